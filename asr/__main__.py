@@ -3,7 +3,7 @@ import asyncio
 import click
 
 from asr.client import ASRClient
-from asr.vad import VAD
+from asr.vad import EnergyGate, VAD
 from common import int_or_str
 
 # Create an event loop shared between the different CLI groups
@@ -24,12 +24,36 @@ ASR = None
 @click.option(
     "-v", "--vad-aggressiveness", type=int, help="VAD aggressiveness", default=1
 )
-def cli(asr_server_uri, vad_aggressiveness):
+@click.option(
+    "--max-in-flight",
+    type=int,
+    help="Max. audio blocks sent to the ASR server waiting for a result",
+    default=ASRClient.MAX_IN_FLIGHT,
+)
+@click.option(
+    "--hangover-ms",
+    type=int,
+    help="Silence (ms) after the last word ending the utterance",
+    default=ASRClient.HANGOVER_MS,
+)
+@click.option(
+    "--energy-gate-db",
+    type=float,
+    help="Skip the VAD on blocks within this margin (dB) of the noise floor",
+    default=None,
+)
+def cli(asr_server_uri, vad_aggressiveness, max_in_flight, hangover_ms, energy_gate_db):
     """Run ASR client to submit an audio file or an audio capture"""
 
     async def init():
         global ASR
-        ASR = ASRClient(asr_server_uri, VAD(vad_aggressiveness))
+        gate = EnergyGate(energy_gate_db) if energy_gate_db is not None else None
+        ASR = ASRClient(
+            asr_server_uri,
+            VAD(vad_aggressiveness, gate=gate),
+            max_in_flight=max_in_flight,
+            hangover_ms=hangover_ms,
+        )
 
     task = loop.create_task(init())
     loop.run_until_complete(task)
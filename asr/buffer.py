@@ -0,0 +1,345 @@
+import asyncio
+import functools
+import mmap
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+SHM_DIR = "/dev/shm"
+
+
+class RingBuffer:
+    """Fixed size circular buffer holding the last N seconds of PCM frames.
+
+    The memory is allocated once; writing a block copies it in place and
+    never grows the buffer. Frames are addressed by an absolute (monotonic)
+    frame index so readers can keep their own cursor, and the wall-clock
+    time of the last written frame is kept to map timestamps to frames.
+
+    A buffer can live in shared memory (see 'create_shared' and 'attach')
+    so consumers in other processes read the frames written by a single
+    capture process without copying them.
+    """
+
+    # Shared memory layout: a header with the counters followed by the frames
+    HEADER_BYTES = 64
+    _WRITTEN, _CAPACITY, _SAMPLE_RATE, _CHANNELS = range(4)
+    _LAST_TIME = 4
+    _FINISHED, _DTYPE = 5, 6
+
+    def __init__(
+        self,
+        seconds: float,
+        sample_rate: int,
+        channels: int = 1,
+        dtype: str = "int16",
+        buffer=None,
+    ) -> None:
+        capacity = round(seconds * sample_rate)
+        if buffer is None:
+            buffer = bytearray(
+                self.HEADER_BYTES + capacity * channels * np.dtype(dtype).itemsize
+            )
+
+        self.name = None
+        self._buffer = buffer
+        self._counters = np.frombuffer(buffer, dtype="int64", count=7)
+        self._times = np.frombuffer(buffer, dtype="float64", count=5)
+        self._data = np.frombuffer(
+            buffer, dtype=dtype, count=capacity * channels, offset=self.HEADER_BYTES
+        ).reshape(capacity, channels)
+
+        self._counters[self._CAPACITY] = capacity
+        self._counters[self._SAMPLE_RATE] = sample_rate
+        self._counters[self._CHANNELS] = channels
+        self._counters[self._DTYPE] = ord(np.dtype(dtype).char)
+
+    @classmethod
+    def _shm_path(cls, name: str) -> Path:
+        return Path(SHM_DIR) / name
+
+    @classmethod
+    def create_shared(
+        cls,
+        name: str,
+        seconds: float,
+        sample_rate: int,
+        channels: int = 1,
+        dtype: str = "int16",
+    ) -> "RingBuffer":
+        """Creates a ring buffer in shared memory (a file under /dev/shm)"""
+        frame_bytes = channels * np.dtype(dtype).itemsize
+        size = cls.HEADER_BYTES + round(seconds * sample_rate) * frame_bytes
+        with cls._shm_path(name).open("w+b") as f:
+            f.truncate(size)
+            buffer = mmap.mmap(f.fileno(), size)
+
+        ring = cls(seconds, sample_rate, channels, dtype, buffer=buffer)
+        ring.name = name
+        return ring
+
+    @classmethod
+    def attach(cls, name: str) -> "RingBuffer":
+        """Attaches to a ring buffer created by another process"""
+        with cls._shm_path(name).open("r+b") as f:
+            buffer = mmap.mmap(f.fileno(), 0)
+
+        header = np.frombuffer(buffer, dtype="int64", count=7)
+        capacity = header[cls._CAPACITY]
+        sample_rate = header[cls._SAMPLE_RATE]
+        dtype = np.dtype(chr(header[cls._DTYPE]))
+        ring = cls(
+            capacity / sample_rate, sample_rate, header[cls._CHANNELS], dtype, buffer
+        )
+        ring.name = name
+        return ring
+
+    @classmethod
+    def unlink(cls, name: str) -> None:
+        cls._shm_path(name).unlink()
+
+    @property
+    def capacity(self) -> int:
+        return int(self._counters[self._CAPACITY])
+
+    @property
+    def sample_rate(self) -> int:
+        return int(self._counters[self._SAMPLE_RATE])
+
+    @property
+    def channels(self) -> int:
+        return int(self._counters[self._CHANNELS])
+
+    @property
+    def written(self) -> int:
+        """Total number of frames ever written"""
+        return int(self._counters[self._WRITTEN])
+
+    @property
+    def last_time(self) -> Optional[float]:
+        """Wall-clock time of the last written frame"""
+        return float(self._times[self._LAST_TIME]) if self.written else None
+
+    @property
+    def finished(self) -> bool:
+        """True once the writer is done: no more frames will be written"""
+        return bool(self._counters[self._FINISHED])
+
+    @finished.setter
+    def finished(self, finished: bool) -> None:
+        self._counters[self._FINISHED] = finished
+
+    @property
+    def oldest(self) -> int:
+        """Index of the oldest frame still available"""
+        return max(0, self.written - self.capacity)
+
+    def write(self, block: np.ndarray, timestamp: Optional[float] = None) -> None:
+        """Copies a (frames, channels) block into the buffer"""
+        written = self.written
+        n = len(block)
+        if n > self.capacity:
+            # Only the tail of the block fits
+            block = block[-self.capacity :]
+            written += n - self.capacity
+            n = self.capacity
+
+        start = written % self.capacity
+        end = start + n
+        if end <= self.capacity:
+            self._data[start:end] = block
+        else:
+            split = self.capacity - start
+            self._data[start:] = block[:split]
+            self._data[: end - self.capacity] = block[split:]
+
+        # Publish the frames only once they are in place
+        self._times[self._LAST_TIME] = (
+            timestamp if timestamp is not None else time.time()
+        )
+        self._counters[self._WRITTEN] = written + n
+
+    def frame_at(self, timestamp: float) -> int:
+        """Index of the frame captured at the given wall-clock time.
+        Clamped to the frames currently available in the buffer.
+        """
+        if self.last_time is None:
+            return self.written
+
+        ago = int((self.last_time - timestamp) * self.sample_rate)
+        return min(self.written, max(self.oldest, self.written - ago))
+
+    def read(self, start: int, n: int) -> Optional[np.ndarray]:
+        """Returns 'n' frames starting at the absolute frame index 'start'.
+
+        Returns None if those frames haven't been written yet and raises an
+        IndexError if they have already been overwritten. The result is a
+        view of the buffer unless the frames wrap around its end.
+        """
+        if start < self.oldest:
+            raise IndexError(f"Frame {start} overwritten (oldest: {self.oldest})")
+
+        if start + n > self.written:
+            return None
+
+        i = start % self.capacity
+        if i + n <= self.capacity:
+            return self._data[i : i + n]
+
+        return np.concatenate((self._data[i:], self._data[: i + n - self.capacity]))
+
+
+class RingReader:
+    """A consumer cursor over a RingBuffer.
+
+    Each consumer keeps its own position; reading never copies the frames
+    (unless they wrap around the end of the buffer). When the consumer falls
+    behind the writer the lost frames are skipped and counted as overruns.
+
+    As blocks are views, a consumer slower than the buffer length can see a
+    block overwritten while still using it: 'overwritten' tells it (once
+    done with the block) so it can discard the result.
+    """
+
+    def __init__(self, ring: RingBuffer, cursor: Optional[int] = None) -> None:
+        self.ring = ring
+        self.cursor = ring.written if cursor is None else cursor
+        self.overruns = 0
+        self._last = None  # start of the last block read
+
+    @property
+    def available(self) -> int:
+        return self.ring.written - self.cursor
+
+    def seek(self, timestamp: float) -> None:
+        self.cursor = self.ring.frame_at(timestamp)
+
+    def read(self, n: int) -> Optional[np.ndarray]:
+        """Returns the next 'n' frames or None if not captured yet"""
+        try:
+            block = self.ring.read(self.cursor, n)
+        except IndexError:
+            self.overruns += 1
+            self.cursor = self.ring.oldest
+            block = self.ring.read(self.cursor, n)
+
+        if block is not None:
+            self._last = self.cursor
+            self.cursor += n
+
+        return block
+
+    def overwritten(self) -> bool:
+        """True (and counted as an overrun) if the writer reached the last
+        block read, i.e. its view may hold newer frames
+        """
+        if self._last is None or self._last >= self.ring.oldest:
+            return False
+
+        self.overruns += 1
+        self._last = None
+        return True
+
+    def wait_s(self, n: int) -> float:
+        """Seconds until 'n' frames are available for reading"""
+        return max(0, n - self.available) / self.ring.sample_rate
+
+
+class BlockPool:
+    """Fixed number of preallocated slots for the audio blocks delivered by
+    the input stream callback.
+
+    The producer (audio thread) copies each block into the next free slot
+    instead of allocating a new 'bytes' object, and the consumer gets a
+    memoryview of the slot which is only reused once released. The consumer
+    is woken up only when it is actually waiting for a block.
+
+    'overruns' counts the blocks dropped because the consumer didn't keep up
+    and 'underruns' the times the consumer had to wait for a block.
+    """
+
+    def __init__(self, n_blocks: int, block_bytes: int) -> None:
+        self.n_blocks = n_blocks
+        self.block_bytes = block_bytes
+        self._memory = memoryview(bytearray(n_blocks * block_bytes))
+        self._sizes = [0] * n_blocks
+        self._head = 0  # blocks written by the producer
+        self._tail = 0  # blocks released by the consumer
+        self._waiting = False
+        self._wakeup = None
+        self.overruns = 0
+        self.underruns = 0
+
+    @property
+    def stats(self) -> dict:
+        return {"overruns": self.overruns, "underruns": self.underruns}
+
+    def __len__(self) -> int:
+        return self._head - self._tail
+
+    def put(self, data) -> bool:
+        """Copies a block into the pool. Called from the audio thread"""
+        if len(self) >= self.n_blocks:
+            self.overruns += 1
+            return False
+
+        slot = self._head % self.n_blocks
+        start = slot * self.block_bytes
+        size = len(data)
+        self._memory[start : start + size] = data
+        self._sizes[slot] = size
+        self._head += 1
+
+        if self._waiting:
+            self._wakeup()
+
+        return True
+
+    def peek(self) -> Optional[memoryview]:
+        """The oldest block not released yet (None if there is none)"""
+        if not len(self):
+            return None
+
+        slot = self._tail % self.n_blocks
+        start = slot * self.block_bytes
+        return self._memory[start : start + self._sizes[slot]]
+
+    def release(self) -> None:
+        """Gives the oldest block slot back to the producer"""
+        if len(self):
+            self._tail += 1
+
+    def clear(self) -> None:
+        self._tail = self._head
+
+    def get(self, timeout: Optional[float] = None) -> Optional[memoryview]:
+        """Blocks until there is a block to consume"""
+        if not len(self):
+            self.underruns += 1
+            event = threading.Event()
+            self._wakeup = event.set
+            self._waiting = True
+            # Re-check so a block put before '_waiting' was set isn't missed
+            if not len(self):
+                event.wait(timeout)
+            self._waiting = False
+
+        return self.peek()
+
+    async def get_async(self) -> memoryview:
+        """Awaits until there is a block to consume"""
+        while not len(self):
+            self.underruns += 1
+            loop = asyncio.get_running_loop()
+            event = asyncio.Event()
+            self._wakeup = functools.partial(loop.call_soon_threadsafe, event.set)
+            self._waiting = True
+            # Re-check so a block put before '_waiting' was set isn't missed
+            if not len(self):
+                await event.wait()
+            self._waiting = False
+
+        return self.peek()
@@ -0,0 +1,295 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import wave
+from typing import AsyncIterator, Optional
+
+import numpy as np
+
+from asr.buffer import RingBuffer, RingReader
+from common.utils.io import init_logger
+
+logger = logging.getLogger(__name__)
+init_logger(level=os.getenv("LOG_LEVEL", logging.INFO), logger=logger)
+
+
+def _select(block: np.ndarray, channel: Optional[int]) -> np.ndarray:
+    """A single channel of a block (all of them if None). Always a view of
+    the buffer, strided for a channel of multichannel audio
+    """
+    return block if channel is None else block[:, channel]
+
+
+def as_bytes(block) -> memoryview:
+    """Bytes of a block of frames (or any buffer). Only copied if the block
+    isn't contiguous, e.g. a channel of multichannel audio
+    """
+    if isinstance(block, np.ndarray):
+        block = np.ascontiguousarray(block)
+    return memoryview(block).cast("B")
+
+
+class CaptureSource:
+    """Base class of the audio sources writing into a RingBuffer.
+
+    Consumers read blocks from any point still in the buffer, e.g. from the
+    moment the hotword was detected, so nothing said between the detection
+    and the consumer start is lost and the device isn't re-opened each time.
+    """
+
+    BUFFER_SECONDS = 5
+    BLOCK_SIZE = 1024
+
+    def __init__(self, ring: RingBuffer) -> None:
+        self.ring = ring
+
+    @property
+    def sample_rate(self) -> int:
+        return self.ring.sample_rate
+
+    @property
+    def channels(self) -> int:
+        return self.ring.channels
+
+    @property
+    def finished(self) -> bool:
+        """True once no more frames will be written (kept in the buffer, so
+        consumers in other processes see it too)
+        """
+        return self.ring.finished
+
+    def start(self) -> "CaptureSource":
+        return self
+
+    def stop(self) -> None:
+        pass
+
+    def reader(self, start_time: Optional[float] = None) -> RingReader:
+        reader = RingReader(self.ring)
+        if start_time:
+            reader.seek(start_time)
+
+        return reader
+
+    async def blocks(
+        self,
+        block_size: int,
+        start_time: Optional[float] = None,
+        channel: Optional[int] = 0,
+    ) -> AsyncIterator[np.ndarray]:
+        """Yields consecutive blocks of 'block_size' frames starting at the
+        frame captured at 'start_time' (or now if not given). Blocks contain
+        a single channel unless 'channel' is None and are only valid until
+        the next one is requested. Once the source is finished the last
+        (shorter) block is yielded.
+
+        Blocks are views of the buffer, never copied: consumers needing
+        contiguous bytes (see 'as_bytes') pay for the copy.
+        """
+        reader = self.reader(start_time)
+        logger.debug(
+            f"🎙️ Reading from frame {reader.cursor} "
+            f"({reader.available / self.sample_rate:.2f}s ago)"
+        )
+        while True:
+            block = reader.read(block_size)
+            if block is None:
+                if self.finished:
+                    if reader.available:
+                        yield _select(reader.read(reader.available), channel)
+                    return
+
+                # Sleep as long as it takes to capture the missing frames
+                await asyncio.sleep(reader.wait_s(block_size))
+                continue
+
+            yield _select(block, channel)
+            if reader.overwritten():
+                logger.warning("🎙️ Block overwritten while in use, reader too slow")
+
+    def stream(self, channel: Optional[int] = 0) -> "RingStream":
+        return RingStream(self.reader(), channel, source=self)
+
+
+class RingStream:
+    """File-like blocking reader over a capture buffer. Can be used as a
+    custom stream for the hotword PreciseRunner (16 bits mono audio).
+
+    Reads return views of the buffer, valid until the next read. Once the
+    'source' is finished reads return what is left (empty at the end).
+    """
+
+    def __init__(
+        self,
+        reader: RingReader,
+        channel: Optional[int] = 0,
+        source: Optional[CaptureSource] = None,
+    ) -> None:
+        self.reader = reader
+        self.channel = channel
+        self.source = source
+
+    def read(self, n_bytes: int) -> memoryview:
+        if self.reader.overwritten():
+            logger.warning("🎙️ Block overwritten while in use, reader too slow")
+
+        n = n_bytes // 2
+        if self.channel is None:
+            n //= self.reader.ring.channels
+        block = self.reader.read(n)
+        while block is None:
+            if self.source is not None and self.source.finished:
+                block = self.reader.read(min(n, self.reader.available))
+                break
+            time.sleep(self.reader.wait_s(n))
+            block = self.reader.read(n)
+
+        return as_bytes(_select(block, self.channel))
+
+
+class AudioCapture(CaptureSource):
+    """Keeps the input device open writing the captured audio into a ring
+    buffer with the last 'seconds' of audio. If 'shm_name' is given the
+    buffer is created in shared memory so other processes can attach to it.
+    """
+
+    def __init__(
+        self,
+        sample_rate: int,
+        device_id: Optional[int] = None,
+        channels: int = 1,
+        seconds: Optional[float] = None,
+        block_size: Optional[int] = None,
+        shm_name: Optional[str] = None,
+    ) -> None:
+        seconds = seconds or self.BUFFER_SECONDS
+        if shm_name:
+            ring = RingBuffer.create_shared(shm_name, seconds, sample_rate, channels)
+        else:
+            ring = RingBuffer(seconds, sample_rate, channels)
+
+        super().__init__(ring)
+        self.device_id = device_id
+        self.block_size = block_size or self.BLOCK_SIZE
+        self._stream = None
+
+    def _callback(self, indata, frames, time_info, status):
+        """This is called (from a separate thread) for each audio block."""
+        if status:
+            logger.warning(f"🎙️ Capture status: {status}")
+
+        block = np.frombuffer(indata, dtype="int16").reshape(-1, self.channels)
+        self.ring.write(block, time.time())
+
+    def start(self) -> "AudioCapture":
+        import sounddevice as sd
+
+        self.ring.finished = False
+
+        logger.info(
+            f"🎙️ Starting capture on device {self.device_id} "
+            f"({self.sample_rate} Hz, {self.channels} channels, "
+            f"{self.ring.capacity} frames buffer)"
+        )
+        self._stream = sd.RawInputStream(
+            samplerate=self.sample_rate,
+            blocksize=self.block_size,
+            device=self.device_id,
+            dtype="int16",
+            channels=self.channels,
+            callback=self._callback,
+        )
+        self._stream.start()
+        return self
+
+    def stop(self) -> None:
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
+
+        self.ring.finished = True
+        if self.ring.name:
+            RingBuffer.unlink(self.ring.name)
+
+
+class WavCapture(CaptureSource):
+    """Fake capture source playing a WAV file into the ring buffer in (or
+    faster than) real time. Allows running the capture consumers without
+    any audio hardware.
+    """
+
+    def __init__(
+        self,
+        wav_file: str,
+        seconds: Optional[float] = None,
+        block_size: Optional[int] = None,
+        shm_name: Optional[str] = None,
+        speed: float = 1.0,
+        loop: bool = False,
+    ) -> None:
+        with wave.open(wav_file, "rb") as wf:
+            if wf.getsampwidth() != 2:
+                raise ValueError(f"Only 16 bits PCM WAV files supported: {wav_file}")
+            sample_rate, channels = wf.getframerate(), wf.getnchannels()
+            frames = wf.readframes(wf.getnframes())
+
+        seconds = seconds or self.BUFFER_SECONDS
+        if shm_name:
+            ring = RingBuffer.create_shared(shm_name, seconds, sample_rate, channels)
+        else:
+            ring = RingBuffer(seconds, sample_rate, channels)
+
+        super().__init__(ring)
+        self.wav_file = wav_file
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.speed = speed
+        self.loop = loop
+        self._frames = np.frombuffer(frames, dtype="int16").reshape(-1, channels)
+        self._running = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        block_s = self.block_size / self.sample_rate / self.speed
+        try:
+            while self._running.is_set():
+                for i in range(0, len(self._frames), self.block_size):
+                    if not self._running.is_set():
+                        return
+
+                    block = self._frames[i : i + self.block_size]
+                    self.ring.write(block, time.time())
+                    time.sleep(block_s)
+
+                if not self.loop:
+                    return
+        finally:
+            self.ring.finished = True
+
+    def start(self) -> "WavCapture":
+        logger.info(f"🎙️ Starting fake capture from: {self.wav_file}")
+        self.ring.finished = False
+        self._running.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self.ring.name:
+            RingBuffer.unlink(self.ring.name)
+
+
+class SharedCapture(CaptureSource):
+    """Consumer side of a capture running in another process (see
+    raspvan.workers.capture), attached through its shared memory buffer.
+    """
+
+    def __init__(self, shm_name: str) -> None:
+        super().__init__(RingBuffer.attach(shm_name))
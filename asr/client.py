@@ -4,20 +4,181 @@ import logging
 import os
 import time
 import wave
-from typing import Dict, Optional
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, Dict, Optional, TYPE_CHECKING, Union
 
-import sounddevice as sd
+import numpy as np
 import websockets
+from websockets.exceptions import WebSocketException
 
 from asr import calc_block_size
+from asr.buffer import BlockPool
+from asr.capture import as_bytes, CaptureSource
+from asr.endpointer import Endpointer
 from asr.vad import VAD
 from common.utils.io import init_logger
-from respeaker.pixels import Pixels
+
+if TYPE_CHECKING:
+    from respeaker.pixels import Pixels
 
 logger = logging.getLogger(__name__)
 init_logger(level=os.getenv("LOG_LEVEL", logging.INFO), logger=logger)
 
 
+class ASRSession:
+    """A websocket connection to the ASR server already configured with a
+    sample rate, so audio can be streamed right away.
+    """
+
+    CONFIG_MSG = '{ "config" : { "sample_rate" : %d } }'
+    RESET_MSG = '{"reset" : 1}'
+
+    def __init__(self, asr_uri: str, sample_rate: float) -> None:
+        self.asr_uri = asr_uri
+        self.sample_rate = sample_rate
+        self.websocket = None
+        self.last_used = time.time()
+
+    @property
+    def closed(self) -> bool:
+        return self.websocket is None or self.websocket.closed
+
+    async def open(self) -> "ASRSession":
+        self.websocket = await websockets.connect(self.asr_uri)
+        await self.websocket.send(self.CONFIG_MSG % self.sample_rate)
+        return self
+
+    async def reset(self) -> Dict[str, str]:
+        """Finishes the current utterance keeping the connection open"""
+        await self.websocket.send(self.RESET_MSG)
+        return json.loads(await self.websocket.recv())
+
+    async def ping(self, timeout: float) -> bool:
+        try:
+            pong = await self.websocket.ping()
+            await asyncio.wait_for(pong, timeout)
+        except (asyncio.TimeoutError, OSError, WebSocketException):
+            return False
+
+        return True
+
+    async def close(self) -> None:
+        if not self.closed:
+            await self.websocket.close()
+
+
+class ASRSessionPool:
+    """Keeps a number of ASR sessions open and ready so an utterance doesn't
+    pay for the TCP handshake and the recognizer setup.
+
+    Idle sessions are periodically pinged and transparently re-opened when
+    found dead. Sessions are borrowed with:
+
+        async with pool.session(sample_rate) as session:
+            ...
+    """
+
+    PING_EVERY_S = 30
+    PING_TIMEOUT_S = 5
+
+    def __init__(self, asr_uri: str, size: int = 1) -> None:
+        self.asr_uri = asr_uri
+        self.size = size
+        self._idle = []
+        self._keepalive_task = None
+        self.stats = {"connects": 0, "reconnects": 0, "connect_s": 0.0}
+
+    async def _connect(self, sample_rate: float) -> ASRSession:
+        start = time.time()
+        session = await ASRSession(self.asr_uri, sample_rate).open()
+        self.stats["connects"] += 1
+        self.stats["connect_s"] += time.time() - start
+        return session
+
+    async def _is_usable(self, session: ASRSession, sample_rate: float) -> bool:
+        if session.closed or session.sample_rate != sample_rate:
+            return False
+
+        # Sessions idle for long might have been silently dropped
+        if time.time() - session.last_used > self.PING_EVERY_S:
+            return await session.ping(self.PING_TIMEOUT_S)
+
+        return True
+
+    async def _give_back(self, session: ASRSession) -> None:
+        if not session.closed and len(self._idle) < self.size:
+            self._idle.append(session)
+        else:
+            await session.close()
+
+    async def _keepalive(self) -> None:
+        while True:
+            await asyncio.sleep(self.PING_EVERY_S)
+            # Checked out of the pool so 'session' can't lend them meanwhile
+            sessions, self._idle = self._idle, []
+            try:
+                while sessions:
+                    session = sessions[0]
+                    if session.closed or not await session.ping(self.PING_TIMEOUT_S):
+                        logger.warning("🔌 ASR session found dead. Reconnecting...")
+                        await session.close()
+                        try:
+                            sessions[0] = await self._connect(session.sample_rate)
+                            self.stats["reconnects"] += 1
+                        except (asyncio.TimeoutError, OSError, WebSocketException):
+                            logger.exception("Error reconnecting ASR session")
+                            sessions.pop(0)
+                            continue
+                    await self._give_back(sessions.pop(0))
+            finally:
+                # Not checked yet when cancelled ('close' disposes of them)
+                self._idle.extend(sessions)
+
+    async def start(self, sample_rate: float) -> None:
+        """Opens the pool sessions and launches the keepalive task"""
+        while len(self._idle) < self.size:
+            self._idle.append(await self._connect(sample_rate))
+
+        if self._keepalive_task is None:
+            self._keepalive_task = asyncio.ensure_future(self._keepalive())
+
+        logger.info(f"🔌 {len(self._idle)} ASR session(s) ready ({self.asr_uri})")
+
+    @asynccontextmanager
+    async def session(self, sample_rate: float):
+        session = None
+        while self._idle and session is None:
+            session = self._idle.pop()
+            if not await self._is_usable(session, sample_rate):
+                await session.close()
+                session = None
+                self.stats["reconnects"] += 1
+
+        if session is None:
+            session = await self._connect(sample_rate)
+
+        try:
+            yield session
+        except BaseException:
+            # Also when cancelled: the session state is unknown, do not give
+            # it back to the pool
+            await session.close()
+            raise
+
+        session.last_used = time.time()
+        await self._give_back(session)
+
+    async def close(self) -> None:
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._keepalive_task
+            self._keepalive_task = None
+
+        while self._idle:
+            await self._idle.pop().close()
+
+
 class ASRClient:
     # TODO: Make as parameters
     MAX_SECONDS_NO_VOICE = 3
@@ -25,45 +186,132 @@ class ASRClient:
     ASR_BLOCK_SIZE = 4000
     VAD_BLOCK_MS = 30
     VOICE_TH = 0.9
+    HANGOVER_MS = 300  # silence after the last word ending the utterance
+    MAX_IN_FLIGHT = 8  # blocks sent to the ASR server waiting for a result
+    MAX_QUEUED_BLOCKS = 40  # ~10s of captured audio waiting to be sent
 
-    def __init__(self, asr_uri: str, vad: VAD, pixels: Optional[Pixels] = None) -> None:
+    def __init__(
+        self,
+        asr_uri: str,
+        vad: VAD,
+        pixels: Optional["Pixels"] = None,
+        max_in_flight: Optional[int] = None,
+        max_queued_blocks: Optional[int] = None,
+        n_sessions: int = 1,
+        hangover_ms: Optional[int] = None,
+    ) -> None:
         self.asr_uri = asr_uri
+        self.hangover_ms = self.HANGOVER_MS if hangover_ms is None else hangover_ms
+        self.sessions = ASRSessionPool(asr_uri, size=n_sessions)
+        self.latency = {"activations": 0, "setup_s": 0.0, "total_s": 0.0}
         self.loop = asyncio.get_running_loop()
-        self.audio_queue = asyncio.Queue()
-        self.pixels = pixels or Pixels()
+        self.max_in_flight = max_in_flight or self.MAX_IN_FLIGHT
+        self.audio_pool = BlockPool(
+            max_queued_blocks or self.MAX_QUEUED_BLOCKS,
+            2 * self.ASR_BLOCK_SIZE,  # int16 pcm data
+        )
+        if pixels is None:
+            # The LEDs (GPIO) are only needed without a custom pixels object
+            from respeaker.pixels import Pixels
+
+            pixels = Pixels()
+        self.pixels = pixels
         self.vad = vad
 
-    async def from_wave(self, wave_file: str) -> Dict[str, str]:
-        async with websockets.connect(self.asr_uri) as websocket:
-            wf = wave.open(wave_file, "rb")
-            await websocket.send(
-                '{ "config" : { "sample_rate" : %d } }' % (wf.getframerate())
+    async def warmup(self, sample_rate: float) -> None:
+        """Opens the ASR sessions ahead of the first utterance"""
+        await self.sessions.start(sample_rate)
+
+    @property
+    def setup_share(self) -> float:
+        """Share of the activations time spent setting up the ASR session"""
+        if not self.latency["total_s"]:
+            return 0.0
+        return self.latency["setup_s"] / self.latency["total_s"]
+
+    def _track_latency(self, setup_s: float, total_s: float) -> None:
+        self.latency["activations"] += 1
+        self.latency["setup_s"] += setup_s
+        self.latency["total_s"] += total_s
+        logger.debug(
+            f"⏳️ ASR session setup: {setup_s:.3f}s of {total_s:.3f}s "
+            f"(overall share: {self.setup_share:.1%})"
+        )
+        gate = getattr(self.vad, "gate", None)
+        if gate is not None and gate.total_frames:
+            logger.debug(
+                f"🔇 Energy gate skipped {gate.skipped_frames} of "
+                f"{gate.total_frames} VAD frames"
             )
+
+    async def from_wave(self, wave_file: str) -> Dict[str, str]:
+        wf = wave.open(wave_file, "rb")
+        async with self.sessions.session(wf.getframerate()) as session:
             buffer_size = int(wf.getframerate() * 0.2)  # 0.2 seconds of audio
             while True:
                 data = wf.readframes(buffer_size)
                 if len(data) == 0:
                     break
 
-                await websocket.send(data)
-                logger.debug(await websocket.recv())
+                await session.websocket.send(data)
+                logger.debug(await session.websocket.recv())
 
-            await websocket.send('{"eof" : 1}')
+            return await session.reset()
 
-            return json.loads(await websocket.recv())
+    async def stream_mic(
+        self,
+        sample_rate: float,
+        device_id: int,
+        capture: Optional[CaptureSource] = None,
+        start_time: Optional[float] = None,
+    ) -> str:
+        """Runs ASR on the microphone audio until the end of the utterance.
+
+        If an (already running) capture source is given, the audio is read from
+        its buffer starting at 'start_time' instead of opening the device.
+        """
+        if capture is not None:
+            blocks = capture.blocks(self.ASR_BLOCK_SIZE, start_time)
+            return await self._recognize(blocks, capture.sample_rate)
+
+        # OSError if the PortAudio library isn't installed
+        import sounddevice as sd
 
-    async def stream_mic(self, sample_rate: float, device_id: int) -> Dict[str, str]:
         def _callback(indata, frames, time, status):
             """This is called (from a separate thread) for each audio block."""
-            self.loop.call_soon_threadsafe(self.audio_queue.put_nowait, bytes(indata))
+            if not self.audio_pool.put(indata):
+                logger.warning(f"🧊 Audio pool full! ({self.audio_pool.stats})")
+
+        async def _pooled_blocks():
+            while True:
+                block = await self.audio_pool.get_async()
+                try:
+                    yield block
+                finally:
+                    # the block is processed once the next one is requested
+                    self.audio_pool.release()
+
+        with sd.RawInputStream(
+            samplerate=sample_rate,
+            blocksize=self.ASR_BLOCK_SIZE,
+            device=device_id,
+            dtype="int16",
+            channels=1,
+            callback=_callback,
+        ) as device:
+            text = await self._recognize(_pooled_blocks(), device.samplerate)
 
-        async def _do_asr(pcm_data):
-            # ASR on the entire buffer
-            await websocket.send(pcm_data)
-            res = json.loads(await websocket.recv())
+            # empty the pool
+            self.audio_pool.clear()
+            logger.debug(f"🎙️ Audio pool: {self.audio_pool.stats}")
 
-            return res.get("text", "")
+            return text
 
+    async def _recognize(
+        self,
+        blocks: AsyncIterator[Union[bytes, memoryview, np.ndarray]],
+        sample_rate: float,
+    ) -> str:
         # Compute pcm buffer parameters
         asr_block_ms = self.ASR_BLOCK_SIZE / sample_rate * 1000  # e.g: 250ms
         vad_block_size = calc_block_size(self.VAD_BLOCK_MS, sample_rate)
@@ -72,68 +320,114 @@ class ASRClient:
             f"ASR Block ms: {asr_block_ms} | VAD block size: {vad_block_size} "
         )
 
-        with sd.RawInputStream(
-            samplerate=sample_rate,
-            blocksize=self.ASR_BLOCK_SIZE,
-            device=device_id,
-            dtype="int16",
-            channels=1,
-            callback=_callback,
-        ) as device:
-            text = ""
-
-            # Blocks of size 4000 @ 16kHz are 250 ms of audio
-            # however for VAD we need 10, 20 or 30 ms blocks
-            async with websockets.connect(self.asr_uri) as websocket:
-                await websocket.send(
-                    '{ "config" : { "sample_rate" : %d } }' % (device.samplerate)
-                )
-                self.pixels.speak()
-                start = time.time()
-                # t_last_voice = start
-                total_seconds_no_voice = 0
-                total_seconds_voice = 0
-                i = 0
-                while True:
-                    i += 1
-                    data = await self.audio_queue.get()
-
-                    if self.vad.is_voice(data, device.samplerate, self.VAD_BLOCK_MS):
-                        total_seconds_no_voice = 0
-                        total_seconds_voice += asr_block_ms / 1000
-
-                        if total_seconds_voice >= self.MAX_SECONDS_VOICE:
-                            logger.info(
-                                f"🛑 Stopped listening after {total_seconds_voice}s "
-                                f"capturing voice (block {i})"
-                            )
-                            break
-                    else:
-                        # time from microphone perspective
-                        total_seconds_no_voice += asr_block_ms / 1000
-
-                        if total_seconds_no_voice >= self.MAX_SECONDS_NO_VOICE:
-                            logger.info(
-                                f"🛑 Stopped listening after {total_seconds_no_voice}s "
-                                f"without detecting voice (block {i})"
-                            )
-                            break
-
-                    # NOTE: While we run the ASR the microphone continues
-                    # to collect audio frames and potentially we can
-                    # break due to having 'silent' audio blocks before
-                    # the ASR has completed!
-                    # logger.debug(f"🎙️ [block {i}] Running ASR! ({len(data)})")
-                    text += await _do_asr(data)
-
-                # close up pixels and asr-server sock stream
-                self.pixels.off()
-                await websocket.send('{"eof" : 1}')
-
-                # empty the queue
-                for _ in range(self.audio_queue.qsize()):
-                    self.audio_queue.get_nowait()
-
-                logger.debug(f"⏳️ Total run time: {time.time() - start}")
-
-                return text
+        # Blocks of size 4000 @ 16kHz are 250 ms of audio
+        # however for VAD we need 10, 20 or 30 ms blocks
+        start = time.time()
+        async with self.sessions.session(sample_rate) as session:
+            setup_s = time.time() - start
+            self.pixels.speak()
+
+            try:
+                text = await self._stream(session.websocket, blocks, sample_rate)
+            finally:
+                await blocks.aclose()
+
+            # close up pixels
+            self.pixels.off()
+
+        self._track_latency(setup_s, time.time() - start)
+
+        return text
+
+    async def _stream(
+        self,
+        websocket,
+        blocks: AsyncIterator[Union[bytes, memoryview, np.ndarray]],
+        sample_rate: float,
+    ) -> str:
+        """Streams the audio blocks to the ASR server.
+
+        A sender task pushes the blocks as soon as they are captured while a
+        receiver task collects the (partial and final) results, so uploading
+        audio never waits on the recognition round trip. The number of blocks
+        sent but not yet answered by the server is bounded by 'max_in_flight'.
+        """
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        reset_sent = asyncio.Event()
+        n_sent = 0
+        texts = []
+
+        async def _send():
+            nonlocal n_sent
+            endpointer = Endpointer(
+                self.vad,
+                sample_rate,
+                frame_ms=self.VAD_BLOCK_MS,
+                hangover_ms=self.hangover_ms,
+            )
+            # Until the end of the utterance or of the audio (e.g. a WAV file)
+            async for block in blocks:
+                # Capture blocks of a channel of multichannel audio are strided
+                data = as_bytes(block)
+                events = endpointer.process(data)
+
+                await in_flight.acquire()
+                await websocket.send(data)
+                n_sent += 1
+
+                if any(kind == Endpointer.END for kind, _ in events):
+                    logger.info(
+                        f"🛑 Stopped listening. Speech ended at "
+                        f"{endpointer.speech_end / sample_rate:.2f}s"
+                    )
+                    break
+
+                if endpointer.in_speech:
+                    speech_samples = endpointer.samples - endpointer.speech_start
+                    if speech_samples / sample_rate >= self.MAX_SECONDS_VOICE:
+                        logger.info(
+                            f"🛑 Stopped listening after {self.MAX_SECONDS_VOICE}s "
+                            "capturing voice"
+                        )
+                        break
+                elif (
+                    endpointer.speech_start is None
+                    and endpointer.seconds >= self.MAX_SECONDS_NO_VOICE
+                ):
+                    logger.info(
+                        f"🛑 Stopped listening after {endpointer.seconds:.2f}s "
+                        "without detecting voice"
+                    )
+                    break
+
+            # The reply to the 'reset' message carries the final result
+            # and leaves the session ready for the next utterance
+            await in_flight.acquire()
+            await websocket.send(ASRSession.RESET_MSG)
+            n_sent += 1
+            reset_sent.set()
+
+        async def _receive():
+            n_received = 0
+            while True:
+                res = json.loads(await websocket.recv())
+                n_received += 1
+                in_flight.release()
+
+                if res.get("text"):
+                    texts.append(res["text"])
+                elif res.get("partial"):
+                    logger.debug(f"🎙️ Partial: {res['partial']}")
+
+                if reset_sent.is_set() and n_received == n_sent:
+                    break
+
+        sender = asyncio.ensure_future(_send())
+        receiver = asyncio.ensure_future(_receive())
+        try:
+            await asyncio.gather(sender, receiver)
+        finally:
+            sender.cancel()
+            receiver.cancel()
+
+        return " ".join(texts)
@@ -0,0 +1,123 @@
+from collections import deque
+from typing import List, Optional, Tuple
+
+from asr import calc_block_size
+from asr.vad import VAD
+
+
+class Endpointer:
+    """Streaming speech endpointer keeping its state across audio blocks.
+
+    Each block is chopped in VAD frames (a trailing partial frame is kept
+    for the next block) and the frame decisions go into a ring:
+      - speech starts when 'voice_th' of the last 'onset_ms' frames are voiced
+      - speech ends when 'voice_th' of the last 'hangover_ms' are unvoiced
+
+    If the VAD has an energy pre-gate, blocks it rules out as silence count
+    as unvoiced frames without running webrtcvad on them.
+
+    'process' returns the (START | END, sample offset) events found in the
+    block. Offsets count samples since the last reset; the start offset is
+    moved back 'pre_padding_ms' and the end offset forward 'post_padding_ms'.
+    """
+
+    START = "start"
+    END = "end"
+
+    def __init__(
+        self,
+        vad: VAD,
+        sample_rate: int,
+        frame_ms: int = 30,
+        onset_ms: int = 90,
+        hangover_ms: int = 300,
+        pre_padding_ms: int = 300,
+        post_padding_ms: int = 150,
+        voice_th: Optional[float] = None,
+    ) -> None:
+        if frame_ms not in VAD.VALID_BLOCK_MS:
+            raise ValueError(f"frame_ms must be one of {VAD.VALID_BLOCK_MS}")
+
+        self.vad = vad
+        self.sample_rate = int(sample_rate)
+        self.voice_th = voice_th or vad.voice_th
+        self.frame_size = calc_block_size(frame_ms, sample_rate)
+        self.frame_bytes = 2 * self.frame_size  # int16 pcm data
+        self.onset_frames = max(1, onset_ms // frame_ms)
+        self.hangover_frames = max(1, hangover_ms // frame_ms)
+        self.pre_padding = calc_block_size(pre_padding_ms, sample_rate)
+        self.post_padding = calc_block_size(post_padding_ms, sample_rate)
+        self._ring = deque(maxlen=max(self.onset_frames, self.hangover_frames))
+        self.reset()
+
+    def reset(self) -> None:
+        self._ring.clear()
+        self._carry = b""
+        self.samples = 0  # samples processed since the last reset
+        self.in_speech = False
+        self.speech_start = None
+        self.speech_end = None
+        self._last_voiced = 0  # end offset of the last voiced frame
+
+    @property
+    def seconds(self) -> float:
+        return self.samples / self.sample_rate
+
+    def _recent(self, n: int) -> int:
+        """Number of voiced frames within the last 'n' decisions"""
+        return sum(self._ring[i] for i in range(len(self._ring) - n, len(self._ring)))
+
+    def _update(self, is_speech: bool) -> Optional[Tuple[str, int]]:
+        self._ring.append(is_speech)
+        self.samples += self.frame_size
+        if is_speech:
+            self._last_voiced = self.samples
+
+        if not self.in_speech:
+            n = self.onset_frames
+            if len(self._ring) >= n and self._recent(n) >= self.voice_th * n:
+                self.in_speech = True
+                onset = self.samples - n * self.frame_size
+                self.speech_start = max(0, onset - self.pre_padding)
+                self.speech_end = None
+                return self.START, self.speech_start
+        else:
+            n = self.hangover_frames
+            if len(self._ring) >= n and n - self._recent(n) >= self.voice_th * n:
+                self.in_speech = False
+                self.speech_end = min(
+                    self.samples, self._last_voiced + self.post_padding
+                )
+                return self.END, self.speech_end
+
+        return None
+
+    def process(self, pcm_data) -> List[Tuple[str, int]]:
+        """Runs the VAD over a block of int16 mono pcm data"""
+        data = memoryview(pcm_data).cast("B")
+        if self._carry:
+            data = memoryview(self._carry + bytes(data))
+
+        events = []
+        n_frames = len(data) // self.frame_bytes
+        silence = n_frames > 0 and self.vad.is_silence(
+            data[: n_frames * self.frame_bytes], n_frames
+        )
+        n_voiced = 0
+        for i in range(n_frames):
+            if silence:
+                is_speech = False
+            else:
+                frame = data[i * self.frame_bytes : (i + 1) * self.frame_bytes]
+                is_speech = self.vad.is_speech(frame, self.sample_rate)
+                n_voiced += is_speech
+
+            event = self._update(is_speech)
+            if event:
+                events.append(event)
+
+        if n_frames and not silence:
+            self.vad.update_gate(n_voiced, n_frames)
+
+        self._carry = bytes(data[n_frames * self.frame_bytes :])
+        return events
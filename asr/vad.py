@@ -1,34 +1,184 @@
 import logging
 import os
+from typing import Iterator, List, Optional, Tuple
 
+import numpy as np
 import webrtcvad
-from funcy import chunks
 
-from asr import calc_block_size
+from asr import calc_block_size, raw_stream_to_numpy
 from common.utils.io import init_logger
 
 logger = logging.getLogger(__name__)
 init_logger(level=os.getenv("LOG_LEVEL", logging.INFO), logger=logger)
 
 
+class EnergyGate:
+    """Cheap pre-gate in front of webrtcvad for the always-listening path.
+
+    Computes the block RMS and zero-crossing rate (ZCR) and tracks both for
+    the background noise. Blocks whose RMS is within 'margin_db' of the noise
+    floor and whose ZCR looks like the noise one are considered silence, so
+    webrtcvad doesn't need to run on them.
+
+    The noise estimate adapts (exponential average with 'adapt_rate') with
+    every block found to be silence, or with up to 'max_voiced_share' of its
+    VAD frames voiced, and instantly follows quieter blocks. Blocks with
+    some speech in them never raise the floor, so quieter speech after them
+    isn't gated. No block is gated during the first 'warmup_blocks' blocks.
+    """
+
+    def __init__(
+        self,
+        margin_db: float = 6.0,
+        zcr_tolerance: float = 0.1,
+        adapt_rate: float = 0.05,
+        warmup_blocks: int = 4,
+        max_voiced_share: float = 0.1,
+    ) -> None:
+        self.margin = 10 ** (margin_db / 20)
+        self.zcr_tolerance = zcr_tolerance
+        self.adapt_rate = adapt_rate
+        self.warmup_blocks = warmup_blocks
+        self.max_voiced_share = max_voiced_share
+        self.noise_rms = None
+        self.noise_zcr = None
+        self.n_blocks = 0
+        self.total_frames = 0
+        self.skipped_frames = 0
+        self._rms = self._zcr = 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "frames": self.total_frames,
+            "skipped": self.skipped_frames,
+            "noise_rms": self.noise_rms,
+            "noise_zcr": self.noise_zcr,
+        }
+
+    def is_silence(self, pcm_data, n_frames: int) -> bool:
+        """Whether the block is clearly background noise. 'n_frames' is the
+        number of VAD frames in the block (for the skipped frames count).
+        """
+        x = raw_stream_to_numpy(pcm_data, "int16", 1)[:, 0].astype(np.float32)
+        if len(x) < 2:
+            return False
+
+        self._rms = float(np.sqrt(np.mean(x * x)))
+        self._zcr = float(np.mean(np.signbit(x[1:]) != np.signbit(x[:-1])))
+        self.n_blocks += 1
+        self.total_frames += n_frames
+
+        silence = (
+            self.n_blocks > self.warmup_blocks
+            and self.noise_rms is not None
+            and self._rms <= self.noise_rms * self.margin
+            and abs(self._zcr - self.noise_zcr) <= self.zcr_tolerance
+        )
+        if silence:
+            self.skipped_frames += n_frames
+            self.update(0, n_frames)
+
+        return silence
+
+    def update(self, n_voiced: int, n_frames: int) -> None:
+        """Adapts the noise estimate with the last checked block, given how
+        many of its VAD frames were voiced
+        """
+        if n_voiced > self.max_voiced_share * n_frames:
+            return
+
+        if self.noise_rms is None:
+            self.noise_rms, self.noise_zcr = self._rms, self._zcr
+            return
+
+        a = self.adapt_rate
+        self.noise_rms = min(self._rms, (1 - a) * self.noise_rms + a * self._rms)
+        self.noise_zcr = (1 - a) * self.noise_zcr + a * self._zcr
+
+
 class VAD:
     VALID_BLOCK_MS = [10, 20, 30]
 
-    def __init__(self, vad_aggressiveness: int, voice_th: float = 0.9) -> None:
+    def __init__(
+        self,
+        vad_aggressiveness: int,
+        voice_th: float = 0.9,
+        gate: Optional[EnergyGate] = None,
+    ) -> None:
         self.voice_th = voice_th
         self.vad = webrtcvad.Vad(vad_aggressiveness)
+        self.gate = gate
+        self._frame_sizes = {}  # (sample rate, ms) -> (frame bytes, tail bytes)
+
+    def _get_frame_sizes(
+        self, sample_rate: int, vad_block_ms: int
+    ) -> Tuple[int, List[int]]:
+        """Frame size in bytes and the valid sizes for a trailing partial frame
+        (computed once per sample rate and frame length)
+        """
+        key = (sample_rate, vad_block_ms)
+        if key not in self._frame_sizes:
+            if vad_block_ms not in self.VALID_BLOCK_MS:
+                raise ValueError(f"vad_block_ms must be one of {self.VALID_BLOCK_MS}")
+
+            self._frame_sizes[key] = (
+                2 * calc_block_size(vad_block_ms, sample_rate),  # int16 pcm data
+                [
+                    2 * calc_block_size(ms, sample_rate)
+                    for ms in reversed(self.VALID_BLOCK_MS)
+                    if ms < vad_block_ms
+                ],
+            )
+
+        return self._frame_sizes[key]
+
+    def frames(
+        self, pcm_data, sample_rate: int, vad_block_ms: int = 30
+    ) -> Iterator[memoryview]:
+        """Iterates over the VAD frames of the int16 pcm data without copying.
+        A trailing partial frame is cut to the longest valid frame length
+        fitting in it (webrtcvad only takes 10, 20 or 30ms frames).
+        """
+        data = memoryview(pcm_data).cast("B")
+        frame_bytes, tail_sizes = self._get_frame_sizes(sample_rate, vad_block_ms)
+
+        end = len(data) - len(data) % frame_bytes
+        for i in range(0, end, frame_bytes):
+            yield data[i : i + frame_bytes]
+
+        rest = len(data) - end
+        for size in tail_sizes:
+            if rest >= size:
+                yield data[end : end + size]
+                break
+
+    def is_speech(self, frame, sample_rate: int) -> bool:
+        """VAD decision for a single 10, 20 or 30ms frame"""
+        return self.vad.is_speech(frame, int(sample_rate))
+
+    def is_silence(self, pcm_data, n_frames: int) -> bool:
+        """Whether the (optional) energy pre-gate rules the block out"""
+        return self.gate is not None and self.gate.is_silence(pcm_data, n_frames)
+
+    def update_gate(self, n_voiced: int, n_frames: int) -> None:
+        if self.gate is not None:
+            self.gate.update(n_voiced, n_frames)
 
-    def is_voice(self, pcm_data, sample_rate: int, vad_block_ms: int = 30):
-        if vad_block_ms not in self.VALID_BLOCK_MS:
-            raise ValueError(f"vad_block_ms must be one of {self.VALID_BLOCK_MS}")
+    def is_voice(self, pcm_data, sample_rate: int, vad_block_ms: int = 30) -> bool:
+        sample_rate = int(sample_rate)
+        if self.gate is not None:
+            frame_bytes = self._get_frame_sizes(sample_rate, vad_block_ms)[0]
+            if self.is_silence(pcm_data, -(-len(pcm_data) // frame_bytes)):
+                return False
 
-        # Chop the pcm buffer in chunks of max 30ms and do VAD
-        vads = []
-        vad_bytes = 2 * calc_block_size(vad_block_ms, sample_rate)  # int16 pcm data
-        for pcm_chunk in chunks(vad_bytes, pcm_data):
-            _is_speech = self.vad.is_speech(pcm_chunk, int(sample_rate))
-            vads.append(_is_speech)
+        # Chop the pcm buffer in frames of max 30ms and do VAD
+        n_frames = n_voiced = 0
+        for frame in self.frames(pcm_data, sample_rate, vad_block_ms):
+            n_frames += 1
+            n_voiced += self.vad.is_speech(frame, sample_rate)
 
         # Are 90% of the frames voice?
-        is_voice = len(vads) and sum(vads) >= self.voice_th * len(vads)
-        return is_voice
+        if n_frames:
+            self.update_gate(n_voiced, n_frames)
+        return n_frames > 0 and n_voiced >= self.voice_th * n_frames
@@ -0,0 +1,641 @@
+"""In-process stand-in for the RabbitMQ broker.
+
+Implements the subset of the pika connection / channel API used by the queue
+clients in 'common.utils.rabbit' (exchanges, queues, bindings, prefetch,
+acks, publisher confirms) so the workers can talk to each other within a
+single process, or be tested, without a broker. Selected with a 'memory://'
+host (e.g. RABBITMQ_HOST=memory://); 'memory://<name>' gives an independent
+broker per name.
+
+Deliveries are handed to the consumer thread the same way pika does it: a
+BlockingConnection runs them inside 'process_data_events' /
+'start_consuming', a connection bound to an asyncio loop schedules them on
+the loop. Messages only live as long as the process.
+"""
+
+import functools
+import itertools
+import logging
+import queue
+import threading
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pika
+from pika.frame import Method
+
+logger = logging.getLogger(__name__)
+
+MEMORY_SCHEME = "memory"
+EXCHANGE_TYPES = ["direct", "fanout", "topic", "headers"]
+
+
+def is_memory_uri(host: Optional[str]) -> bool:
+    return isinstance(host, str) and host.startswith(f"{MEMORY_SCHEME}://")
+
+
+@functools.lru_cache(maxsize=1024)
+def topic_matches(pattern: str, routing_key: str) -> bool:
+    """AMQP topic matching: '*' matches exactly one word and '#' zero or
+    more ('.' separated)
+    """
+    return _match_words(tuple(pattern.split(".")), tuple(routing_key.split(".")))
+
+
+def _match_words(pattern: Tuple[str, ...], words: Tuple[str, ...]) -> bool:
+    if not pattern:
+        return not words
+    head, rest = pattern[0], pattern[1:]
+    if head == "#":
+        return any(_match_words(rest, words[i:]) for i in range(len(words) + 1))
+    if not words:
+        return False
+    return head in ("*", words[0]) and _match_words(rest, words[1:])
+
+
+def _headers_match(arguments: Dict, headers: Optional[Dict]) -> bool:
+    headers = headers or {}
+    expected = {k: v for k, v in arguments.items() if not k.startswith("x-")}
+    matches = [
+        k in headers and (v is None or headers[k] == v) for k, v in expected.items()
+    ]
+    if arguments.get("x-match", "all") == "any":
+        return any(matches)
+    return all(matches)
+
+
+def _closed_by_broker(channel: "MemoryChannel", code: int, text: str):
+    """Closes the channel as the broker does on a channel error"""
+    error = pika.exceptions.ChannelClosedByBroker(code, text)
+    channel._closed(error)
+    return error
+
+
+class _Queue:
+    def __init__(self, name: str, durable: bool, auto_delete: bool) -> None:
+        self.name = name
+        self.durable = durable
+        self.auto_delete = auto_delete
+        # (exchange, routing key, properties, body, redelivered)
+        self.messages = deque()
+        self.consumers = []  # (channel, consumer tag, callback)
+        self.next_consumer = 0  # round robin position
+
+
+class MemoryBroker:
+    """Exchanges, queues and bindings shared by the connections of a process.
+    Routing and dispatching happen under a lock on the publisher's thread,
+    the consumer callbacks on each consumer's connection thread.
+    """
+
+    def __init__(self, name: str = "") -> None:
+        self.name = name
+        self.exchanges = {"": "direct"}  # name -> type
+        self.bindings = {}  # exchange -> [(queue, routing key, arguments)]
+        self.queues = {}
+        self._lock = threading.RLock()
+
+    def declare_exchange(self, channel, exchange: str, exchange_type: str) -> None:
+        with self._lock:
+            if exchange_type not in EXCHANGE_TYPES:
+                raise _closed_by_broker(
+                    channel,
+                    503,
+                    f"COMMAND_INVALID - invalid exchange type '{exchange_type}'",
+                )
+            declared = self.exchanges.setdefault(exchange, exchange_type)
+            if declared != exchange_type:
+                raise _closed_by_broker(
+                    channel,
+                    406,
+                    f"PRECONDITION_FAILED - inequivalent arg 'type' for exchange "
+                    f"'{exchange}': received '{exchange_type}', current '{declared}'",
+                )
+
+    def declare_queue(
+        self, channel, name: str, passive: bool, durable: bool, auto_delete: bool
+    ) -> _Queue:
+        with self._lock:
+            if passive:
+                if name not in self.queues:
+                    raise _closed_by_broker(
+                        channel, 404, f"NOT_FOUND - no queue '{name}'"
+                    )
+                return self.queues[name]
+
+            name = name or f"amq.gen-{uuid.uuid4().hex}"
+            if name not in self.queues:
+                self.queues[name] = _Queue(name, durable, auto_delete)
+            return self.queues[name]
+
+    def bind(
+        self,
+        channel,
+        exchange: str,
+        queue_name: str,
+        routing_key: str,
+        arguments: Optional[Dict],
+    ) -> None:
+        with self._lock:
+            self._check(channel, exchange, queue_name)
+            binding = (queue_name, routing_key, arguments or {})
+            bindings = self.bindings.setdefault(exchange, [])
+            if binding not in bindings:
+                bindings.append(binding)
+
+    def unbind(
+        self,
+        channel,
+        exchange: str,
+        queue_name: str,
+        routing_key: str,
+        arguments: Optional[Dict],
+    ) -> None:
+        with self._lock:
+            self._check(channel, exchange, queue_name)
+            binding = (queue_name, routing_key, arguments or {})
+            if binding in self.bindings.get(exchange, []):
+                self.bindings[exchange].remove(binding)
+
+    def _check(self, channel, exchange: str, queue_name: str) -> None:
+        if exchange not in self.exchanges:
+            raise _closed_by_broker(
+                channel, 404, f"NOT_FOUND - no exchange '{exchange}'"
+            )
+        if queue_name not in self.queues:
+            raise _closed_by_broker(
+                channel, 404, f"NOT_FOUND - no queue '{queue_name}'"
+            )
+
+    def _route(self, exchange: str, routing_key: str, properties) -> List[str]:
+        exchange_type = self.exchanges[exchange]
+        if exchange == "":
+            # Default exchange: straight to the queue named as the routing key
+            return [routing_key] if routing_key in self.queues else []
+
+        routed = []
+        for queue_name, key, arguments in self.bindings.get(exchange, []):
+            if exchange_type == "fanout":
+                matched = True
+            elif exchange_type == "topic":
+                matched = topic_matches(key, routing_key)
+            elif exchange_type == "headers":
+                matched = _headers_match(arguments, properties.headers)
+            else:
+                matched = key == routing_key
+            if matched and queue_name not in routed:
+                routed.append(queue_name)
+        return routed
+
+    def publish(
+        self, channel, exchange: str, routing_key: str, body, properties
+    ) -> int:
+        """Routes the message to the bound queues. Number of queues it got to"""
+        with self._lock:
+            if exchange not in self.exchanges:
+                raise _closed_by_broker(
+                    channel, 404, f"NOT_FOUND - no exchange '{exchange}'"
+                )
+            routed = self._route(exchange, routing_key, properties)
+            for queue_name in routed:
+                q = self.queues[queue_name]
+                q.messages.append((exchange, routing_key, properties, body, False))
+                self._dispatch(q)
+        return len(routed)
+
+    def consume(self, channel, queue_name: str, consumer_tag: str, callback: Callable):
+        with self._lock:
+            if queue_name not in self.queues:
+                raise _closed_by_broker(
+                    channel, 404, f"NOT_FOUND - no queue '{queue_name}'"
+                )
+            q = self.queues[queue_name]
+            q.consumers.append((channel, consumer_tag, callback))
+            self._dispatch(q)
+
+    def cancel(self, channel, consumer_tag: Optional[str] = None) -> None:
+        """Removes the consumer(s) of a channel, deleting auto-delete queues
+        left without consumers
+        """
+        with self._lock:
+            for q in list(self.queues.values()):
+                had_consumers = bool(q.consumers)
+                q.consumers = [
+                    c
+                    for c in q.consumers
+                    if c[0] is not channel or consumer_tag not in (None, c[1])
+                ]
+                if q.auto_delete and had_consumers and not q.consumers:
+                    self._delete(q.name)
+
+    def _delete(self, queue_name: str) -> None:
+        del self.queues[queue_name]
+        for exchange, bindings in self.bindings.items():
+            self.bindings[exchange] = [b for b in bindings if b[0] != queue_name]
+
+    def requeue(self, queue_name: str, messages: List[Tuple]) -> None:
+        """Puts back (in their original order, marked as redelivered) the
+        messages of a queue that were nacked or left unacked
+        """
+        with self._lock:
+            q = self.queues.get(queue_name)
+            if q is None:
+                return
+            for exchange, routing_key, properties, body, _ in reversed(messages):
+                q.messages.appendleft((exchange, routing_key, properties, body, True))
+            self._dispatch(q)
+
+    def dispatch(self, queue_name: str) -> None:
+        with self._lock:
+            if queue_name in self.queues:
+                self._dispatch(self.queues[queue_name])
+
+    def _dispatch(self, q: _Queue) -> None:
+        """Hands the queued messages round robin to the consumers with room
+        in their prefetch window
+        """
+        while q.messages and q.consumers:
+            n = len(q.consumers)
+            for i in range(n):
+                channel, consumer_tag, callback = q.consumers[(q.next_consumer + i) % n]
+                if channel.has_capacity():
+                    q.next_consumer = (q.next_consumer + i + 1) % n
+                    channel._deliver(
+                        q.name, consumer_tag, callback, q.messages.popleft()
+                    )
+                    break
+            else:
+                return  # every consumer is full
+
+    def message_count(self, queue_name: str) -> int:
+        with self._lock:
+            return len(self.queues[queue_name].messages)
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_broker(uri: str = f"{MEMORY_SCHEME}://") -> MemoryBroker:
+    """Process wide broker of a 'memory://<name>' URI"""
+    name = uri.split("://", 1)[-1].strip("/")
+    with _brokers_lock:
+        if name not in _brokers:
+            logger.info(f"🐇 In-memory broker '{name}'")
+            _brokers[name] = MemoryBroker(name)
+        return _brokers[name]
+
+
+class _Timeout:
+    def __init__(
+        self, connection: "MemoryConnection", delay: float, callback: Callable
+    ):
+        self.cancelled = False
+        self._timer = threading.Timer(
+            delay, connection._post, args=(self._run(callback),)
+        )
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run(self, callback: Callable) -> Callable:
+        def run():
+            # Checked on the connection thread, where it's removed as well
+            if not self.cancelled:
+                callback()
+
+        return run
+
+    def cancel(self) -> None:
+        self.cancelled = True
+        self._timer.cancel()
+
+
+class MemoryConnection:
+    """Connection to a MemoryBroker, usable as a pika BlockingConnection or
+    (given an asyncio 'loop') as an AsyncioConnection
+    """
+
+    def __init__(
+        self,
+        uri: str = f"{MEMORY_SCHEME}://",
+        loop=None,
+        on_close_callback: Optional[Callable] = None,
+    ) -> None:
+        self.broker = get_broker(uri)
+        self._loop = loop
+        self._on_close_callback = on_close_callback
+        self._events = queue.SimpleQueue()  # callbacks to run (blocking mode)
+        self._channels = []
+        self._channel_numbers = itertools.count(1)
+        self.is_open = True
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    @property
+    def is_closing(self) -> bool:
+        return False
+
+    def _post(self, callback: Callable) -> None:
+        """Runs the callback on the connection thread"""
+        if self._loop is not None:
+            if not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(callback)
+        else:
+            self._events.put(callback)
+
+    def channel(self, on_open_callback: Optional[Callable] = None) -> "MemoryChannel":
+        channel = MemoryChannel(self, next(self._channel_numbers))
+        self._channels.append(channel)
+        if on_open_callback is not None:
+            self._post(functools.partial(on_open_callback, channel))
+        return channel
+
+    def process_data_events(self, time_limit: Optional[float] = 0) -> None:
+        """Runs the pending callbacks. When there are none waits up to
+        'time_limit' (forever if None) for some
+        """
+        try:
+            if time_limit == 0:
+                callback = self._events.get_nowait()
+            else:
+                callback = self._events.get(timeout=time_limit)
+        except queue.Empty:
+            return
+
+        while True:
+            callback()
+            try:
+                callback = self._events.get_nowait()
+            except queue.Empty:
+                return
+
+    def add_callback_threadsafe(self, callback: Callable) -> None:
+        self._post(callback)
+
+    def call_later(self, delay: float, callback: Callable) -> _Timeout:
+        return _Timeout(self, delay, callback)
+
+    def remove_timeout(self, timeout: _Timeout) -> None:
+        timeout.cancel()
+
+    def add_on_connection_blocked_callback(self, callback: Callable) -> None:
+        """There are no resource alarms to block publishers"""
+
+    def add_on_connection_unblocked_callback(self, callback: Callable) -> None:
+        """There are no resource alarms to block publishers"""
+
+    def close(self, reply_code: int = 200, reply_text: str = "Normal shutdown") -> None:
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError("Connection already closed")
+        reason = pika.exceptions.ConnectionClosedByClient(reply_code, reply_text)
+        for channel in list(self._channels):
+            if channel.is_open:
+                channel._closed(
+                    pika.exceptions.ChannelClosedByClient(reply_code, reply_text)
+                )
+        self.is_open = False
+        if self._on_close_callback is not None:
+            self._post(functools.partial(self._on_close_callback, self, reason))
+        self._post(lambda: None)  # wakes up 'start_consuming'
+
+
+class MemoryChannel:
+    """Channel of a MemoryConnection. Methods taking a 'callback' (as the
+    pika asynchronous channel does) get the reply frame through it, on the
+    connection thread; otherwise it's returned (as the BlockingChannel does)
+    """
+
+    def __init__(self, connection: MemoryConnection, channel_number: int) -> None:
+        self.connection = connection
+        self.channel_number = channel_number
+        self.is_open = True
+        self.prefetch_count = 0  # unlimited
+        self._broker = connection.broker
+        self._unacked = {}  # delivery tag -> (queue name, message)
+        self._delivery_tags = itertools.count(1)
+        self._consumer_tags = itertools.count(1)
+        self._consuming = False
+        self._on_close_callbacks = []
+        self._confirm_callback = None
+        self._publish_tags = itertools.count(1)
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    @property
+    def _impl(self) -> "MemoryChannel":
+        """Both the blocking and the underlying asynchronous channel"""
+        return self
+
+    def _reply(self, method, callback: Optional[Callable]) -> Method:
+        frame = Method(self.channel_number, method)
+        if callback is not None:
+            self.connection._post(functools.partial(callback, frame))
+        return frame
+
+    def _check_open(self) -> None:
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+
+    def add_on_close_callback(self, callback: Callable) -> None:
+        self._on_close_callbacks.append(callback)
+
+    def exchange_declare(
+        self,
+        exchange: str,
+        exchange_type: str = "direct",
+        durable: bool = False,
+        callback: Optional[Callable] = None,
+        **kwargs,
+    ) -> Method:
+        self._check_open()
+        self._broker.declare_exchange(self, exchange, exchange_type)
+        return self._reply(pika.spec.Exchange.DeclareOk(), callback)
+
+    def queue_declare(
+        self,
+        queue: str,
+        passive: bool = False,
+        durable: bool = False,
+        exclusive: bool = False,
+        auto_delete: bool = False,
+        callback: Optional[Callable] = None,
+        **kwargs,
+    ) -> Method:
+        self._check_open()
+        q = self._broker.declare_queue(self, queue, passive, durable, auto_delete)
+        method = pika.spec.Queue.DeclareOk(q.name, len(q.messages), len(q.consumers))
+        return self._reply(method, callback)
+
+    def queue_bind(
+        self,
+        queue: str,
+        exchange: str,
+        routing_key: Optional[str] = None,
+        arguments: Optional[Dict] = None,
+        callback: Optional[Callable] = None,
+    ) -> Method:
+        self._check_open()
+        self._broker.bind(self, exchange, queue, routing_key or queue, arguments)
+        return self._reply(pika.spec.Queue.BindOk(), callback)
+
+    def queue_unbind(
+        self,
+        queue: str,
+        exchange: Optional[str] = None,
+        routing_key: Optional[str] = None,
+        arguments: Optional[Dict] = None,
+        callback: Optional[Callable] = None,
+    ) -> Method:
+        self._check_open()
+        self._broker.unbind(self, exchange, queue, routing_key or queue, arguments)
+        return self._reply(pika.spec.Queue.UnbindOk(), callback)
+
+    def basic_qos(
+        self, prefetch_count: int = 0, callback: Optional[Callable] = None, **kwargs
+    ) -> Method:
+        self._check_open()
+        self.prefetch_count = prefetch_count
+        return self._reply(pika.spec.Basic.QosOk(), callback)
+
+    def confirm_delivery(
+        self,
+        ack_nack_callback: Optional[Callable] = None,
+        callback: Optional[Callable] = None,
+    ) -> Method:
+        """Messages are confirmed once routed (i.e. right away)"""
+        self._check_open()
+        self._confirm_callback = ack_nack_callback
+        self._publish_tags = itertools.count(1)
+        return self._reply(pika.spec.Confirm.SelectOk(), callback)
+
+    def basic_publish(
+        self,
+        exchange: str,
+        routing_key: str,
+        body,
+        properties: Optional[pika.BasicProperties] = None,
+        mandatory: bool = False,
+    ) -> None:
+        self._check_open()
+        if isinstance(body, str):
+            body = body.encode()
+        properties = properties or pika.BasicProperties()
+        self._broker.publish(self, exchange, routing_key or "", body, properties)
+        if self._confirm_callback is not None:
+            self._reply(
+                pika.spec.Basic.Ack(delivery_tag=next(self._publish_tags)),
+                self._confirm_callback,
+            )
+
+    def basic_consume(
+        self,
+        queue: str,
+        on_message_callback: Callable,
+        auto_ack: bool = False,
+        consumer_tag: Optional[str] = None,
+        **kwargs,
+    ) -> str:
+        self._check_open()
+        if auto_ack:
+            raise ValueError("auto_ack isn't supported by the in-memory broker")
+        consumer_tag = (
+            consumer_tag or f"ctag{self.channel_number}.{next(self._consumer_tags)}"
+        )
+        self._broker.consume(self, queue, consumer_tag, on_message_callback)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag: str, callback: Optional[Callable] = None):
+        self._broker.cancel(self, consumer_tag)
+        return self._reply(pika.spec.Basic.CancelOk(consumer_tag), callback)
+
+    def has_capacity(self) -> bool:
+        return self.is_open and (
+            not self.prefetch_count or len(self._unacked) < self.prefetch_count
+        )
+
+    def _deliver(self, queue_name: str, consumer_tag: str, callback: Callable, message):
+        """Called by the broker (under its lock) to hand a message over"""
+        exchange, routing_key, properties, body, redelivered = message
+        delivery_tag = next(self._delivery_tags)
+        self._unacked[delivery_tag] = (queue_name, message)
+        method = pika.spec.Basic.Deliver(
+            consumer_tag, delivery_tag, redelivered, exchange, routing_key
+        )
+
+        def deliver():
+            if self.is_open:
+                callback(self, method, properties, body)
+
+        self.connection._post(deliver)
+
+    def _settle(self, delivery_tag: int, multiple: bool) -> List[Tuple[str, Tuple]]:
+        self._check_open()
+        with self._broker._lock:
+            if multiple:
+                tags = [t for t in self._unacked if t <= delivery_tag]
+            elif delivery_tag in self._unacked:
+                tags = [delivery_tag]
+            else:
+                raise _closed_by_broker(
+                    self,
+                    406,
+                    f"PRECONDITION_FAILED - unknown delivery tag {delivery_tag}",
+                )
+            return [self._unacked.pop(t) for t in tags]
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False) -> None:
+        for queue_name in {
+            queue_name for queue_name, _ in self._settle(delivery_tag, multiple)
+        }:
+            self._broker.dispatch(queue_name)
+
+    def basic_nack(
+        self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True
+    ) -> None:
+        self._requeue(self._settle(delivery_tag, multiple), requeue)
+
+    def basic_reject(self, delivery_tag: int = 0, requeue: bool = True) -> None:
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def _requeue(self, settled: List[Tuple[str, Tuple]], requeue: bool = True) -> None:
+        by_queue = {}
+        for queue_name, message in settled:
+            by_queue.setdefault(queue_name, []).append(message)
+        for queue_name, messages in by_queue.items():
+            if requeue:
+                self._broker.requeue(queue_name, messages)
+            else:
+                self._broker.dispatch(queue_name)
+
+    def start_consuming(self) -> None:
+        """Handles deliveries until 'stop_consuming' or the channel closes"""
+        self._consuming = True
+        while self._consuming and self.is_open:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self) -> None:
+        self._consuming = False
+        self.connection._post(lambda: None)
+
+    def _closed(self, reason: Exception) -> None:
+        """Closes the channel: its unacked messages are redelivered"""
+        with self._broker._lock:
+            if not self.is_open:
+                return
+            self.is_open = False
+            self._broker.cancel(self)
+            unacked = list(self._unacked.values())
+            self._unacked.clear()
+            self._requeue(unacked)
+        for callback in self._on_close_callbacks:
+            self.connection._post(functools.partial(callback, self, reason))
+
+    def close(self, reply_code: int = 200, reply_text: str = "Normal shutdown") -> None:
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+        self._closed(pika.exceptions.ChannelClosedByClient(reply_code, reply_text))
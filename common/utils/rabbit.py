@@ -1,15 +1,28 @@
+import asyncio
+import functools
+import json
 import logging
+import multiprocessing
 import os
+import threading
 import time
-from typing import Callable, List, Optional, Tuple
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime as dt, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
 from pika.adapters.blocking_connection import BlockingChannel
+from pika.channel import Channel
 
 from common.utils.io import init_logger
+from common.utils.memory_broker import is_memory_uri, MemoryConnection
 from raspvan.constants import (
+    DEFAULT_RABBITMQ_CODEC,
     DEFAULT_RABBITMQ_HOST,
     DEFAULT_RABBITMQ_PORT,
+    RABBITMQ_CODEC_ENV_VAR,
     RABBITMQ_HOST_ENV_VAR,
     RABBITMQ_PORT_ENV_VAR,
 )
@@ -29,10 +42,11 @@ def get_amqp_uri_from_env():
 
     rabbit_port = os.getenv(RABBITMQ_PORT_ENV_VAR)
     if rabbit_port is None:
-        logger.warning(
-            f"🐇 env.var '{RABBITMQ_PORT_ENV_VAR}' not set. "
-            f"Defaulting to: '{DEFAULT_RABBITMQ_PORT}'"
-        )
+        if not is_memory_uri(rabbit_host):
+            logger.warning(
+                f"🐇 env.var '{RABBITMQ_PORT_ENV_VAR}' not set. "
+                f"Defaulting to: '{DEFAULT_RABBITMQ_PORT}'"
+            )
         rabbit_port = DEFAULT_RABBITMQ_PORT
 
     return rabbit_host, int(rabbit_port)
@@ -42,16 +56,124 @@ def get_q_count(channel, q_name):
     return channel.queue_declare(queue=q_name, passive=True).method.message_count
 
 
-def wait_on_q_limit(channel: BlockingChannel, q_name: str, lim: int, sleep: int = 10):
-    msg_in_q = get_q_count(channel, q_name)
-    logger.info(f"🐇 Found {msg_in_q} messages in the queue ({q_name})...")
-    while msg_in_q > lim:
-        logger.debug(f"🐇 Waiting... ({msg_in_q} remaining)")
-        time.sleep(sleep)
-        msg_in_q = get_q_count(channel, q_name)
+# =============== Codecs ================
+
+CODECS = ["json", "orjson", "msgpack"]
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+EVENT_SCHEMA_VERSION = 1
+SCHEMA_HEADER = "x-schema-version"
+
+
+class Codec:
+    """Encoding of the queue payloads. Messages are published with its
+    content type (and the event schema version) so consumers pick the
+    decoder on their own
+    """
+
+    def __init__(
+        self, name: str, content_type: str, dumps: Callable, loads: Callable
+    ) -> None:
+        self.name = name
+        self.content_type = content_type
+        self.dumps = dumps
+        self.loads = loads
+        self.properties = pika.BasicProperties(
+            delivery_mode=2,  # make message persistent
+            content_type=content_type,
+            headers={SCHEMA_HEADER: EVENT_SCHEMA_VERSION},
+        )
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+
+def _load_codec(name: str) -> Codec:
+    if name == "json":
+        return Codec(name, JSON_CONTENT_TYPE, _json_dumps, json.loads)
+    if name == "orjson":
+        import orjson
+
+        return Codec(name, JSON_CONTENT_TYPE, orjson.dumps, orjson.loads)
+    if name == "msgpack":
+        import msgpack
+
+        return Codec(name, MSGPACK_CONTENT_TYPE, msgpack.packb, msgpack.unpackb)
+
+    raise ValueError(f"Invalid codec: '{name}'. Must be one of: {CODECS}")
+
+
+@functools.lru_cache()
+def get_codec(name: Optional[str] = None) -> Codec:
+    """Codec by name, from the environment by default"""
+    return _load_codec(
+        name or os.getenv(RABBITMQ_CODEC_ENV_VAR, DEFAULT_RABBITMQ_CODEC)
+    )
+
+
+@functools.lru_cache()
+def get_decoder(content_type: Optional[str]) -> Optional[Callable]:
+    """Decoder of a content type (None if unknown). JSON is decoded with
+    orjson when installed, whatever encoded it
+    """
+    if content_type == JSON_CONTENT_TYPE:
+        try:
+            return _load_codec("orjson").loads
+        except ImportError:
+            return json.loads
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return _load_codec("msgpack").loads
+
+    return None
+
+
+def make_event(status: str, timestamp: Optional[str] = None, **fields) -> Dict:
+    """Queue event of the current schema: version, status, ISO timestamp
+    (now, in UTC, by default) and any other fields
+    """
+    return {
+        "v": EVENT_SCHEMA_VERSION,
+        "status": status,
+        "timestamp": timestamp or dt.now(timezone.utc).isoformat(),
+        **fields,
+    }
+
+
+def _encode(codec: Codec, message: Any) -> Tuple[Any, pika.BasicProperties]:
+    """Body and properties of a message. Already encoded messages (bytes or
+    str) are published as they are, without a content type
+    """
+    if isinstance(message, (bytes, str)):
+        return message, BlockingQueuePublisher.PROPERTIES
+    return codec.dumps(message), codec.properties
+
+
+def _get_loader(properties, load_func: Optional[Callable]) -> Callable:
+    """Decoder of a delivery by its content type. 'load_func' decodes the
+    messages without one (e.g. from older publishers)
+    """
+    content_type = getattr(properties, "content_type", None)
+    headers = getattr(properties, "headers", None) or {}
+    if headers.get(SCHEMA_HEADER, 0) > EVENT_SCHEMA_VERSION:
+        logger.warning(
+            f"🐇 Event schema v{headers[SCHEMA_HEADER]} is newer than the "
+            f"supported one (v{EVENT_SCHEMA_VERSION})"
+        )
+
+    decoder = get_decoder(content_type)
+    if decoder is not None:
+        return decoder
+    if load_func is None:
+        raise ValueError(f"No decoder for content type: '{content_type}'")
+    return load_func
 
 
 class BaseQueueClient:
+    """A 'memory://' host (see 'common.utils.memory_broker') connects to an
+    in-process broker instead of RabbitMQ
+    """
+
     VALID_EXCHANGE_TYPES = ["fanout", "topic", "headers"]
     DEFAULT_TCP_KEEPIDLE = 60 * 5  # 5 minutes
 
@@ -82,8 +204,8 @@ class BaseQueueClient:
                 f"Invalid exchange type: '{self.exchange_type}'. "
                 f"Must be one of: {self.VALID_EXCHANGE_TYPES}"
             )
-        if self.q_lim > 0 and self.exchange_name:
-            logger.warning("🐇 Queue limit will be ignored when sending to an exchange")
+        if self.q_lim > 0 and not self.queue_name:
+            logger.warning("🐇 Queue limit will be ignored without a queue name")
 
         logger.info(
             f"🐇 @ {self.host}:{self.port} "
@@ -126,27 +248,71 @@ class BaseQueueClient:
             durable=durable,
         )
 
-    def connect(
+    def _parameters(
         self, tcp_keepidle: Optional[int] = None
-    ) -> Tuple[pika.BlockingConnection, BlockingChannel]:
+    ) -> pika.ConnectionParameters:
         tcp_options = {"TCP_KEEPIDLE": tcp_keepidle or self.DEFAULT_TCP_KEEPIDLE}
-        connection = pika.BlockingConnection(
-            # for connection no to die while blocked waiting for inputs
-            # we must set the heartbeat to 0 (although is discouraged)
-            pika.ConnectionParameters(
-                self.host,
-                self.port,
-                blocked_connection_timeout=self._timeout,
-                heartbeat=0,
-                tcp_options=tcp_options,
-            )
+        # for connection no to die while blocked waiting for inputs
+        # we must set the heartbeat to 0 (although is discouraged)
+        return pika.ConnectionParameters(
+            self.host,
+            self.port,
+            blocked_connection_timeout=self._timeout,
+            heartbeat=0,
+            tcp_options=tcp_options,
         )
+
+    def connect(
+        self, tcp_keepidle: Optional[int] = None
+    ) -> Tuple[pika.BlockingConnection, BlockingChannel]:
+        if is_memory_uri(self.host):
+            connection = MemoryConnection(self.host)
+            return connection, connection.channel()
+
+        connection = pika.BlockingConnection(self._parameters(tcp_keepidle))
         channel = connection.channel()
 
         return connection, channel
 
 
 class BlockingQueuePublisher(BaseQueueClient):
+    """Publisher keeping a single long-lived connection to the broker.
+
+    The exchange / queue are declared once per connection. When the
+    connection dies, messages are kept in a bounded outbox (dropping the
+    oldest ones when full) and the publisher reconnects on the next send,
+    backing off exponentially between failed attempts. The outbox is
+    flushed, in order, before publishing new messages.
+
+    With 'confirm' the channel is put in publisher confirms mode without
+    waiting for each confirm: messages are pipelined and tracked by delivery
+    tag until the broker (asynchronously) acks them. Up to 'max_unconfirmed'
+    messages can be in flight; unconfirmed messages of a dead connection and
+    nacked ones are queued again (i.e. at least once delivery).
+
+    Messages other than bytes / str (e.g. lists of events, see 'make_event')
+    are encoded with the 'codec' ('RABBITMQ_CODEC' env. var. by default).
+
+    With a 'q_lim' (and a 'queue_name') publishing blocks while the queue
+    holds 'q_lim' messages. The publisher keeps a credit window: the queue
+    depth is only asked to the broker once the messages published since the
+    last check could have filled the queue. While blocked, the depth is
+    re-checked with a growing interval (from 1ms), handling the connection
+    I/O in between. Time blocked on the queue limit or by the broker
+    (connection.blocked, e.g. memory alarms) is accounted in the stats.
+    """
+
+    OUTBOX_SIZE = 100
+    RECONNECT_DELAY_S = 0.5
+    MAX_RECONNECT_DELAY_S = 30.0
+    LATENCY_WINDOW = 100  # latest publish latencies kept for the stats
+    MAX_UNCONFIRMED = 1000
+    CONFIRM_TIMEOUT_S = 10.0
+    CONFIRM_POLL_S = 0.01
+    PROPERTIES = pika.BasicProperties(delivery_mode=2)  # make message persistent
+    MIN_CREDIT_POLL_S = 0.001
+    MAX_CREDIT_POLL_S = 0.1
+
     def __init__(
         self,
         host: Optional[str] = None,
@@ -154,6 +320,10 @@ class BlockingQueuePublisher(BaseQueueClient):
         queue_name: Optional[str] = None,
         exchange_name: Optional[str] = None,
         exchange_type: Optional[str] = None,
+        outbox_size: Optional[int] = None,
+        confirm: bool = False,
+        max_unconfirmed: Optional[int] = None,
+        codec: Optional[str] = None,
         *args,
         **kwargs,
     ):
@@ -161,45 +331,406 @@ class BlockingQueuePublisher(BaseQueueClient):
         self.queue_name = queue_name
         self.exchange_name = exchange_name or ""
         self.exchange_type = exchange_type
+        self.codec = get_codec(codec)
+        self.confirm = confirm
+        self.max_unconfirmed = max_unconfirmed or self.MAX_UNCONFIRMED
 
-    def send_message(self, message, topic: Optional[str] = None):
-        connection, channel = self.connect()
-        if self.exchange_name and self.exchange_type:
-            self.declare_exchange(
-                channel, self.exchange_name, self.exchange_type, durable=True
+        self.outbox = deque(maxlen=outbox_size or self.OUTBOX_SIZE)
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.throughput = None  # msg/s of the last 'publish_many'
+        self.latencies = deque(maxlen=self.LATENCY_WINDOW)
+        self._unconfirmed = OrderedDict()  # delivery tag -> (message, topic)
+        self._delivery_tag = 0
+        self._credit = 0  # messages that can be published before re-checking
+        self.blocked = {"count": 0, "total_s": 0.0, "max_s": 0.0}
+        self._broker_blocked_at = None
+        self._connection = None
+        self._channel = None
+        self._n_failures = 0
+        self._next_attempt = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return (
+            self._connection is not None
+            and self._connection.is_open
+            and self._channel.is_open
+        )
+
+    @property
+    def stats(self) -> Dict:
+        latencies = sorted(self.latencies)
+        stats = {
+            "published": self.published,
+            "queued": len(self.outbox),
+            "dropped": self.dropped,
+            "reconnects": self.reconnects,
+        }
+        if self.confirm:
+            stats["confirmed"] = self.confirmed
+            stats["nacked"] = self.nacked
+            stats["unconfirmed"] = len(self._unconfirmed)
+        if self.blocked["count"]:
+            stats["blocked"] = {
+                "count": self.blocked["count"],
+                "total_s": round(self.blocked["total_s"], 3),
+                "max_ms": round(1000 * self.blocked["max_s"], 1),
+            }
+        if self.throughput is not None:
+            stats["throughput_msg_s"] = round(self.throughput, 1)
+        if latencies:
+            stats["latency_ms"] = {
+                "p50": round(1000 * latencies[len(latencies) // 2], 2),
+                "p95": round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 2),
+                "max": round(1000 * latencies[-1], 2),
+            }
+        return stats
+
+    def _open(self) -> bool:
+        """(Re)connects and declares the exchange / queue unless still backing
+        off from a previous failed attempt
+        """
+        if time.monotonic() < self._next_attempt:
+            return False
+
+        self._reset()
+        try:
+            self._connection, self._channel = self.connect()
+            if self.exchange_name and self.exchange_type:
+                self.declare_exchange(
+                    self._channel, self.exchange_name, self.exchange_type, durable=True
+                )
+            if self.queue_name:
+                # If a queue_name is given but doesn't exist, will fail
+                self.declare_queue(self._channel, self.queue_name, passive=True)
+            if self.confirm:
+                self._confirm_delivery()
+            self._connection.add_on_connection_blocked_callback(self._on_blocked)
+            self._connection.add_on_connection_unblocked_callback(self._on_unblocked)
+        except pika.exceptions.AMQPError as e:
+            self._failed(e)
+            return False
+
+        if self._n_failures:
+            self.reconnects += 1
+            logger.info(f"🐇 Reconnected after {self._n_failures} failed attempt(s)")
+        self._n_failures = 0
+        self._credit = 0
+        return True
+
+    def _track_blocked(self, blocked_s: float) -> None:
+        self.blocked["count"] += 1
+        self.blocked["total_s"] += blocked_s
+        self.blocked["max_s"] = max(self.blocked["max_s"], blocked_s)
+
+    def _on_blocked(self, _connection, method_frame) -> None:
+        reason = method_frame.method.reason
+        logger.warning(f"🐇 Publishing blocked by the broker ({reason})")
+        self._broker_blocked_at = time.monotonic()
+
+    def _on_unblocked(self, _connection, _method_frame) -> None:
+        if self._broker_blocked_at is not None:
+            blocked_s = time.monotonic() - self._broker_blocked_at
+            self._track_blocked(blocked_s)
+            logger.info(f"🐇 Publishing unblocked after {blocked_s:.1f}s")
+        self._broker_blocked_at = None
+
+    def _wait_for_credit(self) -> None:
+        """Blocks until the queue is below 'q_lim' messages"""
+        if self._credit > 0:
+            return
+
+        self._credit = self.q_lim - get_q_count(self._channel, self.queue_name)
+        if self._credit > 0:
+            return
+
+        start = time.monotonic()
+        poll_s = self.MIN_CREDIT_POLL_S
+        logger.debug(f"🐇 Queue '{self.queue_name}' full ({self.q_lim}), waiting...")
+        while self._credit <= 0:
+            # Sleeps handling the I/O meanwhile (e.g. confirms)
+            self._connection.process_data_events(time_limit=poll_s)
+            poll_s = min(2 * poll_s, self.MAX_CREDIT_POLL_S)
+            self._credit = self.q_lim - get_q_count(self._channel, self.queue_name)
+
+        self._track_blocked(time.monotonic() - start)
+
+    def _confirm_delivery(self) -> None:
+        """Publisher confirms on the underlying (asynchronous) channel.
+
+        'BlockingChannel.confirm_delivery' makes every 'basic_publish' wait
+        for its Basic.Ack (raising NackError / UnroutableError), i.e. a round
+        trip per message, and pika has no public way to get the confirms
+        asynchronously on a BlockingConnection. The '_impl' channel takes an
+        'ack_nack_callback' instead, called while handling the connection I/O
+        ('process_data_events'), so messages are pipelined and confirmed by
+        delivery tag. Unroutable messages are confirmed by the broker too (no
+        'mandatory' flag) and nacked ones are published again.
+        """
+        selected = []
+        self._channel._impl.confirm_delivery(
+            ack_nack_callback=self._on_confirm,
+            callback=lambda _frame: selected.append(True),
+        )
+        deadline = time.monotonic() + self.CONFIRM_TIMEOUT_S
+        while not selected:
+            if time.monotonic() > deadline:
+                raise pika.exceptions.AMQPChannelError("Confirm.Select timed out")
+            self._connection.process_data_events(time_limit=self.CONFIRM_POLL_S)
+
+        self._delivery_tag = 0
+
+    def _on_confirm(self, frame) -> None:
+        """Basic.Ack / Basic.Nack of one or (if 'multiple') all messages up to
+        the delivery tag
+        """
+        method = frame.method
+        if method.multiple:
+            tags = [t for t in self._unconfirmed if t <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        for tag in tags:
+            item = self._unconfirmed.pop(tag, None)
+            if item is None:
+                continue
+            if acked:
+                self.confirmed += 1
+            else:
+                self.nacked += 1
+                self._enqueue(*item)
+
+        if not acked:
+            logger.warning(f"🐇 Broker nacked {len(tags)} message(s), queued again")
+
+    def _wait_confirms(self, max_unconfirmed: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while len(self._unconfirmed) > max_unconfirmed:
+            if time.monotonic() > deadline:
+                return False
+            self._connection.process_data_events(time_limit=self.CONFIRM_POLL_S)
+
+        return True
+
+    def wait_for_confirms(self, timeout: Optional[float] = None) -> bool:
+        """Waits until every published message is confirmed by the broker.
+        True if they all were acked (nacked ones are queued again)
+        """
+        with self._lock:
+            if not self.confirm or not self.connected:
+                return not self._unconfirmed and not self.outbox
+            try:
+                timeout = timeout or self.CONFIRM_TIMEOUT_S
+                return self._wait_confirms(0, timeout) and not self.outbox
+            except pika.exceptions.AMQPError as e:
+                self._failed(e)
+                return False
+
+    def _failed(self, error: Exception) -> None:
+        self._reset()
+        if self._unconfirmed:
+            # Their fate is unknown: published again, before the queued ones
+            # (dropping the oldest messages if they don't fit)
+            pending = [*self._unconfirmed.values(), *self.outbox]
+            overflow = max(len(pending) - self.outbox.maxlen, 0)
+            if overflow:
+                self.dropped += overflow
+                logger.warning(
+                    f"🐇 Outbox full, dropping the {overflow} oldest messages"
+                )
+            self.outbox.clear()
+            self.outbox.extend(pending[overflow:])
+            self._unconfirmed.clear()
+        # A stale connection is retried right away, then backing off
+        delay = 0.0
+        if self._n_failures:
+            delay = min(
+                self.RECONNECT_DELAY_S * 2 ** (self._n_failures - 1),
+                self.MAX_RECONNECT_DELAY_S,
             )
+        self._n_failures += 1
+        self._next_attempt = time.monotonic() + delay
+        logger.warning(
+            f"🐇 Connection to {self.host}:{self.port} lost ({error!r}). "
+            f"Retrying in {delay:.1f}s ({len(self.outbox)} messages queued)"
+        )
 
-        if self.queue_name:
-            # If a queue_name is given but doesn't exist, will fail
-            self.declare_queue(channel, self.queue_name, passive=True)
+    def _reset(self) -> None:
+        if self._connection is not None and self._connection.is_open:
+            try:
+                self._connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+        self._connection, self._channel = None, None
 
-            if self.q_lim > 0:
-                wait_on_q_limit(channel, self.queue_name, lim=self.q_lim)
+    def _enqueue(self, message, topic: Optional[str]) -> None:
+        if len(self.outbox) == self.outbox.maxlen:
+            self.dropped += 1
+            logger.warning(
+                f"🐇 Outbox full, dropping the oldest message ({self.dropped})"
+            )
+        self.outbox.append((message, topic))
+
+    def _publish(self, message, topic: Optional[str]) -> None:
+        if self.queue_name and self.q_lim > 0:
+            self._wait_for_credit()
+        if self.confirm and len(self._unconfirmed) >= self.max_unconfirmed:
+            # Half the window at a time, so publishing keeps pipelined. Waits
+            # before publishing: a message failing here is only in the outbox
+            timeout = self.CONFIRM_TIMEOUT_S
+            if not self._wait_confirms(self.max_unconfirmed // 2, timeout):
+                raise pika.exceptions.AMQPChannelError("Confirms timed out")
 
         logger.debug(
             f"Publishing to: {self.exchange_name} | q:{self.queue_name} (topic:{topic})"
         )
-        channel.basic_publish(
+        body, properties = _encode(self.codec, message)
+        start = time.perf_counter()
+        self._channel.basic_publish(
             exchange=self.exchange_name,
             routing_key=topic,
-            body=message,
-            properties=pika.BasicProperties(
-                delivery_mode=2,
-            ),  # make message persistent
+            body=body,
+            properties=properties,
         )
+        self.latencies.append(time.perf_counter() - start)
+        self.published += 1
+        self._credit -= 1
+        if self.confirm:
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = (message, topic)
 
-        connection.close()
-        logger.debug("🐇🍻 Sent!")
+    def _publish_outbox(self) -> None:
+        while self.outbox:
+            # Only dequeued once published (i.e. at least once delivery)
+            self._publish(*self.outbox[0])
+            self.outbox.popleft()
+
+    def flush(self) -> bool:
+        """Publishes the queued messages. True if the outbox got emptied"""
+        with self._lock:
+            return self._flush()
+
+    def _flush(self, pending: Iterable[Tuple] = ()) -> bool:
+        """Publishes the queued and then the 'pending' (message, topic) items.
+        Whatever can't be published ends up in the outbox
+        """
+        pending = iter(pending)
+        for _ in range(2):
+            if not self.connected and not self._open():
+                break
+            try:
+                self._publish_outbox()
+                for item in pending:
+                    # Through the (then empty) outbox, so it's kept if it fails
+                    self.outbox.append(item)
+                    self._publish_outbox()
+                if self.confirm:
+                    # Handle the confirms received so far (doesn't block)
+                    self._connection.process_data_events(time_limit=0)
+            except pika.exceptions.AMQPError as e:
+                self._failed(e)
+            else:
+                break
+
+        for item in pending:
+            self._enqueue(*item)
+
+        return not self.outbox
+
+    def send_message(self, message, topic: Optional[str] = None) -> bool:
+        """Publishes the message (after any previously queued ones). If the
+        broker isn't reachable the message is queued and False returned
+        """
+        with self._lock:
+            sent = self._flush([(message, topic)])
+
+        if sent:
+            logger.debug("🐇🍻 Sent!")
+        return sent
+
+    def publish_many(
+        self, messages: Iterable, topic: Optional[str] = None, wait: bool = False
+    ) -> bool:
+        """Publishes a batch of messages back to back on the channel (with
+        'confirm', without waiting for the confirms unless 'wait').
+        Same return value as 'send_message'
+        """
+        start = time.perf_counter()
+        published = self.published
+        with self._lock:
+            sent = self._flush((message, topic) for message in messages)
+
+        if sent and wait:
+            sent = self.wait_for_confirms()
+
+        elapsed = time.perf_counter() - start
+        n_messages = self.published - published
+        if elapsed > 0:
+            self.throughput = n_messages / elapsed
+            logger.debug(
+                f"🐇🍻 {n_messages} messages in {elapsed * 1000:.1f}ms "
+                f"({self.throughput:.0f} msg/s)"
+            )
+        return sent
+
+    def close(self) -> None:
+        with self._lock:
+            if self.confirm and self.connected:
+                try:
+                    self._wait_confirms(0, self.CONFIRM_TIMEOUT_S)
+                except pika.exceptions.AMQPError as e:
+                    self._failed(e)
+            if self.outbox and not self._flush():
+                logger.warning(f"🐇 Closing with {len(self.outbox)} unsent messages")
+            logger.info(f"🐇 Closing publisher connection ({self.stats})")
+            self._reset()
+
+
+def _handle_message(load_func: Callable, on_event: Callable, body) -> List:
+    """'on_event' results for each event of a message (runs in the pool)"""
+    return [on_event(event) for event in load_func(body)]
 
 
 class BlockingQueueConsumer(BaseQueueClient):
+    """Consumes messages (encoded lists of events) calling 'on_event' for
+    each event and 'on_done' once the message is processed. The message is
+    acked no matter what. 'on_result' (if given) gets every non None result
+    of 'on_event'. Messages are decoded according to their content type,
+    or with 'load_func' if they have none.
+
+    By default messages are processed one at a time on the connection
+    thread. With 'workers' they are processed concurrently in a pool of
+    threads (or forked processes, so the handlers must be picklable and can
+    use any state loaded before consuming). Up to 'max_in_flight' messages
+    (the prefetch count, 2 per worker by default) are handled at a time.
+    Messages with the same 'order_key(method, properties, body)' (if not
+    None) are processed one after the other, in delivery order. Acks,
+    'on_result' and 'on_done' always run on the connection thread.
+
+    With 'on_batch' the events of the deliveries received within 'batch_ms'
+    (up to 'batch_size' events) are handed at once to 'on_batch', on the
+    connection thread, which returns a result per event. Messages with an
+    event whose result is an exception are nacked, the rest acked as usual.
+    If 'on_batch' raises, the messages of the batch are handed to it again
+    one at a time, so only the failing ones are nacked (the others might be
+    handled twice).
+    """
+
     PREFETCH_COUNT = 10
+    BATCH_SIZE = 16
+    BATCH_MS = 50
 
     def __init__(
         self,
         on_event: Callable,
         on_done: Callable,
-        load_func: Callable,
+        load_func: Optional[Callable],
         queue_name: Optional[str] = None,
         exchange_name: Optional[str] = None,
         exchange_type: Optional[str] = None,
@@ -207,6 +738,14 @@ class BlockingQueueConsumer(BaseQueueClient):
         prefetch_count: Optional[int] = None,
         host: Optional[str] = None,
         port: Optional[int] = None,
+        workers: int = 0,
+        processes: bool = False,
+        max_in_flight: Optional[int] = None,
+        order_key: Optional[Callable] = None,
+        on_result: Optional[Callable] = None,
+        on_batch: Optional[Callable] = None,
+        batch_size: Optional[int] = None,
+        batch_ms: Optional[float] = None,
         *args,
         **kwargs,
     ):
@@ -226,6 +765,25 @@ class BlockingQueueConsumer(BaseQueueClient):
         self.exchange_type = exchange_type
 
         self._prefetch_count = prefetch_count or self.PREFETCH_COUNT
+        self._on_result = on_result
+        self._workers = workers
+        self._processes = processes
+        self._order_key = order_key
+        self._pool = None
+        self._keyed = {}  # order key -> deliveries waiting for the previous one
+        self.in_flight = 0
+        if workers:
+            self._prefetch_count = max_in_flight or 2 * workers
+
+        self._on_batch = on_batch
+        self._batch_size = batch_size or self.BATCH_SIZE
+        self._batch_ms = batch_ms or self.BATCH_MS
+        self._batch = []  # (delivery tag, events) of the deliveries so far
+        self._batch_events = 0
+        self._batch_timer = None
+        if on_batch is not None:
+            # Enough deliveries to fill a batch
+            self._prefetch_count = max(self._prefetch_count, self._batch_size)
 
         self._validate_params()
         self._connection, self._channel = self.connect()
@@ -255,21 +813,171 @@ class BlockingQueueConsumer(BaseQueueClient):
         """Assumes a 'body' is an encoded list of data. For each element
         the 'on_event' function is called to process the messages
         """
+        if self._on_batch is not None:
+            self._add_to_batch(method.delivery_tag, properties, body)
+            return
+
+        if self._pool is None:
+            try:
+                load_func = _get_loader(properties, self._load_func)
+                results = _handle_message(load_func, self._on_event, body)
+            except Exception:
+                logger.exception("🐇 Error in queue callback")
+                results = None
+            self._finish(method.delivery_tag, results)
+            return
+
+        key = None
+        if self._order_key is not None:
+            key = self._order_key(method, properties, body)
+        if key is not None:
+            if key in self._keyed:
+                # Waits for the previous message with the same key
+                self._keyed[key].append((method.delivery_tag, properties, body))
+                return
+            self._keyed[key] = deque()
+
+        self._submit(method.delivery_tag, properties, body, key)
+
+    def _submit(self, delivery_tag: int, properties, body, key) -> None:
+        self.in_flight += 1
         try:
-            rx_data = self._load_func(body)
-            for event in rx_data:
-                self._on_event(event)
-        except Exception as e:
-            logger.exception(f"🐇 Error in queue callback: {e}")
+            load_func = _get_loader(properties, self._load_func)
+        except (ImportError, ValueError) as e:
+            # No decoder for the message
+            future = Future()
+            future.set_exception(e)
         else:
+            future = self._pool.submit(_handle_message, load_func, self._on_event, body)
+        future.add_done_callback(
+            lambda f: self._connection.add_callback_threadsafe(
+                functools.partial(self._processed, delivery_tag, key, f)
+            )
+        )
+
+    def _processed(self, delivery_tag: int, key, future: Future) -> None:
+        """Pool completion, back on the connection thread"""
+        self.in_flight -= 1
+        error = future.exception()
+        if error is not None:
+            logger.error("🐇 Error in queue callback", exc_info=error)
+        self._finish(delivery_tag, None if error else future.result())
+        if key is not None:
+            waiting = self._keyed[key]
+            if waiting:
+                self._submit(*waiting.popleft(), key)
+            else:
+                del self._keyed[key]
+
+    def _finish(self, delivery_tag: int, results: Optional[List] = None) -> None:
+        """Acks the message. No 'results' if handling it failed (and got logged)"""
+        try:
+            if results is None:
+                return
+            if self._on_result is not None:
+                for result in results:
+                    if result is not None:
+                        self._on_result(result)
             # Notify Inference Server via endpoint
             self._on_done()
+        except Exception:
+            logger.exception("🐇 Error in queue callback")
         finally:
             # Send basic acknowledge back (no matter what)
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+            self._channel.basic_ack(delivery_tag=delivery_tag)
             logger.debug("🐇 Done!")
 
+    def _add_to_batch(self, delivery_tag: int, properties, body) -> None:
+        try:
+            events = list(_get_loader(properties, self._load_func)(body))
+        except Exception:
+            logger.exception(f"🐇 Can't decode message {delivery_tag}")
+            self._channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            return
+
+        self._batch.append((delivery_tag, events))
+        self._batch_events += len(events)
+        if self._batch_events >= self._batch_size:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = self._connection.call_later(
+                self._batch_ms / 1000, self._batch_timeout
+            )
+
+    def _batch_timeout(self) -> None:
+        self._batch_timer = None
+        self._flush_batch()
+
+    def _flush_batch(self) -> None:
+        if self._batch_timer is not None:
+            self._connection.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+
+        batch, self._batch, self._batch_events = self._batch, [], 0
+        events = [event for _, message_events in batch for event in message_events]
+        try:
+            results = self._run_batch(events)
+        except Exception as e:
+            logger.exception("🐇 Error in batch callback")
+            if len(batch) == 1:
+                results = [e] * len(events)
+            else:
+                # Only the messages failing on their own are nacked
+                logger.info(f"🐇 Handling the {len(batch)} messages one at a time")
+                results = [
+                    result
+                    for _, message_events in batch
+                    for result in self._run_alone(message_events)
+                ]
+
+        logger.debug(f"🐇 Batch of {len(events)} events ({len(batch)} messages)")
+        start = 0
+        for delivery_tag, message_events in batch:
+            message_results = results[start : start + len(message_events)]
+            start += len(message_events)
+            errors = [r for r in message_results if isinstance(r, Exception)]
+            if errors:
+                logger.warning(f"🐇 Nacking message {delivery_tag} ({errors[0]!r})")
+                self._channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+            else:
+                self._finish(delivery_tag, message_results)
+
+    def _run_batch(self, events: List) -> List:
+        """'on_batch' results, one per event"""
+        results = list(self._on_batch(events)) if events else []
+        if len(results) != len(events):
+            raise ValueError(
+                f"{len(results)} results for a batch of {len(events)} events"
+            )
+        return results
+
+    def _run_alone(self, events: List) -> List:
+        """'on_batch' results of a message's events (the error if it fails)"""
+        try:
+            return self._run_batch(events)
+        except Exception as e:
+            logger.exception("🐇 Error in batch callback")
+            return [e] * len(events)
+
+    def _start_pool(self) -> None:
+        if self._processes:
+            # Forked so the workers share whatever the handlers loaded
+            self._pool = ProcessPoolExecutor(
+                self._workers, mp_context=multiprocessing.get_context("fork")
+            )
+        else:
+            self._pool = ThreadPoolExecutor(
+                self._workers, thread_name_prefix="consumer"
+            )
+        kind = "processes" if self._processes else "threads"
+        logger.info(
+            f"🐇 Processing up to {self._prefetch_count} messages "
+            f"on {self._workers} {kind}"
+        )
+
     def consume(self):
+        if self._workers and self._pool is None:
+            self._start_pool()
         self._channel.basic_consume(
             queue=self.queue_name, on_message_callback=self._callback
         )
@@ -287,4 +995,357 @@ class BlockingQueueConsumer(BaseQueueClient):
 
     def close(self):
         logger.info("🐇 Closing connection!")
+        if self._pool is not None:
+            # Unacked messages are redelivered by the broker
+            self._pool.shutdown(wait=False)
+            self._pool = None
         self._connection.close()
+
+
+# =============== asyncio clients ================
+
+
+class AsyncQueueClient(BaseQueueClient):
+    """Base of the asyncio clients: the connection runs on the running event
+    loop and the pika callbacks resolve futures awaited by the coroutines.
+    Pending futures fail when the channel or connection closes.
+    """
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(host, port, *args, **kwargs)
+        self._connection = None
+        self._channel = None
+        self._closed = None
+        self._waiters = set()
+
+    @property
+    def connected(self) -> bool:
+        return (
+            self._connection is not None
+            and self._connection.is_open
+            and self._channel is not None
+            and self._channel.is_open
+        )
+
+    def _waiter(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.add(future)
+        future.add_done_callback(self._waiters.discard)
+        return future
+
+    @staticmethod
+    def _resolve(future: asyncio.Future) -> Callable:
+        def callback(result):
+            if not future.done():
+                future.set_result(result)
+
+        return callback
+
+    def _on_closed(self, _source, reason) -> None:
+        """Connection open error, connection or channel closed"""
+        if not isinstance(reason, Exception):
+            reason = pika.exceptions.AMQPConnectionError(reason)
+        for future in list(self._waiters):
+            if not future.done():
+                future.set_exception(reason)
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(reason)
+
+    async def _rpc(self, method: Callable, **kwargs):
+        """Calls an asynchronous channel method waiting for the broker reply"""
+        future = self._waiter()
+        method(callback=self._resolve(future), **kwargs)
+        return await future
+
+    async def connect(
+        self, tcp_keepidle: Optional[int] = None
+    ) -> Tuple[AsyncioConnection, Channel]:
+        self._closed = asyncio.get_running_loop().create_future()
+        if is_memory_uri(self.host):
+            self._connection = MemoryConnection(
+                self.host,
+                loop=asyncio.get_running_loop(),
+                on_close_callback=self._on_closed,
+            )
+            self._channel = self._connection.channel()
+            self._channel.add_on_close_callback(self._on_closed)
+            return self._connection, self._channel
+
+        opened = self._waiter()
+        self._connection = AsyncioConnection(
+            self._parameters(tcp_keepidle),
+            on_open_callback=self._resolve(opened),
+            on_open_error_callback=self._on_closed,
+            on_close_callback=self._on_closed,
+            custom_ioloop=asyncio.get_running_loop(),
+        )
+        await opened
+
+        channel_opened = self._waiter()
+        self._connection.channel(on_open_callback=self._resolve(channel_opened))
+        self._channel = await channel_opened
+        self._channel.add_on_close_callback(self._on_closed)
+
+        return self._connection, self._channel
+
+    async def declare_exchange_async(self, durable: bool = True) -> None:
+        logger.debug(
+            f"🐇 Connecting to a '{self.exchange_type}' exchange: {self.exchange_name}"
+        )
+        await self._rpc(
+            self._channel.exchange_declare,
+            exchange=self.exchange_name,
+            exchange_type=self.exchange_type,
+            durable=durable,
+        )
+
+    async def close(self) -> None:
+        if self._connection is None or self._connection.is_closed:
+            return
+        if not self._connection.is_closing:
+            self._connection.close()
+        await self._closed
+
+
+class AsyncQueuePublisher(AsyncQueueClient):
+    """asyncio counterpart of BlockingQueuePublisher: connects on the first
+    send (and after the connection is lost). With 'confirm' (default)
+    awaiting 'send_message' returns once the broker confirmed the message,
+    without blocking the loop meanwhile, and raises if it's nacked.
+    """
+
+    def __init__(
+        self,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        queue_name: Optional[str] = None,
+        exchange_name: Optional[str] = None,
+        exchange_type: Optional[str] = None,
+        confirm: bool = True,
+        codec: Optional[str] = None,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(host, port, *args, **kwargs)
+        self.queue_name = queue_name
+        self.exchange_name = exchange_name or ""
+        self.exchange_type = exchange_type
+        self.codec = get_codec(codec)
+        self.confirm = confirm
+        self.published = 0
+        self._unconfirmed = OrderedDict()  # delivery tag -> future
+        self._delivery_tag = 0
+        self._lock = asyncio.Lock()
+
+    async def connect(self, tcp_keepidle: Optional[int] = None):
+        await super().connect(tcp_keepidle)
+        if self.exchange_name and self.exchange_type:
+            await self.declare_exchange_async()
+        if self.queue_name:
+            # If a queue_name is given but doesn't exist, will fail
+            await self._rpc(
+                self._channel.queue_declare, queue=self.queue_name, passive=True
+            )
+        if self.confirm:
+            await self._rpc(
+                self._channel.confirm_delivery, ack_nack_callback=self._on_confirm
+            )
+        self._delivery_tag = 0
+
+        return self._connection, self._channel
+
+    def _on_confirm(self, frame) -> None:
+        method = frame.method
+        if method.multiple:
+            tags = [t for t in self._unconfirmed if t <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        for tag in tags:
+            future = self._unconfirmed.pop(tag, None)
+            if future is None or future.done():
+                continue
+            if acked:
+                future.set_result(tag)
+            else:
+                future.set_exception(
+                    pika.exceptions.NackError(f"Message {tag} nacked by the broker")
+                )
+
+    async def _publish(self, message, topic: Optional[str]) -> Optional[asyncio.Future]:
+        async with self._lock:
+            if not self.connected:
+                await self.connect()
+
+        logger.debug(
+            f"Publishing to: {self.exchange_name} | q:{self.queue_name} (topic:{topic})"
+        )
+        body, properties = _encode(self.codec, message)
+        self._channel.basic_publish(
+            exchange=self.exchange_name,
+            routing_key=topic,
+            body=body,
+            properties=properties,
+        )
+        self.published += 1
+        if not self.confirm:
+            return None
+
+        self._delivery_tag += 1
+        future = self._waiter()
+        self._unconfirmed[self._delivery_tag] = future
+        return future
+
+    async def send_message(self, message, topic: Optional[str] = None) -> None:
+        confirmed = await self._publish(message, topic)
+        if confirmed is not None:
+            await confirmed
+        logger.debug("🐇🍻 Sent!")
+
+    async def publish_many(self, messages: Iterable, topic: Optional[str] = None):
+        """Publishes the messages back to back, then awaits their confirms"""
+        confirms = [await self._publish(message, topic) for message in messages]
+        await asyncio.gather(*[c for c in confirms if c is not None])
+
+
+class Delivery:
+    """A message handed by AsyncQueueConsumer. Must be acked (or nacked)"""
+
+    def __init__(self, channel, method, properties, body, load_func: Callable):
+        self.channel = channel
+        self.delivery_tag = method.delivery_tag
+        self.routing_key = method.routing_key
+        self.properties = properties
+        self.body = body
+        self._load_func = load_func
+
+    @property
+    def events(self):
+        return _get_loader(self.properties, self._load_func)(self.body)
+
+    def ack(self) -> None:
+        if self.channel.is_open:
+            self.channel.basic_ack(delivery_tag=self.delivery_tag)
+
+    def nack(self, requeue: bool = False) -> None:
+        if self.channel.is_open:
+            self.channel.basic_nack(delivery_tag=self.delivery_tag, requeue=requeue)
+
+
+class AsyncQueueConsumer(AsyncQueueClient):
+    """asyncio counterpart of BlockingQueueConsumer. Either iterate it
+    ('async for delivery in consumer') acking each delivery, or 'consume'
+    calling 'on_event' (a function or coroutine) for each event of each
+    message and 'on_done' after each message, as BlockingQueueConsumer does.
+
+    Iteration ends when the connection or channel is closed.
+    """
+
+    PREFETCH_COUNT = 10
+
+    def __init__(
+        self,
+        on_event: Optional[Callable] = None,
+        on_done: Optional[Callable] = None,
+        load_func: Optional[Callable] = None,
+        queue_name: Optional[str] = None,
+        exchange_name: Optional[str] = None,
+        exchange_type: Optional[str] = None,
+        routing_keys: Optional[List] = None,
+        prefetch_count: Optional[int] = None,
+        host: Optional[str] = None,
+        port: Optional[int] = None,
+        *args,
+        **kwargs,
+    ):
+        super().__init__(host, port, *args, **kwargs)
+        self._on_event = on_event
+        self._on_done = on_done
+        self._load_func = load_func
+        self.routing_keys = routing_keys or []
+        self.queue_name = queue_name
+        self.exchange_name = exchange_name or ""
+        self.exchange_type = exchange_type
+        self._prefetch_count = prefetch_count or self.PREFETCH_COUNT
+        self._deliveries = None
+
+        self._validate_params()
+
+    async def connect(self, tcp_keepidle: Optional[int] = None):
+        await super().connect(tcp_keepidle)
+        self._deliveries = asyncio.Queue()
+
+        result = await self._rpc(
+            self._channel.queue_declare,
+            queue=self.queue_name or "",
+            durable=True,
+            passive=False,
+        )
+        self.queue_name = result.method.queue
+        await self._rpc(self._channel.basic_qos, prefetch_count=self._prefetch_count)
+
+        if self.exchange_name and self.exchange_type:
+            await self.declare_exchange_async()
+            for k in self.routing_keys:
+                logger.info(f"🐇 Binding queue '{self.queue_name}' to key: '{k}'")
+                await self._rpc(
+                    self._channel.queue_bind,
+                    exchange=self.exchange_name,
+                    queue=self.queue_name,
+                    routing_key=k,
+                )
+
+        self._channel.basic_consume(
+            queue=self.queue_name, on_message_callback=self._on_message
+        )
+        return self._connection, self._channel
+
+    def _on_message(self, channel, method, properties, body) -> None:
+        self._deliveries.put_nowait(
+            Delivery(channel, method, properties, body, self._load_func)
+        )
+
+    def _on_closed(self, source, reason) -> None:
+        super()._on_closed(source, reason)
+        logger.info(f"🐇 Consumer connection closed ({reason!r})")
+        if self._deliveries is not None:
+            self._deliveries.put_nowait(None)  # ends the iteration
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Delivery:
+        if self._deliveries is None:
+            await self.connect()
+
+        delivery = await self._deliveries.get()
+        if delivery is None:
+            raise StopAsyncIteration
+        return delivery
+
+    async def consume(self):
+        logger.debug(
+            f"🐇 Waiting for messages on {self.queue_name}. To exit press CTRL+C"
+        )
+        async for delivery in self:
+            try:
+                for event in delivery.events:
+                    res = self._on_event(event)
+                    if asyncio.iscoroutine(res):
+                        await res
+            except Exception:
+                logger.exception("🐇 Error in queue callback")
+            else:
+                if self._on_done is not None:
+                    self._on_done()
+            finally:
+                # Send basic acknowledge back (no matter what)
+                delivery.ack()
+                logger.debug("🐇 Done!")
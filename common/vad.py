@@ -4,10 +4,17 @@ import scipy.io.wavfile as wf
 
 
 class VoiceActivityDetector:
-    """Use signal energy to detect voice activity in wav file"""
+    """Use signal energy to detect voice activity in wav file.
 
-    def __init__(self, wave_input_filename):
-        self._read_wav(wave_input_filename)._convert_to_mono()
+    With 'mmap' the WAV file is memory-mapped instead of loaded, which
+    together with 'stream_speech' keeps the memory bounded by the chunk
+    size on long recordings.
+    """
+
+    def __init__(self, wave_input_filename, mmap=False):
+        self._read_wav(wave_input_filename, mmap)
+        if not mmap:
+            self._convert_to_mono()
         self.sample_window = 0.02  # 20 ms
         self.sample_overlap = 0.01  # 10ms
         self.speech_window = 0.5  # half a second
@@ -15,8 +22,8 @@ class VoiceActivityDetector:
         self.speech_start_band = 300
         self.speech_end_band = 3000
 
-    def _read_wav(self, wave_file):
-        self.rate, self.data = wf.read(wave_file)
+    def _read_wav(self, wave_file, mmap=False):
+        self.rate, self.data = wf.read(wave_file, mmap=mmap)
         self.channels = len(self.data.shape)
         self.filename = wave_file
         return self
@@ -27,20 +34,36 @@ class VoiceActivityDetector:
             self.channels = 1
         return self
 
-    def _calculate_frequencies(self, audio_data):
-        data_freq = np.fft.fftfreq(len(audio_data), 1.0 / self.rate)
-        data_freq = data_freq[1:]
-        return data_freq
-
-    def _calculate_amplitude(self, audio_data):
-        data_ampl = np.abs(np.fft.fft(audio_data))
-        data_ampl = data_ampl[1:]
-        return data_ampl
-
-    def _calculate_energy(self, data):
-        data_amplitude = self._calculate_amplitude(data)
-        data_energy = data_amplitude**2
-        return data_energy
+    def _mono(self, data):
+        if data.ndim == 2:
+            return np.mean(data, axis=1, dtype=data.dtype)
+        return data
+
+    def _n_windows(self, n_samples, sample_window, sample_overlap):
+        """Windows starting before the last full one"""
+        return max(0, -(-(n_samples - sample_window) // sample_overlap))
+
+    def _frame_windows(self, data, sample_window, sample_overlap, n_windows=None):
+        """(n windows, window size) view over the signal (no copy)"""
+        if n_windows is None:
+            n_windows = self._n_windows(len(data), sample_window, sample_overlap)
+        step = data.strides[0]
+        return np.lib.stride_tricks.as_strided(
+            data,
+            shape=(n_windows, sample_window),
+            strides=(sample_overlap * step, step),
+            writeable=False,
+        )
+
+    def _band_mask(self, sample_window, start_band, end_band):
+        """Positive frequency bins (no DC) strictly within the band"""
+        data_freq = np.fft.rfftfreq(sample_window, 1.0 / self.rate)[1:]
+        return (start_band < data_freq) & (data_freq < end_band)
+
+    def _calculate_energy(self, windows):
+        """Energy of the positive frequency bins (no DC) of each window"""
+        data_ampl = np.abs(np.fft.rfft(windows, axis=1)[:, 1:])
+        return data_ampl**2
 
     def _znormalize_energy(self, data_energy):
         energy_mean = np.mean(data_energy)
@@ -48,26 +71,15 @@ class VoiceActivityDetector:
         energy_znorm = (data_energy - energy_mean) / energy_std
         return energy_znorm
 
-    def _connect_energy_with_frequencies(self, data_freq, data_energy):
-        energy_freq = {}
-        for i, freq in enumerate(data_freq):
-            if abs(freq) not in energy_freq:
-                energy_freq[abs(freq)] = data_energy[i] * 2
-        return energy_freq
-
-    def _calculate_normalized_energy(self, data):
-        data_freq = self._calculate_frequencies(data)
-        data_energy = self._calculate_energy(data)
-        # data_energy = self._znormalize_energy(data_energy) #znorm brings worse results
-        energy_freq = self._connect_energy_with_frequencies(data_freq, data_energy)
-        return energy_freq
-
-    def _sum_energy_in_band(self, energy_frequencies, start_band, end_band):
-        sum_energy = 0
-        for f in energy_frequencies.keys():
-            if start_band < f < end_band:
-                sum_energy += energy_frequencies[f]
-        return sum_energy
+    def _speech_flags(self, windows, band_mask):
+        """Raw (not smoothed) speech flag of each window"""
+        data_energy = self._calculate_energy(windows)
+        sum_voice_energy = data_energy[:, band_mask].sum(axis=1)
+        sum_full_energy = data_energy.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speech_ratio = sum_voice_energy / sum_full_energy
+        # Hipothesis is that when there is a speech sequence we have ratio of energies more than Threshold
+        return speech_ratio > self.speech_energy_threshold
 
     def _median_filter(self, x, k):
         assert k % 2 == 1, "Median filter length must be odd."
@@ -83,10 +95,14 @@ class VoiceActivityDetector:
             y[-j:, -(i + 1)] = x[-1]
         return np.median(y, axis=1)
 
-    def _smooth_speech_detection(self, detected_windows):
+    def _median_window(self):
         median_window = int(self.speech_window / self.sample_window)
         if median_window % 2 == 0:
             median_window = median_window - 1
+        return median_window
+
+    def _smooth_speech_detection(self, detected_windows):
+        median_window = self._median_window()
         median_energy = self._median_filter(detected_windows[:, 1], median_window)
         return median_energy
 
@@ -128,34 +144,107 @@ class VoiceActivityDetector:
         plt.show()
         return self
 
-    def detect_speech(self):
+    def detect_speech(self, batch_windows=4096):
         """Detects speech regions based on ratio between speech band energy
         and total energy.
         Output is array of window numbers and speech flags (1 - speech, 0 - nonspeech).
+
+        Windows are processed 'batch_windows' at a time (one batched FFT per
+        batch) to bound the memory used on long recordings.
         """
-        detected_windows = np.array([])
         sample_window = int(self.rate * self.sample_window)
         sample_overlap = int(self.rate * self.sample_overlap)
-        data = self.data
-        sample_start = 0
-        start_band = self.speech_start_band
-        end_band = self.speech_end_band
-        while sample_start < (len(data) - sample_window):
-            sample_end = sample_start + sample_window
-            if sample_end >= len(data):
-                sample_end = len(data) - 1
-            data_window = data[sample_start:sample_end]
-            energy_freq = self._calculate_normalized_energy(data_window)
-            sum_voice_energy = self._sum_energy_in_band(
-                energy_freq, start_band, end_band
+        windows = self._frame_windows(
+            self._mono(self.data), sample_window, sample_overlap
+        )
+        band_mask = self._band_mask(
+            sample_window, self.speech_start_band, self.speech_end_band
+        )
+        detected_windows = np.zeros((len(windows), 2))
+        detected_windows[:, 0] = np.arange(len(windows)) * sample_overlap
+        for i in range(0, len(windows), batch_windows):
+            detected_windows[i : i + batch_windows, 1] = self._speech_flags(
+                windows[i : i + batch_windows], band_mask
             )
-            sum_full_energy = sum(energy_freq.values())
-            speech_ratio = sum_voice_energy / sum_full_energy
-            # Hipothesis is that when there is a speech sequence we have ratio of energies more than Threshold
-            speech_ratio = speech_ratio > self.speech_energy_threshold
-            detected_windows = np.append(detected_windows, [sample_start, speech_ratio])
-            sample_start += sample_overlap
-        detected_windows = detected_windows.reshape(int(len(detected_windows) / 2), 2)
         detected_windows[:, 1] = self._smooth_speech_detection(detected_windows)
 
         return detected_windows
+
+    def _stream_speech_flags(self, chunk_seconds):
+        """Yields the raw speech flags chunk by chunk. Only the samples of the
+        windows in a chunk (plus the overlap with the next one) are read.
+        """
+        sample_window = int(self.rate * self.sample_window)
+        sample_overlap = int(self.rate * self.sample_overlap)
+        band_mask = self._band_mask(
+            sample_window, self.speech_start_band, self.speech_end_band
+        )
+        n_windows = self._n_windows(len(self.data), sample_window, sample_overlap)
+        chunk_windows = max(1, int(chunk_seconds / self.sample_overlap))
+        for i in range(0, n_windows, chunk_windows):
+            n = min(chunk_windows, n_windows - i)
+            start = i * sample_overlap
+            chunk = self._mono(
+                np.asarray(
+                    self.data[start : start + (n - 1) * sample_overlap + sample_window]
+                )
+            )
+            windows = self._frame_windows(chunk, sample_window, sample_overlap, n)
+            yield self._speech_flags(windows, band_mask)
+
+    def _stream_smoothed_flags(self, chunk_seconds):
+        """Median filters the raw flags as they come, keeping the last
+        'median_window - 1' flags as context for the next chunk. The signal
+        edges are padded repeating the first and last flags, as
+        '_median_filter' does.
+        """
+        k = self._median_window()
+        k2 = (k - 1) // 2
+        context = None
+        for flags in self._stream_speech_flags(chunk_seconds):
+            flags = flags.astype(float)
+            if context is None:
+                context = np.repeat(flags[:1], k2)
+            padded = np.concatenate((context, flags))
+            if len(padded) >= k:
+                yield self._median(padded, k)
+            context = padded[max(0, len(padded) - (k - 1)) :]
+
+        if context is not None and len(context):
+            padded = np.concatenate((context, np.repeat(context[-1:], k2)))
+            yield self._median(padded, k)
+
+    def _median(self, padded, k):
+        """Median of every full 'k' long window of the padded flags"""
+        windows = self._frame_windows(padded, k, 1, len(padded) - k + 1)
+        return np.median(windows, axis=1)
+
+    def stream_speech(self, chunk_seconds=30.0, until_end=False):
+        """Streaming version of 'detect_speech' followed by
+        'convert_windows_to_readible_labels'. Processes the signal in chunks
+        of 'chunk_seconds' (use with 'mmap' to bound the memory used on long
+        recordings) and yields the speech intervals as they are found.
+        As in the batch version, speech lasting until the very end of the
+        signal doesn't yield an interval, unless 'until_end' (ending then at
+        the end of the signal).
+        """
+        sample_overlap = int(self.rate * self.sample_overlap)
+        window = 0
+        speech_begin = None
+        for flags in self._stream_smoothed_flags(chunk_seconds):
+            for is_speech in flags:
+                if is_speech == 1.0 and speech_begin is None:
+                    speech_begin = window * sample_overlap / self.rate
+                if is_speech == 0.0 and speech_begin is not None:
+                    yield {
+                        "speech_begin": speech_begin,
+                        "speech_end": window * sample_overlap / self.rate,
+                    }
+                    speech_begin = None
+                window += 1
+
+        if until_end and speech_begin is not None:
+            yield {
+                "speech_begin": speech_begin,
+                "speech_end": len(self.data) / self.rate,
+            }
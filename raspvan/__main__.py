@@ -4,7 +4,6 @@ import os
 import click
 
 from common import int_or_str
-from raspvan import pipeline
 from raspvan.constants import (
     ASR_SERVER_DEFAULT_URI,
     ASR_SERVER_URI_ENV_VAR,
@@ -13,11 +12,14 @@ from raspvan.constants import (
     AUDIO_SAMPLE_RATE_ENV_VAR,
     HOTWORD_MODEL_DEFAULT_PATH,
     HOTWORD_MODEL_ENV_VAR,
+    HOTWORD_PROFILE_ENV_VAR,
     NLU_SERVER_DEFAULT_URI,
     NLU_SERVER_URI_ENV_VAR,
     PRECISE_ENGINE_DEFAULT_BIN_PATH,
     PRECISE_ENGINE_ENV_VAR,
 )
+from raspvan.pipeline import pipeline
+from raspvan.workers.hotword import DEFAULT_HOTWORD_PROFILE, HOTWORD_PROFILES
 
 
 @click.command()
@@ -53,6 +55,13 @@ from raspvan.constants import (
     type=click.Path(dir_okay=False),
     default=os.getenv(PRECISE_ENGINE_ENV_VAR, PRECISE_ENGINE_DEFAULT_BIN_PATH),
 )
+@click.option(
+    "-P",
+    "--hotword-profile",
+    type=click.Choice(list(HOTWORD_PROFILES)),
+    help="latency / CPU usage tradeoff of the hotword engine",
+    default=os.getenv(HOTWORD_PROFILE_ENV_VAR, DEFAULT_HOTWORD_PROFILE),
+)
 # ASR options
 @click.option(
     "-as",
@@ -73,6 +82,7 @@ def main(
     vad_aggressiveness,
     hotword_engine,
     hotword_model,
+    hotword_profile,
     asr_server_uri,
     nlu_server_uri,
 ):
@@ -85,6 +95,7 @@ def main(
             hotword_model=hotword_model,
             asr_uri=asr_server_uri,
             nlu_uri=nlu_server_uri,
+            hotword_profile=hotword_profile,
         )
     )
 
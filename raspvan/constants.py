@@ -5,6 +5,8 @@ DEFAULT_LOG_DIR = "logs"
 AUDIO_DEVICE_ID_ENV_VAR = "AUDIO_DEVICE_ID"
 AUDIO_SAMPLE_RATE_ENV_VAR = "AUDIO_SAMPLE_RATE"
 AUDIO_DEFAULT_SAMPLE_RATE = 16000
+AUDIO_CAPTURE_SHM_ENV_VAR = "AUDIO_CAPTURE_SHM"
+AUDIO_CAPTURE_DEFAULT_SHM = "raspvan-capture"
 
 # [DEPRECATED] Rabbit MQ env. vars
 Q_EXCHANGE_ENV_VAR = "Q_EXCHANGE"
@@ -12,6 +14,8 @@ RABBITMQ_HOST_ENV_VAR = "RABBITMQ_HOST"
 RABBITMQ_PORT_ENV_VAR = "RABBITMQ_PORT"
 DEFAULT_RABBITMQ_HOST = "localhost"
 DEFAULT_RABBITMQ_PORT = 5672
+RABBITMQ_CODEC_ENV_VAR = "RABBITMQ_CODEC"
+DEFAULT_RABBITMQ_CODEC = "json"
 DEFAULT_EXCHANGE = "fiona"
 
 DEFAULT_HOTWORD_ASR_TOPIC = "hotword.detected"
@@ -23,6 +27,10 @@ HOTWORD_MODEL_ENV_VAR = "HOTWORD_MODEL_PB_PATH"
 HOTWORD_MODEL_DEFAULT_PATH = "hotword/models/fiona/fiona.pb"
 PRECISE_ENGINE_ENV_VAR = "PRECISE_ENGINE_BIN_PATH"
 PRECISE_ENGINE_DEFAULT_BIN_PATH = "hotword/mycroft-precise/.venv/bin/precise-engine"
+HOTWORD_CHIME_ENV_VAR = "HOTWORD_CHIME_PATH"
+HOTWORD_CHIME_DEFAULT_PATH = "assets/hotword-ding.wav"
+HOTWORD_REFRACTORY_ENV_VAR = "HOTWORD_REFRACTORY_S"
+HOTWORD_PROFILE_ENV_VAR = "HOTWORD_PROFILE"
 
 # ASR
 ASR_SERVER_URI_ENV_VAR = "ASR_SERVER_URI"
@@ -0,0 +1,126 @@
+import logging
+import os
+import queue
+
+import requests
+
+from asr.client import ASRClient
+from asr.vad import VAD
+from common.utils.io import init_logger
+from raspvan.workers.hotword import DEFAULT_HOTWORD_PROFILE, init_engine
+from raspvan.workers.relay import RelayClient
+from respeaker.pixels import Pixels
+
+logger = logging.getLogger(__name__)
+init_logger(
+    level=os.getenv("LOGGING_LEVEL", logging.INFO),
+    logger=logger,
+)
+
+# Simple communication Queue between components
+HOTWORD_KEY = "HOTWORD"
+ASR_KEY = "ASR"
+NLU_KEY = "NLU"
+q = queue.Queue()
+
+
+async def pipeline(
+    device,
+    samplerate,
+    vad_aggressiveness,
+    hotword_engine,
+    hotword_model,
+    asr_uri,
+    nlu_uri,
+    hotword_profile=DEFAULT_HOTWORD_PROFILE,
+):
+    logger.info(f"🎙️ Using Audio Device: {device} (sampling rate: {samplerate} Hz)")
+
+    def parse(text: str):
+        try:
+            res = requests.post(nlu_uri, json={"text": text})
+            res.raise_for_status()
+            return res.json()
+        except Exception as e:
+            logger.error(f"Error making NLU parse request: {e}")
+
+    def activate():
+        pixels.wakeup()
+        q.put(HOTWORD_KEY)
+
+    # Init the Pixels client
+    pixels = Pixels(pattern_name="google")
+
+    # ---------------------------
+    #     HOTWORD DETECTION
+    # ---------------------------
+    try:
+        # Init the precise-engine machinery
+        runner, _, _ = init_engine(
+            engine_binary_path=hotword_engine,
+            hotword_model_pb=hotword_model,
+            on_activation_func=activate,
+            sample_rate=samplerate,
+            profile=hotword_profile,
+        )
+        # The runner runs on a separate thread...
+        runner.start()
+        logger.info("🚀 Hotword runner launched!")
+    except Exception as e:
+        raise Exception(f"Error in audio-stream or hotword engine: {e}")
+
+    # ---------------------------
+    #     ASR + NLU + Relays
+    # ---------------------------
+    logger.info("🤐 Initializing ASR and VAD clients")
+    vad = VAD(vad_aggressiveness)
+    asr = ASRClient(asr_uri, vad, pixels)
+    await asr.warmup(samplerate)
+    rc = RelayClient()
+    light_map = {
+        "all": [0, 1, 2, 3],
+        "main": [0],
+        "rear": [1],
+        "middle": [2],
+        "front": [3],
+    }
+
+    # This requires to external services running (docker):
+    #  - ASR websocket server
+    #  - NLU http server
+    logger.info(f"🔁 Starting ASR ({asr_uri}) + NLU ({nlu_uri}) infinite loop")
+    while True:
+        msg = q.get()
+        key = msg["key"]
+        if key == HOTWORD_KEY:
+            # ASR: Start audio stream and do speach recognition on the fly
+            logger.info("🔥 hotword detected! Starting microphone stream...")
+            text = await asr.stream_mic(samplerate, device)
+            res = {"key": ASR_KEY, "text": text}
+            logger.info(f"👂 {res}")
+            q.put(res)
+        elif key == ASR_KEY:
+            # NLU: Analysis of the recognized text
+            parsed = parse(msg["text"])
+            res = {
+                "key": NLU_KEY,
+                "intent": parsed["intent"]["label"],
+                "lights": [
+                    e["value"]
+                    for e in parsed["entities"]
+                    if e["entity"] == "light_name"],
+            }
+            logger.info(f"🔮 {res}")
+            q.put(res)
+        elif key == NLU_KEY:
+            # Unpack all the recognized lights and map to channels
+            channels = [
+                channel for lname in msg["lights"] for channel in light_map.get(lname)
+            ]
+            # Switch On or Off: 1 or 0
+            mode = int(msg["intent"] == "switch-on")
+            rc.switch(channels, mode)
+        else:
+            logger.warning("😵‍💫 Weird message in the queue: '{msg}")
+
+        pixels.off()
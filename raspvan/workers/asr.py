@@ -2,21 +2,24 @@ import asyncio
 import json
 import logging
 import os
+import time
 from datetime import datetime as dt
 
 import click
 
+from asr.capture import AudioCapture, SharedCapture
 from asr.client import ASRClient
-from asr.vad import VAD
+from asr.vad import EnergyGate, VAD
 from common import int_or_str
-from common.utils.exec import run_sync
 from common.utils.io import init_logger
 from common.utils.rabbit import (
-    BlockingQueueConsumer,
-    BlockingQueuePublisher,
+    AsyncQueueConsumer,
+    AsyncQueuePublisher,
     get_amqp_uri_from_env,
+    make_event,
 )
 from raspvan.constants import (
+    AUDIO_CAPTURE_SHM_ENV_VAR,
     AUDIO_DEVICE_ID_ENV_VAR,
     DEFAULT_ASR_NLU_TOPIC,
     DEFAULT_EXCHANGE,
@@ -29,7 +32,7 @@ logger = logging.getLogger(__name__)
 init_logger(level=os.getenv("LOG_LEVEL", logging.INFO), logger=logger)
 
 
-last_time_asr_completed = dt.now().isoformat()
+last_time_asr_completed = time.time()
 
 
 async def callback(event):
@@ -38,41 +41,51 @@ async def callback(event):
 
     text = "😕"
     try:
-        if event["timestamp"] <= last_time_asr_completed:
+        # Local time if naive (i.e. from older publishers)
+        detected_at = dt.fromisoformat(event["timestamp"]).timestamp()
+        if detected_at <= last_time_asr_completed:
             return
 
         logger.info(f"🚀 Launching ASR: {event}")
-        text = await asr.stream_mic(sample_rate, device_id)
+        # Start recognizing from the moment the hotword was detected
+        text = await asr.stream_mic(
+            sample_rate,
+            device_id,
+            capture=capture,
+            start_time=detected_at,
+        )
         logger.info(f"👂️ Recognized: {text}")
-        publisher.send_message(
-            json.dumps(
-                [
-                    {
-                        "text": text,
-                        "status": "completed",
-                        "timestamp": dt.now().isoformat(),
-                    }
-                ]
-            ),
-            topic=PUBLISH_TOPIC,
+        await publisher.send_message(
+            [make_event("completed", text=text)], topic=PUBLISH_TOPIC
         )
     except Exception as e:
         logger.exception(f"Unknown error while runnig VAD/ASR callback: {e}")
     finally:
-        last_time_asr_completed = dt.now().isoformat()
+        last_time_asr_completed = time.time()
         pixels.off()
 
 
 async def arun_asr(
-    samplerate, device, uri, exchange, consume_topic, publish_topic, vad_aggressiveness
+    samplerate,
+    device,
+    uri,
+    exchange,
+    consume_topic,
+    publish_topic,
+    vad_aggressiveness,
+    buffer_seconds,
+    capture_name,
+    energy_gate_db,
 ):
     global asr
+    global capture
     global device_id
     global sample_rate
     global pixels
     global publisher
     global PUBLISH_TOPIC
     PUBLISH_TOPIC = publish_topic
+    consumer, publisher, capture = None, None, None
 
     try:
         # Init ASR parameters
@@ -87,8 +100,18 @@ async def arun_asr(
         pixels = Pixels()
 
         # Init the ASR Client
-        vad = VAD(vad_aggressiveness)
+        gate = EnergyGate(energy_gate_db) if energy_gate_db is not None else None
+        vad = VAD(vad_aggressiveness, gate=gate)
         asr = ASRClient(uri, vad)
+        await asr.warmup(sample_rate)
+
+        # Keep the microphone open so no audio is lost after the hotword
+        if capture_name:
+            logger.info(f"🎙️ Attaching to the shared capture: '{capture_name}'")
+            capture = SharedCapture(capture_name)
+        else:
+            capture = AudioCapture(sample_rate, device_id, seconds=buffer_seconds)
+        capture.start()
 
         # Init the triggering queue
         amqp_host, amqp_port = get_amqp_uri_from_env()
@@ -99,10 +122,10 @@ async def arun_asr(
             f"🐇 Initializing Consumer. Exchange: {exchange}"
             f"(topics: {consume_topic})"
         )
-        consumer = BlockingQueueConsumer(
+        consumer = AsyncQueueConsumer(
             host=amqp_host,
             port=amqp_port,
-            on_event=lambda e: run_sync(callback, e),
+            on_event=callback,
             on_done=lambda: pixels.off(),
             load_func=json.loads,
             routing_keys=[consume_topic],
@@ -116,18 +139,26 @@ async def arun_asr(
             f"(topics: {publish_topic})"
         )
         publish_topic = publish_topic
-        publisher = BlockingQueuePublisher(
+        publisher = AsyncQueuePublisher(
             host=amqp_host,
             port=amqp_port,
             exchange_name=exchange,
             exchange_type="topic",
             queue_name="nlu",
         )
+        await consumer.connect()
+        await publisher.connect()
+        # The websocket, the mic and the broker all run on this loop
         logger.info("👹 Starting consuming from queue...")
-        consumer.consume()
-    except KeyboardInterrupt:
+        await consumer.consume()
+    finally:
         logger.info("Closing connection and unbinding")
-        consumer.close()
+        if consumer is not None:
+            await consumer.close()
+        if publisher is not None:
+            await publisher.close()
+        if capture is not None:
+            capture.stop()
 
 
 @click.command()
@@ -168,6 +199,25 @@ async def arun_asr(
 @click.option(
     "-v", "--vad-aggressiveness", type=int, help="VAD aggressiveness", default=2
 )
+@click.option(
+    "-b",
+    "--buffer-seconds",
+    type=float,
+    help="seconds of audio kept in the capture buffer",
+    default=AudioCapture.BUFFER_SECONDS,
+)
+@click.option(
+    "-c",
+    "--capture-name",
+    help="attach to a running capture worker instead of opening the device",
+    default=os.getenv(AUDIO_CAPTURE_SHM_ENV_VAR),
+)
+@click.option(
+    "--energy-gate-db",
+    type=float,
+    help="skip the VAD on blocks within this margin (dB) of the noise floor",
+    default=None,
+)
 def main(
     samplerate,
     device,
@@ -176,6 +226,9 @@ def main(
     consume_topic,
     publish_topic,
     vad_aggressiveness,
+    buffer_seconds,
+    capture_name,
+    energy_gate_db,
 ):
     try:
         asyncio.run(
@@ -187,6 +240,9 @@ def main(
                 consume_topic,
                 publish_topic,
                 vad_aggressiveness,
+                buffer_seconds,
+                capture_name,
+                energy_gate_db,
             )
         )
     except Exception as e:
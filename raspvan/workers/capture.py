@@ -0,0 +1,77 @@
+import logging
+import os
+from time import sleep
+
+import click
+
+from asr.capture import AudioCapture, WavCapture
+from common import int_or_str
+from common.utils.io import init_logger
+from raspvan.constants import (
+    AUDIO_CAPTURE_DEFAULT_SHM,
+    AUDIO_CAPTURE_SHM_ENV_VAR,
+    AUDIO_DEVICE_ID_ENV_VAR,
+)
+from respeaker.constants import RESPEAKER_CHANNELS, RESPEAKER_RATE
+
+logger = logging.getLogger(__name__)
+init_logger(level=os.getenv("LOG_LEVEL", logging.INFO), logger=logger)
+
+
+@click.command()
+@click.option(
+    "-n",
+    "--name",
+    help="shared memory buffer name consumers attach to",
+    default=os.getenv(AUDIO_CAPTURE_SHM_ENV_VAR, AUDIO_CAPTURE_DEFAULT_SHM),
+)
+@click.option(
+    "-d",
+    "--device",
+    type=int_or_str,
+    help="input device (numeric ID or substring)",
+    default=os.getenv(AUDIO_DEVICE_ID_ENV_VAR, "0"),
+)
+@click.option("-r", "--samplerate", type=int, default=RESPEAKER_RATE)
+@click.option("-c", "--channels", type=int, default=RESPEAKER_CHANNELS)
+@click.option(
+    "-s",
+    "--seconds",
+    type=float,
+    help="seconds of audio kept in the buffer",
+    default=AudioCapture.BUFFER_SECONDS,
+)
+@click.option(
+    "-w",
+    "--wav",
+    type=click.Path(dir_okay=False, exists=True),
+    help="play this WAV file (in a loop) instead of capturing from a device",
+)
+def main(name, device, samplerate, channels, seconds, wav):
+    """Captures audio from the input device once and shares it with the
+    local consumers (hotword, ASR, recording) through shared memory.
+    """
+    if wav:
+        capture = WavCapture(wav, seconds=seconds, shm_name=name, loop=True)
+    else:
+        capture = AudioCapture(
+            samplerate, device, channels=channels, seconds=seconds, shm_name=name
+        )
+
+    try:
+        capture.start()
+        logger.info(f"🚀 Capture shared as '{name}'")
+        while True:
+            sleep(10)
+    finally:
+        logger.warning("‼️ Stopping capture!")
+        capture.stop()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        logger.exception("Error while running audio capture")
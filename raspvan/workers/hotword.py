@@ -1,68 +1,173 @@
-import json
 import logging
 import os
-import subprocess
+import queue
 import threading
 import time
-from datetime import datetime as dt
+from datetime import datetime as dt, timezone
 from time import sleep
-from typing import Callable
+from typing import Callable, Optional, TYPE_CHECKING
 
 import click
-import precise_runner
-from precise_runner import PreciseEngine, PreciseRunner
-from pyaudio import paInt16, PyAudio
 
+from asr.capture import SharedCapture
 from common import int_or_str
 from common.utils.context import no_alsa_err
 from common.utils.io import init_logger
-from common.utils.rabbit import BlockingQueuePublisher, get_amqp_uri_from_env
+from common.utils.rabbit import (
+    BlockingQueuePublisher,
+    get_amqp_uri_from_env,
+    make_event,
+)
 from raspvan.constants import (
+    AUDIO_CAPTURE_SHM_ENV_VAR,
     AUDIO_DEVICE_ID_ENV_VAR,
     DEFAULT_EXCHANGE,
     DEFAULT_HOTWORD_ASR_TOPIC,
+    HOTWORD_CHIME_DEFAULT_PATH,
+    HOTWORD_CHIME_ENV_VAR,
     HOTWORD_MODEL_ENV_VAR,
+    HOTWORD_PROFILE_ENV_VAR,
+    HOTWORD_REFRACTORY_ENV_VAR,
     PRECISE_ENGINE_ENV_VAR,
     Q_EXCHANGE_ENV_VAR,
 )
-from respeaker.pixels import Pixels
+from respeaker.chime import ChimePlayer
+
+if TYPE_CHECKING:
+    from precise_runner import PreciseEngine
+    from respeaker.pixels import Pixels
 
 logger = logging.getLogger(__name__)
 init_logger(level=os.getenv("LOG_LEVEL", logging.INFO), logger=logger)
 
 
-CHUNK_SIZE = 2048
+# Engine chunk (bytes), input stream buffer (frames) and trigger settings.
+# Smaller chunks detect sooner but cost more CPU (one inference per chunk)
+HOTWORD_PROFILES = {
+    "low-latency": {
+        "chunk_size": 1024,
+        "frames_per_buffer": 512,
+        "sensitivity": 0.5,
+        "trigger_level": 3,
+    },
+    "balanced": {
+        "chunk_size": 2048,
+        "frames_per_buffer": 2048,
+        "sensitivity": 0.5,
+        "trigger_level": 3,
+    },
+    "low-power": {
+        "chunk_size": 4096,
+        "frames_per_buffer": 4096,
+        "sensitivity": 0.45,
+        "trigger_level": 1,
+    },
+}
+DEFAULT_HOTWORD_PROFILE = "balanced"
+CHUNK_SIZE = HOTWORD_PROFILES[DEFAULT_HOTWORD_PROFILE]["chunk_size"]
+SELF_CHECK_CHUNKS = 20
 COUNT = 0
 PUBLISH_TOPIC = None
 
 
-class SoundThread(threading.Thread):
-    def __init__(self, timeout=3):
-        threading.Thread.__init__(self)
-        self.timeout = timeout
+class ActivationDispatcher(threading.Thread):
+    """Handles the hotword activations on its own thread.
+
+    'dispatch' is meant to be called from the precise runner thread: it only
+    timestamps the activation and puts it in a bounded queue, so the runner
+    goes straight back to processing audio. Activations arriving with the
+    queue full are dropped (and counted).
+    """
 
-    def run(self):
+    MAX_QUEUED = 8
+
+    def __init__(
+        self, handler: Callable[[float], None], max_queued: Optional[int] = None
+    ) -> None:
+        super().__init__(daemon=True)
+        self.handler = handler
+        self._queue = queue.Queue(maxsize=max_queued or self.MAX_QUEUED)
+        self.dropped = 0
+
+    def dispatch(self, timestamp: Optional[float] = None) -> None:
         try:
-            sound_path = os.path.join(os.getcwd(), "assets/hotword-ding.wav")
-            logger.debug(f"Playing sound: {sound_path}")
-            # playsound(sound_path)
-            p = subprocess.Popen(["aplay", sound_path])
+            self._queue.put_nowait(timestamp or time.time())
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Activation dropped, dispatcher busy ({self.dropped})")
+
+    def run(self) -> None:
+        while True:
+            timestamp = self._queue.get()
+            if timestamp is None:
+                return
+
             try:
-                p.wait(self.timeout)
-            except subprocess.TimeoutExpired:
-                p.kill()
-        except Exception as e:
-            logger.exception(f"Error playing sound: {e}")
+                self.handler(timestamp)
+            except Exception as e:
+                logger.exception(f"Error handling activation: {e}")
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self.join()
 
 
 class ASRTrigger:
+    """Publishes a message for the ASR worker on each hotword activation.
+
+    Activations within 'refractory_s' of the last accepted one (e.g. the
+    engine firing several times for the same utterance or the user repeating
+    the hotword) are coalesced into it: they are counted as suppressed and
+    never reach the dispatcher nor the broker. The window doesn't restart
+    with suppressed activations, so a continuous source of triggers (e.g. a
+    TV) still gets an activation through every 'refractory_s'.
+    """
+
+    PIXELS_ON_S = 0.5
+    REFRACTORY_S = 3.0
+
     def __init__(
-        self, q_topic: str, pixels: Pixels, publisher: BlockingQueuePublisher
+        self,
+        q_topic: str,
+        pixels: "Pixels",
+        publisher: BlockingQueuePublisher,
+        chime: Optional[ChimePlayer] = None,
+        refractory_s: Optional[float] = None,
     ) -> None:
         self.publisher = publisher
         self.pixels = pixels
+        self.refractory_s = self.REFRACTORY_S if refractory_s is None else refractory_s
+        self.suppressed = 0
+        self._last_activation = 0.0
+        self.chime = chime or ChimePlayer(HOTWORD_CHIME_DEFAULT_PATH).start()
+        # Delay between the hotword detection and its message being published
+        self.publish_delay = {"count": 0, "total_s": 0.0, "max_s": 0.0}
+        self.dispatcher = ActivationDispatcher(self.handle_activation)
+        self.dispatcher.start()
 
     def on_activation(self):
+        """Runner callback, see 'handle_activation' for the actual handling"""
+        now = time.time()
+        if now - self._last_activation < self.refractory_s:
+            self.suppressed += 1
+            logger.debug(f"🔕 Activation coalesced ({self.suppressed} suppressed)")
+            return
+
+        self._last_activation = now
+        self.dispatcher.dispatch(now)
+
+    def _track_delay(self, delay_s: float) -> None:
+        self.publish_delay["count"] += 1
+        self.publish_delay["total_s"] += delay_s
+        self.publish_delay["max_s"] = max(self.publish_delay["max_s"], delay_s)
+        mean_s = self.publish_delay["total_s"] / self.publish_delay["count"]
+        logger.debug(
+            f"⏳️ Activation published after {delay_s * 1000:.1f}ms "
+            f"(mean: {mean_s * 1000:.1f}ms, "
+            f"max: {self.publish_delay['max_s'] * 1000:.1f}ms)"
+        )
+
+    def handle_activation(self, timestamp: float):
         global COUNT
         global PUBLISH_TOPIC
         COUNT += 1
@@ -70,18 +175,62 @@ class ASRTrigger:
         logger.info(f" 🔫 Hotword detected! ({COUNT})")
         try:
             self.pixels.wakeup()
-            SoundThread().start()
+            self.chime.play()
             # Send activation message through queue
-            self.publisher.send_message(
-                json.dumps([{"status": "detected", "timestamp": dt.now().isoformat()}]),
-                topic=PUBLISH_TOPIC,
+            event = make_event(
+                "detected",
+                timestamp=dt.fromtimestamp(timestamp, timezone.utc).isoformat(),
             )
+            self.publisher.send_message([event], topic=PUBLISH_TOPIC)
+            self._track_delay(time.time() - timestamp)
         except Exception as e:
             logger.exception(f"Error sending Queue message: {e}")
         finally:
-            # Switch off the wake up pixels
-            time.sleep(0.5)
-            self.pixels.off()
+            # Switch off the wake up pixels without holding the dispatcher
+            threading.Timer(self.PIXELS_ON_S, self.pixels.off).start()
+
+
+def self_check(
+    engine: "PreciseEngine", sample_rate: int, n_chunks: Optional[int] = None
+):
+    """Times the engine inference on the first chunks of live audio and warns
+    if it takes longer than the audio in a chunk (i.e. the engine can't keep
+    up in real time). The first chunks wait on the model loading and are
+    not accounted.
+    """
+    n_chunks = n_chunks or SELF_CHECK_CHUNKS
+    get_prediction = engine.get_prediction
+    chunk_s = engine.chunk_size / 2 / sample_rate  # int16 mono audio
+    times = []
+
+    def timed_prediction(chunk):
+        start = time.perf_counter()
+        done = True
+        try:
+            prob = get_prediction(chunk)
+            times.append(time.perf_counter() - start)
+            done = len(times) == n_chunks + 2
+        finally:
+            # Unwrapped once checked, or right away if the engine fails
+            if done:
+                engine.get_prediction = get_prediction
+
+        if done:
+            inference_s = sorted(times[2:])[n_chunks // 2]
+            msg = (
+                f"⏱️ Hotword inference: {inference_s * 1000:.1f}ms "
+                f"per {chunk_s * 1000:.0f}ms chunk ({inference_s / chunk_s:.0%})"
+            )
+            if inference_s > chunk_s:
+                logger.warning(
+                    f"{msg}. The engine can't keep up in real time, "
+                    "try a profile with larger chunks"
+                )
+            else:
+                logger.info(msg)
+        return prob
+
+    engine.get_prediction = timed_prediction
 
 
 def init_engine(
@@ -91,35 +240,67 @@ def init_engine(
     custom_stream: bool = False,
     sample_rate: int = 16000,
     n_channels: int = 4,
+    capture_name: Optional[str] = None,
+    chunk_size: Optional[int] = None,
+    stream=None,
+    profile: str = DEFAULT_HOTWORD_PROFILE,
 ):
+    """Inits the precise engine and runner reading from (in order of
+    preference) the given 'stream', the shared capture 'capture_name', a
+    PyAudio stream (if 'custom_stream') or the default input device.
+
+    'profile' is one of HOTWORD_PROFILES ('chunk_size' overrides its chunk).
+    """
+    # The engine (and PyAudio) are only needed to run the detection
+    import precise_runner
+    from precise_runner import PreciseEngine, PreciseRunner
+
+    settings = HOTWORD_PROFILES[profile]
+    chunk_size = chunk_size or settings["chunk_size"]
+    logger.info(f"⚙️ Hotword profile: '{profile}' (chunk size: {chunk_size})")
     logger.debug(f"Precise Engine: '{engine_binary_path}'")
     logger.debug(f"Precise Runner version: '{precise_runner.__version__}'")
     logger.debug(f"model path: '{hotword_model_pb}'")
 
-    pa, stream = None, None
-    if custom_stream:
+    pa = None
+    if stream is not None:
+        logger.info("🎙️ Reading from a custom stream")
+    elif capture_name:
+        # Read the audio from the shared capture worker buffer
+        logger.info(f"🎙️ Attaching to the shared capture: '{capture_name}'")
+        stream = SharedCapture(capture_name).stream()
+    elif custom_stream:
         # Init the runner with a custom stream
         # so we can select the input device
         device_id = os.getenv(AUDIO_DEVICE_ID_ENV_VAR, 0)
         logger.info(f"🎙️ Initializing audio stream. Using device ID: {device_id}")
 
+        from pyaudio import paInt16, PyAudio
+
         pa = PyAudio()
         stream = pa.open(
             rate=sample_rate,
             channels=n_channels,
             format=paInt16,
             input=True,
-            frames_per_buffer=CHUNK_SIZE,
+            frames_per_buffer=settings["frames_per_buffer"],
             input_device_index=int(device_id),
         )
 
     # Init the Precise Engine
     logger.info("⚙️ Initializing hotword engine")
-    engine = PreciseEngine(engine_binary_path, hotword_model_pb, chunk_size=CHUNK_SIZE)
+    engine = PreciseEngine(engine_binary_path, hotword_model_pb, chunk_size=chunk_size)
+    self_check(engine, sample_rate)
 
     # Init the precise runner (python wrapper over the engine)
     logger.info("⚙️ Initializing hotword runner")
-    runner = PreciseRunner(engine, on_activation=on_activation_func, stream=stream)
+    runner = PreciseRunner(
+        engine,
+        trigger_level=settings["trigger_level"],
+        sensitivity=settings["sensitivity"],
+        on_activation=on_activation_func,
+        stream=stream,
+    )
 
     return runner, pa, stream
 
@@ -147,7 +328,44 @@ def init_engine(
 @click.option("-r", "--samplerate", type=int, help="sampling rate", default=16000)
 @click.option("-m", "--model", default=os.getenv(HOTWORD_MODEL_ENV_VAR))
 @click.option("-e", "--engine", default=os.getenv(PRECISE_ENGINE_ENV_VAR))
-def main(device, samplerate, exchange, publish_topic, engine, model):
+@click.option(
+    "-c",
+    "--capture-name",
+    help="attach to a running capture worker instead of opening the device",
+    default=os.getenv(AUDIO_CAPTURE_SHM_ENV_VAR),
+)
+@click.option(
+    "-s",
+    "--chime",
+    help="WAV file played on activation",
+    default=os.getenv(HOTWORD_CHIME_ENV_VAR, HOTWORD_CHIME_DEFAULT_PATH),
+)
+@click.option(
+    "-w",
+    "--refractory-s",
+    type=float,
+    help="seconds after an activation during which new ones are coalesced",
+    default=os.getenv(HOTWORD_REFRACTORY_ENV_VAR, ASRTrigger.REFRACTORY_S),
+)
+@click.option(
+    "-P",
+    "--profile",
+    type=click.Choice(list(HOTWORD_PROFILES)),
+    help="latency / CPU usage tradeoff of the hotword engine",
+    default=os.getenv(HOTWORD_PROFILE_ENV_VAR, DEFAULT_HOTWORD_PROFILE),
+)
+def main(
+    device,
+    samplerate,
+    exchange,
+    publish_topic,
+    engine,
+    model,
+    capture_name,
+    chime,
+    refractory_s,
+    profile,
+):
     if model is None:
         raise ValueError(
             f"--model not provided and '{HOTWORD_MODEL_ENV_VAR}' env. var not set."
@@ -177,8 +395,17 @@ def main(device, samplerate, exchange, publish_topic, engine, model):
     except Exception as e:
         raise Exception(f"Error initializing 🐇 publisher: {e}")
 
+    # The LEDs (GPIO) are only needed to run the worker
+    from respeaker.pixels import Pixels
+
     try:
-        trigger = ASRTrigger(publish_topic, Pixels(), publisher)
+        trigger = ASRTrigger(
+            publish_topic,
+            Pixels(),
+            publisher,
+            ChimePlayer(chime).start(),
+            refractory_s=refractory_s,
+        )
     except Exception as e:
         raise Exception(f"Error initializing ASR Trigger: {e}")
 
@@ -189,6 +416,8 @@ def main(device, samplerate, exchange, publish_topic, engine, model):
             hotword_model_pb=model,
             on_activation_func=trigger.on_activation,
             sample_rate=samplerate,
+            capture_name=capture_name,
+            profile=profile,
         )
         # The runner runs on a separate thread...
         runner.start()
@@ -200,6 +429,9 @@ def main(device, samplerate, exchange, publish_topic, engine, model):
         while True:
             sleep(10)
     finally:
+        trigger.dispatcher.stop()
+        trigger.chime.stop()
+        trigger.publisher.close()
         if pa is not None:
             logger.warning("‼️ Terminating pyAudio!")
             pa.terminate()
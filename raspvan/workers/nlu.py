@@ -1,7 +1,6 @@
 import json
 import logging
 import os
-from datetime import datetime as dt
 
 import click
 
@@ -10,6 +9,7 @@ from common.utils.rabbit import (
     BlockingQueueConsumer,
     BlockingQueuePublisher,
     get_amqp_uri_from_env,
+    make_event,
 )
 from nlu import NLUPipeline
 from raspvan.constants import (
@@ -29,31 +29,41 @@ PUBLISH_TOPIC = None
 
 
 def callback(event):
-    text = "😕"
+    """Runs the NLU on an event text (possibly in a consumer worker)"""
     try:
         text = event.get("text", "")
         if not text:
-            return
+            return None
 
         logger.info(f"🚀 Running NLU on: '{text}'")
         res = NLP([text])
         logger.info(f"🤔 Results: {res}")
+        return res
+    except Exception:
+        logger.exception("Unknown error while runnig NLU callback")
+
+
+def batch_callback(events):
+    """Runs the NLU on the texts of a batch of events at once"""
+    texts = [event.get("text", "") for event in events]
+    sentences = [text for text in texts if text]
+    if not sentences:
+        return [None] * len(texts)
+
+    logger.info(f"🚀 Running NLU on {len(sentences)} texts: {sentences}")
+    parsed = iter(NLP(sentences))
+    res = [[next(parsed)] if text else None for text in texts]
+    logger.info(f"🤔 Results: {res}")
+    return res
+
+
+def publish(res):
+    try:
         PUBLISHER.send_message(
-            json.dumps(
-                [
-                    {
-                        "results": res,
-                        "status": "completed",
-                        "timestamp": dt.now().isoformat(),
-                    }
-                ]
-            ),
-            topic=PUBLISH_TOPIC,
+            [make_event("completed", results=res)], topic=PUBLISH_TOPIC
         )
-    except Exception as e:
-        logger.exception(f"Unknown error while runnig NLU callback: {e}")
-    finally:
-        PIXELS.off()
+    except Exception:
+        logger.exception("Unknown error while publishing NLU results")
 
 
 @click.command()
@@ -93,7 +103,43 @@ def callback(event):
     help="entity extractor pkl file",
     default="nlu/models/entity-tagger.pkl",
 )
-def main(classifier, label_encoder, tagger, exchange, consume_topic, publish_topic):
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    help="process messages concurrently on this many workers (0: inline)",
+    default=0,
+)
+@click.option(
+    "--processes/--threads",
+    help="workers are processes (default) or threads",
+    default=True,
+)
+@click.option(
+    "-B",
+    "--batch-size",
+    type=int,
+    help="run the NLU on batches of up to this many texts (0: no batching)",
+    default=0,
+)
+@click.option(
+    "--batch-ms",
+    type=float,
+    help="max. time (ms) to wait for a batch to fill",
+    default=BlockingQueueConsumer.BATCH_MS,
+)
+def main(
+    classifier,
+    label_encoder,
+    tagger,
+    exchange,
+    consume_topic,
+    publish_topic,
+    workers,
+    processes,
+    batch_size,
+    batch_ms,
+):
     global PUBLISH_TOPIC
     global PUBLISHER
     global PIXELS
@@ -117,8 +163,14 @@ def main(classifier, label_encoder, tagger, exchange, consume_topic, publish_top
         consumer = BlockingQueueConsumer(
             host=amqp_host,
             port=amqp_port,
-            on_event=lambda e: callback(e),
+            on_event=callback,
             on_done=lambda: PIXELS.off(),
+            on_result=publish,
+            workers=workers,
+            processes=processes,
+            on_batch=batch_callback if batch_size else None,
+            batch_size=batch_size,
+            batch_ms=batch_ms,
             load_func=json.loads,
             routing_keys=[consume_topic],
             exchange_name=exchange,
@@ -144,10 +196,11 @@ def main(classifier, label_encoder, tagger, exchange, consume_topic, publish_top
     except KeyboardInterrupt:
         logger.info("Closing connection and unbinding")
         consumer.close()
+        PUBLISHER.close()
 
 
 if __name__ == "__main__":
     try:
         main()
-    except Exception as e:
-        logger.exception(f"Error while running NLU: {e}")
+    except Exception:
+        logger.exception("Error while running NLU")
@@ -0,0 +1,137 @@
+import logging
+import os
+import wave
+from typing import Optional
+
+from common.utils.io import init_logger
+
+logger = logging.getLogger(__name__)
+init_logger(level=os.getenv("LOG_LEVEL", logging.INFO), logger=logger)
+
+
+class ChimePlayer:
+    """Plays a short feedback sound (e.g. the hotword chime) from memory.
+
+    The WAV file is decoded once and the output stream is opened once, so
+    playing the chime only rewinds the position the stream callback reads
+    from and (re)starts the stream: no process to spawn, file to read or
+    device to open on every activation. The start latency is bounded by the
+    (small) block size of the stream. The stream stops itself once the sound
+    is over so there are no callbacks while idle.
+
+    Falls back to a null sink (playing does nothing but count) when the file
+    or the audio output isn't available, e.g. on headless machines or tests.
+    """
+
+    BLOCK_SIZE = 128  # frames, 8ms @ 16kHz
+
+    def __init__(
+        self,
+        wav_file: str,
+        device: Optional[int] = None,
+        block_size: Optional[int] = None,
+        null_sink: bool = False,
+    ) -> None:
+        self.wav_file = wav_file
+        self.device = device
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.null_sink = null_sink
+        self.plays = 0
+        self._stream = None
+        self._callback_stop = None  # raised by the callback at the end
+        self._pos = None  # byte offset of the next block to play (None: idle)
+        self._data = memoryview(b"")
+        self.sample_rate, self.channels = None, 1
+        if not null_sink:
+            self._load()
+
+        self._silence = bytes(2 * self.channels * self.block_size)
+
+    def _load(self) -> None:
+        try:
+            with wave.open(self.wav_file, "rb") as wf:
+                if wf.getsampwidth() != 2:
+                    raise ValueError("only 16 bits PCM WAV files supported")
+                self.sample_rate = wf.getframerate()
+                self.channels = wf.getnchannels()
+                self._data = memoryview(wf.readframes(wf.getnframes()))
+        except (OSError, EOFError, ValueError, wave.Error) as e:
+            logger.warning(f"🔇 Can't load '{self.wav_file}' ({e}). Using a null sink")
+            self.null_sink = True
+
+    @property
+    def playing(self) -> bool:
+        return self._pos is not None
+
+    def _callback(self, outdata, frames, time_info, status):
+        """This is called (from a separate thread) for each output block."""
+        n = len(outdata)
+        pos = self._pos
+        if pos is None:
+            outdata[:] = self._silence[:n]
+            return
+
+        chunk = self._data[pos : pos + n]
+        outdata[: len(chunk)] = chunk
+        outdata[len(chunk) :] = self._silence[: n - len(chunk)]
+        self._pos = pos + n if pos + n < len(self._data) else None
+        if self._pos is None and self._callback_stop is not None:
+            raise self._callback_stop  # plays this last block, then stops
+
+    def start(self) -> "ChimePlayer":
+        if self.null_sink or self._stream is not None:
+            return self
+
+        try:
+            # OSError if the PortAudio library isn't installed
+            import sounddevice as sd
+        except (ImportError, OSError) as e:
+            logger.warning(f"🔇 No audio output ({e}). Using a null sink")
+            self.null_sink = True
+            return self
+
+        try:
+            # Opened once but only started to play
+            self._stream = sd.RawOutputStream(
+                samplerate=self.sample_rate,
+                blocksize=self.block_size,
+                device=self.device,
+                channels=self.channels,
+                dtype="int16",
+                latency="low",
+                callback=self._callback,
+            )
+            self._callback_stop = sd.CallbackStop
+        except sd.PortAudioError as e:
+            logger.warning(f"🔇 Can't open the audio output ({e}). Using a null sink")
+            self._stream = None
+            self.null_sink = True
+
+        return self
+
+    def play(self) -> None:
+        """Plays the sound from the start (even if it's already playing)"""
+        self.plays += 1
+        if self.null_sink:
+            return
+
+        if self._stream is None:
+            self.start()
+            if self.null_sink:
+                return
+
+        import sounddevice as sd
+
+        try:
+            # Cuts a chime still playing, so the callback isn't running
+            self._stream.abort()
+            self._pos = 0
+            self._stream.start()
+        except sd.PortAudioError as e:
+            logger.warning(f"🔇 Can't play the chime: {e}")
+
+    def stop(self) -> None:
+        if self._stream is not None:
+            self._stream.stop()
+            self._stream.close()
+            self._stream = None
@@ -0,0 +1,256 @@
+import json
+import os
+import threading
+import time
+import wave
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from raspvan.constants import (
+    HOTWORD_MODEL_DEFAULT_PATH,
+    HOTWORD_MODEL_ENV_VAR,
+    PRECISE_ENGINE_DEFAULT_BIN_PATH,
+    PRECISE_ENGINE_ENV_VAR,
+)
+from raspvan.workers.hotword import CHUNK_SIZE, init_engine
+
+console = Console()
+
+SAMPLE_RATE = 16000
+GAP_S = 2.0  # silence between files so the engine state doesn't leak
+MATCH_WINDOW_S = 2.0  # max. latency for an activation to match a label
+
+
+def _clock_ticks(pid: int) -> int:
+    """User + system CPU time (in clock ticks) of a process (Linux only)"""
+    stat = Path(f"/proc/{pid}/stat").read_text()
+    fields = stat.rsplit(")", 1)[1].split()
+    return int(fields[11]) + int(fields[12])
+
+
+class ReplayStream:
+    """File-like stream feeding WAV files (16kHz, 16 bits) one after the
+    other to the hotword runner as fast as it reads. Files are read lazily,
+    separated by 'GAP_S' of silence and preceded by a warm-up silence (so
+    the engine start-up isn't accounted). Reads past the end return silence
+    until the runner is stopped.
+    """
+
+    def __init__(self, wav_files: List[str], warmup_s: float = GAP_S) -> None:
+        self.wav_files = wav_files
+        self.gap = bytes(2 * int(GAP_S * SAMPLE_RATE))
+        self.pos = 0  # bytes read so far
+        self.starts = []  # byte offset where each file starts
+        self.lengths = []  # bytes of each file
+        self.warmup_bytes = 2 * int(warmup_s * SAMPLE_RATE)
+        self.done = threading.Event()
+        self.warm = threading.Event()
+        self._pending = bytes(self.warmup_bytes)
+        self._next = 0
+
+    def _load(self, wav_file: str) -> bytes:
+        with wave.open(wav_file, "rb") as wf:
+            if wf.getframerate() != SAMPLE_RATE or wf.getsampwidth() != 2:
+                raise ValueError(f"{wav_file}: 16kHz 16 bits audio expected")
+            data = wf.readframes(wf.getnframes())
+            channels = wf.getnchannels()
+
+        if channels > 1:
+            # Hotword on the first channel
+            data = np.frombuffer(data, dtype="int16")[::channels].tobytes()
+
+        return data
+
+    def read(self, n_bytes: int) -> bytes:
+        while len(self._pending) < n_bytes and self._next < len(self.wav_files):
+            data = self._load(self.wav_files[self._next])
+            self.starts.append(self.pos + len(self._pending))
+            self.lengths.append(len(data))
+            self._pending += data + self.gap
+            self._next += 1
+
+        chunk = self._pending[:n_bytes]
+        self._pending = self._pending[n_bytes:]
+        if len(chunk) < n_bytes:
+            self.done.set()
+            chunk += bytes(n_bytes - len(chunk))
+
+        self.pos += n_bytes
+        if self.pos >= self.warmup_bytes:
+            self.warm.set()
+
+        return chunk
+
+    def locate(self, pos: int) -> Optional[Tuple[int, float]]:
+        """(file index, seconds into the file) of a stream byte offset"""
+        for i, (start, length) in enumerate(zip(self.starts, self.lengths)):
+            if start <= pos < start + length + len(self.gap):
+                return i, (pos - start) / 2 / SAMPLE_RATE
+        return None
+
+
+def replay(
+    engine: str, model: str, wav_files: List[str], chunk_size: int
+) -> Tuple[Dict[str, List[float]], Dict[str, float], float]:
+    """Detections (seconds into each file), duration of each file and CPU
+    seconds used (engine process + this process) after the warm-up
+    """
+    stream = ReplayStream(wav_files)
+    detections = {wav_file: [] for wav_file in wav_files}
+
+    def on_activation():
+        located = stream.locate(stream.pos)
+        if located is not None:
+            i, offset = located
+            detections[wav_files[i]].append(round(offset, 3))
+
+    runner, _, _ = init_engine(
+        engine_binary_path=engine,
+        hotword_model_pb=model,
+        on_activation_func=on_activation,
+        chunk_size=chunk_size,
+        stream=stream,
+    )
+    runner.start()
+    stream.warm.wait()
+    tick_s = 1 / os.sysconf("SC_CLK_TCK")
+    engine_start = _clock_ticks(runner.engine.proc.pid)
+    start = time.process_time()
+    stream.done.wait()
+    cpu_s = (_clock_ticks(runner.engine.proc.pid) - engine_start) * tick_s
+    cpu_s += time.process_time() - start
+    runner.stop()
+
+    durations = {
+        wav_file: length / 2 / SAMPLE_RATE
+        for wav_file, length in zip(wav_files, stream.lengths)
+    }
+    return detections, durations, cpu_s
+
+
+def find_files(pattern: Optional[str]) -> List[str]:
+    """WAV files in a directory (recursively) or matching a glob pattern"""
+    if pattern is None:
+        return []
+
+    path = Path(pattern)
+    if path.is_dir():
+        files = path.rglob("*.wav")
+    elif path.is_absolute():
+        files = Path(path.anchor).glob(str(path.relative_to(path.anchor)))
+    else:
+        files = Path().glob(pattern)
+    return sorted(str(f) for f in files)
+
+
+@click.command()
+@click.option("-p", "--positives", help="dir. or glob of WAV files with the hotword")
+@click.option(
+    "-l",
+    "--labels",
+    type=click.Path(dir_okay=False, exists=True),
+    help="JSON with the hotword end times (seconds) of each positive file",
+)
+@click.option("-n", "--negatives", help="dir. or glob of WAV files without it")
+@click.option(
+    "-m",
+    "--model",
+    default=os.getenv(HOTWORD_MODEL_ENV_VAR, HOTWORD_MODEL_DEFAULT_PATH),
+)
+@click.option(
+    "-e",
+    "--engine",
+    default=os.getenv(PRECISE_ENGINE_ENV_VAR, PRECISE_ENGINE_DEFAULT_BIN_PATH),
+)
+@click.option("-c", "--chunk-size", type=int, multiple=True, help="engine chunk sizes")
+@click.option("-o", "--output", help="write the results as JSON to this file")
+def main(positives, labels, negatives, model, engine, chunk_size, output):
+    """Replays WAV files through the hotword engine faster than real time and
+    reports detections, detection latency, false activations per hour and
+    CPU time per audio second for each engine chunk size.
+
+    The labels file maps each positive file (as found by the glob) to the
+    list of times (seconds) where a hotword utterance ends.
+    """
+    positive_files, negative_files = find_files(positives), find_files(negatives)
+    if not positive_files and not negative_files:
+        raise click.UsageError("Nothing to replay: give --positives and/or --negatives")
+
+    hotword_ends = {}
+    if labels:
+        with Path(labels).open() as f:
+            hotword_ends = json.load(f)
+
+    results = []
+    for size in chunk_size or [CHUNK_SIZE]:
+        console.print(f"⚙️ Replaying with chunk size {size}...")
+        detections, durations, cpu_s = replay(
+            engine, model, positive_files + negative_files, size
+        )
+        audio_s = sum(durations.values())
+
+        latencies, false_pos, missed, n_labels = [], 0, 0, 0
+        for wav_file in positive_files:
+            ends = hotword_ends.get(wav_file, [])
+            n_labels += len(ends)
+            found = list(detections[wav_file])
+            for end in ends:
+                match = [d for d in found if 0 <= d - end <= MATCH_WINDOW_S]
+                if match:
+                    latencies.append(match[0] - end)
+                    found.remove(match[0])
+                else:
+                    missed += 1
+            false_pos += len(found)
+
+        negative_s = sum(durations[f] for f in negative_files)
+        negative_fa = sum(len(detections[f]) for f in negative_files)
+        results.append(
+            {
+                "chunk_size": size,
+                "chunk_ms": round(1000 * size / 2 / SAMPLE_RATE, 1),
+                "audio_s": round(audio_s, 1),
+                "cpu_per_audio_s": round(cpu_s / audio_s, 4) if audio_s else None,
+                "labels": n_labels,
+                "missed": missed,
+                "latency_ms": (
+                    round(1000 * float(np.mean(latencies))) if latencies else None
+                ),
+                "false_activations": false_pos + negative_fa,
+                "false_activations_per_hour": (
+                    round(3600 * negative_fa / negative_s, 2) if negative_s else None
+                ),
+                "detections": detections,
+            }
+        )
+
+    table = Table(title="Hotword replay")
+    table.add_column("Chunk (ms)", justify="right", style="magenta")
+    for column in ["CPU s / audio s", "Missed", "Latency (ms)", "FA", "FA / hour"]:
+        table.add_column(column, justify="right", style="cyan")
+    for r in results:
+        table.add_row(
+            f"{r['chunk_size']} ({r['chunk_ms']})",
+            str(r["cpu_per_audio_s"]),
+            f"{r['missed']} / {r['labels']}",
+            str(r["latency_ms"]),
+            str(r["false_activations"]),
+            str(r["false_activations_per_hour"]),
+        )
+
+    console.print(table)
+    if output:
+        with Path(output).open("w") as f:
+            json.dump(results, f, indent=2)
+        console.print(f"💾 Results written to {output}")
+
+
+if __name__ == "__main__":
+    # python -m scripts.bench_hotword -p positives/ -l labels.json -n negatives/ \
+    #   -c 1024 -c 2048 -c 4096
+    main()
@@ -0,0 +1,94 @@
+import time
+
+import click
+from rich.console import Console
+from rich.table import Table
+
+from common.utils.rabbit import (
+    BlockingQueuePublisher,
+    CODECS,
+    get_amqp_uri_from_env,
+    get_codec,
+    make_event,
+)
+
+console = Console()
+
+
+def make_events(n: int):
+    """Hotword-like messages (a list with one event each)"""
+    return [[make_event("detected", seq=i)] for i in range(n)]
+
+
+@click.command()
+@click.option("-x", "--exchange", default="bench", help="exchange to publish to")
+@click.option("-t", "--topic", default="bench.events", help="routing key")
+@click.option("-n", "--n-events", type=int, default=10000)
+@click.option("-b", "--batch-size", type=int, multiple=True, help="publish_many sizes")
+@click.option("-u", "--max-unconfirmed", type=int, default=None)
+@click.option(
+    "-k", "--codec", type=click.Choice(CODECS), multiple=True, help="payload codecs"
+)
+def main(exchange, topic, n_events, batch_size, max_unconfirmed, codec):
+    """Pushes events through a (topic) exchange and reports the throughput
+    of: one 'send_message' per event without confirms, and 'publish_many'
+    batches with pipelined publisher confirms (all confirmed at the end),
+    for each payload codec.
+
+    Bind a queue to the topic to account for the broker routing / storage.
+    """
+    host, port = get_amqp_uri_from_env()
+    events = make_events(n_events)
+    runs = []
+    for name in codec or ["json"]:
+        runs.append((name, "send_message", None, False))
+        runs += [
+            (name, "publish_many", size, True) for size in batch_size or [100, 1000]
+        ]
+
+    table = Table(title=f"{n_events} events -> {exchange} ({topic})")
+    table.add_column("Codec", style="magenta")
+    table.add_column("Mode", style="magenta")
+    for column in ["Batch", "Confirms", "Payload (B)", "msg / s", "p95 publish (ms)"]:
+        table.add_column(column, justify="right", style="cyan")
+
+    for name, mode, size, confirm in runs:
+        publisher = BlockingQueuePublisher(
+            host=host,
+            port=port,
+            exchange_name=exchange,
+            exchange_type="topic",
+            outbox_size=n_events,
+            confirm=confirm,
+            max_unconfirmed=max_unconfirmed,
+            codec=name,
+        )
+        start = time.perf_counter()
+        if mode == "send_message":
+            for event in events:
+                publisher.send_message(event, topic=topic)
+        else:
+            for i in range(0, n_events, size):
+                publisher.publish_many(events[i : i + size], topic=topic)
+            if not publisher.wait_for_confirms():
+                console.print("[red]Not every message got confirmed![/red]")
+
+        elapsed = time.perf_counter() - start
+        stats = publisher.stats
+        publisher.close()
+        table.add_row(
+            name,
+            mode,
+            str(size or 1),
+            "yes" if confirm else "no",
+            str(len(get_codec(name).dumps(events[0]))),
+            f"{stats['published'] / elapsed:.0f}",
+            str(stats.get("latency_ms", {}).get("p95")),
+        )
+
+    console.print(table)
+
+
+if __name__ == "__main__":
+    # python -m scripts.bench_rabbit -n 20000 -b 100 -b 1000
+    main()
@@ -0,0 +1,294 @@
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import click
+import numpy as np
+import scipy.io.wavfile as wf
+from rich.console import Console
+from rich.table import Table
+
+from asr import calc_block_size
+from asr.endpointer import Endpointer
+from asr.vad import EnergyGate, VAD
+from common.vad import VoiceActivityDetector
+
+console = Console()
+
+FIXTURES_DIR = Path("assets") / "vad"
+LABELS_FILE = "labels.json"
+SAMPLE_RATE = 16000
+BLOCK_MS = 250  # audio blocks as streamed by the ASR client
+GRID_MS = 10  # resolution of the frame-level metrics
+
+# Short parameter names for the results table
+PARAM_NAMES = {"aggressiveness": "aggr", "voice_th": "th", "threshold": "th"}
+
+Segments = List[Tuple[float, float]]
+
+
+# =============== Fixtures ================
+
+
+def _voiced(rng, seconds: float) -> np.ndarray:
+    """Harmonic signal with a wobbling pitch and syllable-like envelope"""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    f0 = rng.uniform(100, 220)
+    phase = 2 * np.pi * np.cumsum(f0 * (1 + 0.1 * np.sin(2 * np.pi * 3 * t)))
+    phase /= SAMPLE_RATE
+    x = sum(
+        np.sin(k * phase) / k * (1.0 if 300 < k * f0 < 3400 else 0.3)
+        for k in range(1, 25)
+    )
+    return x * (0.6 + 0.4 * np.sin(2 * np.pi * rng.uniform(3, 5) * t) ** 2)
+
+
+def _background(rng, kind: str, seconds: float) -> np.ndarray:
+    n = int(seconds * SAMPLE_RATE)
+    if kind == "quiet":
+        return rng.standard_normal(n) * 50
+    if kind == "noisy":
+        return rng.standard_normal(n) * 1000
+
+    # engine like hum with some noise on top
+    t = np.arange(n) / SAMPLE_RATE
+    hum = sum(np.sin(2 * np.pi * 90 * k * t) / k for k in range(1, 4))
+    return hum * 1500 + rng.standard_normal(n) * 300
+
+
+def make_fixture(kind: str, seed: int) -> Tuple[np.ndarray, Segments]:
+    """Three 'utterances' over the given background"""
+    rng = np.random.default_rng(seed)
+    seconds = 8.0
+    audio = _background(rng, kind, seconds)
+    labels = []
+    start = rng.uniform(0.5, 1.0)
+    for _ in range(3):
+        duration = rng.uniform(0.6, 1.4)
+        i = int(start * SAMPLE_RATE)
+        voiced = _voiced(rng, duration) * 3000
+        audio[i : i + len(voiced)] += voiced
+        labels.append((round(start, 3), round(start + duration, 3)))
+        start += duration + rng.uniform(0.8, 1.5)
+
+    return np.clip(audio, -32768, 32767).astype("int16"), labels
+
+
+# =============== Detectors ================
+
+
+def run_webrtc(
+    audio: np.ndarray, aggressiveness: int, voice_th: float, gate: bool
+) -> Tuple[Segments, List[float], int]:
+    """Speech segments, time (seconds of audio) at which each END event
+    was available and number of VAD frames
+    """
+    vad = VAD(aggressiveness, gate=EnergyGate() if gate else None)
+    endpointer = Endpointer(vad, SAMPLE_RATE, voice_th=voice_th)
+    block_size = calc_block_size(BLOCK_MS, SAMPLE_RATE)
+    segments, ends_at = [], []
+    for i in range(0, len(audio), block_size):
+        for kind, offset in endpointer.process(audio[i : i + block_size].tobytes()):
+            if kind == Endpointer.START:
+                start = offset / SAMPLE_RATE
+            else:
+                segments.append((start, offset / SAMPLE_RATE))
+                ends_at.append(endpointer.seconds)
+
+    if endpointer.in_speech:
+        segments.append((start, endpointer.seconds))
+        ends_at.append(endpointer.seconds)
+
+    return segments, ends_at, endpointer.samples // endpointer.frame_size
+
+
+def run_fft(wav_file: str, threshold: float) -> Tuple[Segments, List[float], int]:
+    vad = VoiceActivityDetector(wav_file)
+    vad.speech_energy_threshold = threshold
+    segments = [(s["speech_begin"], s["speech_end"]) for s in vad.stream_speech()]
+    window = int(vad.rate * vad.sample_window)
+    hop = int(vad.rate * vad.sample_overlap)
+    n_windows = -(-(len(vad.data) - window) // hop)
+    # Offline detector: the end of speech is known at the interval end
+    return segments, [end for _, end in segments], n_windows
+
+
+def detectors() -> List[Tuple[str, Dict]]:
+    settings = []
+    for aggressiveness in range(4):
+        for voice_th in [0.5, 0.9]:
+            settings.append(
+                (
+                    "webrtc",
+                    {
+                        "aggressiveness": aggressiveness,
+                        "voice_th": voice_th,
+                        "gate": False,
+                    },
+                )
+            )
+    settings.append(("webrtc", {"aggressiveness": 2, "voice_th": 0.9, "gate": True}))
+    for threshold in [0.5, 0.6, 0.7]:
+        settings.append(("fft", {"threshold": threshold}))
+
+    return settings
+
+
+# =============== Metrics ================
+
+
+def _grid(segments: Segments, n: int) -> np.ndarray:
+    centers = (np.arange(n) + 0.5) * GRID_MS / 1000
+    mask = np.zeros(n, dtype=bool)
+    for start, end in segments:
+        mask |= (start <= centers) & (centers < end)
+    return mask
+
+
+def score(
+    labels: Segments, segments: Segments, ends_at: List[float], seconds: float
+) -> Dict:
+    n = int(seconds * 1000 / GRID_MS)
+    truth, pred = _grid(labels, n), _grid(segments, n)
+    tp = int(np.sum(truth & pred))
+    latencies = []
+    for start, end in labels:
+        # The first detected segment overlapping the labeled one
+        for (s, e), end_at in zip(segments, ends_at):
+            if s < end and e > start:
+                latencies.append(end_at - end)
+                break
+
+    return {
+        "tp": tp,
+        "fp": int(np.sum(~truth & pred)),
+        "fn": int(np.sum(truth & ~pred)),
+        "latencies": latencies,
+        "missed": len(labels) - len(latencies),
+    }
+
+
+def _ratio(a: int, b: int) -> float:
+    return a / b if b else 0.0
+
+
+# =============== CLI ================
+
+
+@click.group()
+def cli():
+    """VAD accuracy and speed benchmark over labeled audio fixtures"""
+
+
+@cli.command()
+@click.option("-d", "--fixtures-dir", default=FIXTURES_DIR)
+def make_fixtures(fixtures_dir):
+    """(Re)generates the synthetic labeled fixtures"""
+    fixtures_dir = Path(fixtures_dir)
+    fixtures_dir.mkdir(parents=True, exist_ok=True)
+    labels = {}
+    for seed, kind in enumerate(["quiet", "noisy", "hum"]):
+        audio, labels[f"{kind}.wav"] = make_fixture(kind, seed)
+        wf.write(fixtures_dir / f"{kind}.wav", SAMPLE_RATE, audio)
+
+    with (fixtures_dir / LABELS_FILE).open("w") as f:
+        json.dump(labels, f, indent=2)
+
+    console.print(f"💾 {len(labels)} fixtures written to {fixtures_dir}")
+
+
+@cli.command()
+@click.option("-d", "--fixtures-dir", default=FIXTURES_DIR)
+@click.option("-o", "--output", help="write the results as JSON to this file")
+@click.option("-n", "--repeat", type=int, default=3, help="timing repetitions")
+def run(fixtures_dir, output, repeat):
+    """Runs every detector setting over the fixtures"""
+    fixtures_dir = Path(fixtures_dir)
+    with (fixtures_dir / LABELS_FILE).open() as f:
+        labels = json.load(f)
+
+    fixtures = {}
+    for name in labels:
+        wav_file = str(fixtures_dir / name)
+        rate, audio = wf.read(wav_file)
+        assert rate == SAMPLE_RATE, f"{name}: fixtures must be {SAMPLE_RATE} Hz"
+        fixtures[name] = (wav_file, audio)
+
+    results = []
+    for detector, params in detectors():
+        totals = {"tp": 0, "fp": 0, "fn": 0, "missed": 0, "latencies": []}
+        cpu_s = audio_s = 0.0
+        n_frames = 0
+        for name, (wav_file, audio) in fixtures.items():
+            best = None
+            for _ in range(repeat):
+                start = time.process_time()
+                if detector == "webrtc":
+                    out = run_webrtc(audio, **params)
+                else:
+                    out = run_fft(wav_file, **params)
+                elapsed = time.process_time() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            segments, ends_at, frames = out
+            seconds = len(audio) / SAMPLE_RATE
+            cpu_s, audio_s, n_frames = (
+                cpu_s + best,
+                audio_s + seconds,
+                n_frames + frames,
+            )
+            scores = score(labels[name], segments, ends_at, seconds)
+            for k in totals:
+                totals[k] += scores[k]
+
+        latencies = totals["latencies"]
+        results.append(
+            {
+                "detector": detector,
+                "params": params,
+                "fps": round(n_frames / cpu_s, 1) if cpu_s else None,
+                "rtf": round(cpu_s / audio_s, 5),
+                "precision": round(
+                    _ratio(totals["tp"], totals["tp"] + totals["fp"]), 3
+                ),
+                "recall": round(_ratio(totals["tp"], totals["tp"] + totals["fn"]), 3),
+                "endpoint_latency_ms": (
+                    round(1000 * float(np.mean(latencies))) if latencies else None
+                ),
+                "missed": totals["missed"],
+            }
+        )
+
+    table = Table(title=f"VAD benchmark on {len(fixtures)} fixtures ({audio_s:.1f}s)")
+    table.add_column("Detector", style="magenta")
+    table.add_column("Params")
+    for column in ["Frames/s", "RTF", "Precision", "Recall", "End latency (ms)"]:
+        table.add_column(column, justify="right", style="cyan")
+    table.add_column("Missed", justify="right")
+    for r in results:
+        params = " ".join(
+            f"{PARAM_NAMES.get(k, k)}={v}" for k, v in r["params"].items()
+        )
+        table.add_row(
+            r["detector"],
+            params,
+            "-" if r["fps"] is None else f"{r['fps']:.0f}",
+            f"{r['rtf']:.4f}",
+            f"{r['precision']:.3f}",
+            f"{r['recall']:.3f}",
+            "-" if r["endpoint_latency_ms"] is None else str(r["endpoint_latency_ms"]),
+            str(r["missed"]),
+        )
+
+    console.print(table)
+    if output:
+        with Path(output).open("w") as f:
+            json.dump({"audio_s": round(audio_s, 3), "results": results}, f, indent=2)
+        console.print(f"💾 Results written to {output}")
+
+
+if __name__ == "__main__":
+    # python -m scripts.bench_vad make-fixtures
+    # python -m scripts.bench_vad run -o vad-bench.json
+    cli()
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import timeit
+
+import click
+import numpy as np
+import scipy.io.wavfile as wf
+from rich.console import Console
+from rich.table import Table
+
+from common.vad import VoiceActivityDetector
+
+console = Console()
+
+
+class LegacyVoiceActivityDetector(VoiceActivityDetector):
+    """VoiceActivityDetector.detect_speech as it was before vectorizing it"""
+
+    def _legacy_energy_freq(self, data):
+        data_freq = np.fft.fftfreq(len(data), 1.0 / self.rate)[1:]
+        data_energy = np.abs(np.fft.fft(data))[1:] ** 2
+        energy_freq = {}
+        for i, freq in enumerate(data_freq):
+            if abs(freq) not in energy_freq:
+                energy_freq[abs(freq)] = data_energy[i] * 2
+        return energy_freq
+
+    def detect_speech(self):
+        detected_windows = np.array([])
+        sample_window = int(self.rate * self.sample_window)
+        sample_overlap = int(self.rate * self.sample_overlap)
+        data = self.data
+        sample_start = 0
+        while sample_start < (len(data) - sample_window):
+            sample_end = sample_start + sample_window
+            energy_freq = self._legacy_energy_freq(data[sample_start:sample_end])
+            sum_voice_energy = 0
+            for f in energy_freq:
+                if self.speech_start_band < f < self.speech_end_band:
+                    sum_voice_energy += energy_freq[f]
+            speech_ratio = sum_voice_energy / sum(energy_freq.values())
+            speech_ratio = speech_ratio > self.speech_energy_threshold
+            detected_windows = np.append(detected_windows, [sample_start, speech_ratio])
+            sample_start += sample_overlap
+        detected_windows = detected_windows.reshape(int(len(detected_windows) / 2), 2)
+        detected_windows[:, 1] = self._smooth_speech_detection(detected_windows)
+
+        return detected_windows
+
+
+def synth_recording(wav_file: str, minutes: float, sample_rate: int = 16000):
+    """Alternating 'speech' (voice band tones) and noise segments"""
+    rng = np.random.default_rng(0)
+    t = np.arange(sample_rate) / sample_rate
+    seconds = []
+    for i in range(int(minutes * 60)):
+        noise = rng.standard_normal(sample_rate) * 300
+        if i % 3 == 0:
+            f0 = rng.uniform(150, 400)
+            tone = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6))
+            noise = noise * 0.2 + tone * 4000
+        seconds.append(noise)
+
+    wf.write(wav_file, sample_rate, np.concatenate(seconds).astype("int16"))
+
+
+@click.command()
+@click.argument("wav_file", type=click.Path(dir_okay=False), required=False)
+@click.option(
+    "-m", "--minutes", type=float, default=10, help="synthetic recording length"
+)
+@click.option("-n", "--repeat", type=int, default=1, help="timing repetitions")
+def main(wav_file, minutes, repeat):
+    """Benchmark of VoiceActivityDetector.detect_speech against the legacy
+    (per window) implementation on a WAV file, or a synthetic recording of
+    the given length if none is given
+    """
+    tmp_dir = None
+    if wav_file is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        wav_file = os.path.join(tmp_dir.name, "recording.wav")
+        synth_recording(wav_file, minutes)
+
+    detectors = [
+        ("legacy", LegacyVoiceActivityDetector(wav_file)),
+        ("vectorized", VoiceActivityDetector(wav_file)),
+    ]
+    audio_s = len(detectors[0][1].data) / detectors[0][1].rate
+
+    table = Table(title=f"detect_speech on {audio_s:.1f}s of audio")
+    table.add_column("Implementation", style="magenta")
+    table.add_column("Best run (s)", justify="right", style="cyan")
+    table.add_column("x real time", justify="right", style="green")
+    labels = []
+    for name, vad in detectors:
+        labels.append(vad.detect_speech())
+        best = min(timeit.repeat(vad.detect_speech, number=1, repeat=repeat))
+        table.add_row(name, f"{best:.3f}", f"{audio_s / best:.0f}")
+
+    console.print(table)
+    if not np.array_equal(*labels):
+        console.print("[yellow]Speech labels differ![/yellow]")
+
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    # python -m scripts.bench_vad_detect [some-recording.wav]
+    main()
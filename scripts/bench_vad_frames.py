@@ -0,0 +1,73 @@
+import timeit
+import wave
+
+import click
+from funcy import chunks
+from rich.console import Console
+from rich.table import Table
+
+from asr import calc_block_size
+from asr.vad import VAD
+
+console = Console()
+
+
+def legacy_is_voice(vad: VAD, pcm_data, sample_rate: int, vad_block_ms: int = 30):
+    """VAD.is_voice as it was before the zero-copy frame iterator"""
+    if vad_block_ms not in vad.VALID_BLOCK_MS:
+        raise ValueError(f"vad_block_ms must be one of {vad.VALID_BLOCK_MS}")
+
+    vads = []
+    vad_bytes = 2 * calc_block_size(vad_block_ms, sample_rate)  # int16 pcm data
+    for pcm_chunk in chunks(vad_bytes, pcm_data):
+        _is_speech = vad.vad.is_speech(pcm_chunk, int(sample_rate))
+        vads.append(_is_speech)
+
+    return len(vads) and sum(vads) >= vad.voice_th * len(vads)
+
+
+@click.command()
+@click.argument("wav_file", type=click.Path(dir_okay=False, exists=True))
+@click.option("-b", "--block-size", type=int, default=4000, help="audio block size")
+@click.option("-m", "--vad-block-ms", type=int, default=30, help="VAD frame ms")
+@click.option("-v", "--vad-aggressiveness", type=int, default=2)
+@click.option("-n", "--repeat", type=int, default=5, help="timing repetitions")
+def main(wav_file, block_size, vad_block_ms, vad_aggressiveness, repeat):
+    """Micro-benchmark of VAD.is_voice against the legacy implementation on
+    the blocks of a recorded (16 bits mono) WAV file
+    """
+    with wave.open(wav_file, "rb") as wf:
+        sample_rate = wf.getframerate()
+        pcm_data = wf.readframes(wf.getnframes())
+
+    block_bytes = 2 * block_size
+    blocks = [
+        pcm_data[i : i + block_bytes]
+        for i in range(0, len(pcm_data) - block_bytes + 1, block_bytes)
+    ]
+    audio_s = len(blocks) * block_size / sample_rate
+    vad = VAD(vad_aggressiveness)
+
+    def run_legacy():
+        return [legacy_is_voice(vad, b, sample_rate, vad_block_ms) for b in blocks]
+
+    def run_current():
+        return [vad.is_voice(b, sample_rate, vad_block_ms) for b in blocks]
+
+    if list(map(bool, run_legacy())) != run_current():
+        console.print("[yellow]Block decisions differ![/yellow]")
+
+    table = Table(title=f"VAD.is_voice on {len(blocks)} blocks ({audio_s:.1f}s)")
+    table.add_column("Implementation", style="magenta")
+    table.add_column("Best run (ms)", justify="right", style="cyan")
+    table.add_column("µs / block", justify="right", style="green")
+    for name, func in [("legacy", run_legacy), ("current", run_current)]:
+        best = min(timeit.repeat(func, number=1, repeat=repeat))
+        table.add_row(name, f"{best * 1000:.2f}", f"{best / len(blocks) * 1e6:.1f}")
+
+    console.print(table)
+
+
+if __name__ == "__main__":
+    # python -m scripts.bench_vad_frames some-recording.wav
+    main()
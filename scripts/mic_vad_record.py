@@ -1,14 +1,18 @@
-import queue
 import sys
 import tempfile
+from typing import Optional
 
 import click
+import numpy as np
 import sounddevice as sd
 import soundfile as sf
 from halo import Halo
 from rich.console import Console
 
-from asr import calc_block_ms, raw_stream_to_numpy
+from asr import raw_stream_to_numpy
+from asr.buffer import BlockPool
+from asr.capture import CaptureSource, SharedCapture
+from asr.endpointer import Endpointer
 from asr.vad import VAD
 from common import int_or_str
 from respeaker.pixels import Pixels
@@ -25,24 +29,43 @@ def record_to_file(
     audio_subtype: str,
     device: str,
     max_silence_ms: int = 1500,
+    capture: Optional[CaptureSource] = None,
 ):
     def _callback(indata, frames, time, status):
         """This is called (from a separate thread) for each audio block."""
         if status:
             console.print(status, file=sys.stderr)
 
-        q.put(bytes(indata))
+        pool.put(indata)
+
+    def _pooled_blocks():
+        while True:
+            yield pool.get()
+            # the block has been processed and its slot can be reused
+            pool.release()
+
+    def _record(blocks):
+        endpointer = Endpointer(vad, sample_rate, hangover_ms=max_silence_ms)
+        with Halo(f"Recoding to {fname}...\n"):
+            pixels.think()
+            for pcm_data in blocks:
+                audio = raw_stream_to_numpy(pcm_data, "int16", n_channels)
+                sfile.write(audio)
+
+                # check VAD (on the first channel)
+                events = endpointer.process(np.ascontiguousarray(audio[:, 0]))
+                no_speech = (
+                    endpointer.speech_start is None
+                    and endpointer.seconds * 1000 >= max_silence_ms
+                )
+                if no_speech or any(k == Endpointer.END for k, _ in events):
+                    pixels.off()
+                    console.print("\nStopping recoding...", style="dim")
+                    break
 
     try:
         pixels = Pixels()
-        q = queue.Queue()
-
-        stop = 0
-        block_ms = calc_block_ms(block_size, sample_rate)
-        max_silence_blocks = int(max_silence_ms / block_ms)
-
-        # console.print(f"block ms: {block_ms}", style="dim")
-        # console.print(f"max silence blocks: {max_silence_blocks}", style="dim")
+        pool = BlockPool(n_blocks=32, block_bytes=2 * block_size * n_channels)
 
         # Make sure the file is opened before recording anything:
         with sf.SoundFile(
@@ -52,6 +75,12 @@ def record_to_file(
             channels=n_channels,
             subtype=audio_subtype,
         ) as sfile:
+            if capture is not None:
+                # Read from the shared capture buffer (all the channels)
+                stream = capture.stream(channel=None)
+                _record(iter(lambda: stream.read(2 * block_size * n_channels), None))
+                return
+
             with sd.RawInputStream(
                 device=device,
                 channels=n_channels,
@@ -59,22 +88,11 @@ def record_to_file(
                 samplerate=sample_rate,
                 callback=_callback,
                 dtype="int16",
-            ) as device:
-                with Halo(f"Recoding to {fname}...\n"):
-                    pixels.think()
-                    while True:
-                        pcm_data = q.get()
-
-                        # check VAD
-                        stop += int(not vad.is_voice(pcm_data, sample_rate))
-                        if stop > max_silence_blocks:
-                            pixels.off()
-                            console.print("\nStopping recoding...", style="dim")
-                            break
-
-                        sfile.write(
-                            raw_stream_to_numpy(pcm_data, device.dtype, device.channels)
-                        )
+            ):
+                _record(_pooled_blocks())
+
+            if pool.overruns:
+                console.print(f"Dropped audio blocks: {pool.stats}", style="yellow")
 
     except KeyboardInterrupt:
         console.print("\nRecording finished: " + repr(fname))
@@ -99,6 +117,11 @@ def record_to_file(
 @click.option(
     "-v", "--vad-aggressiveness", type=int, help="VAD aggressiveness", default=2
 )
+@click.option(
+    "-x",
+    "--capture-name",
+    help="attach to a running capture worker instead of opening the device",
+)
 def main(
     filename,
     list_devices,
@@ -108,6 +131,7 @@ def main(
     blocksize,
     subtype,
     vad_aggressiveness,
+    capture_name,
 ):
     if list_devices:
         console.print(sd.query_devices())
@@ -124,6 +148,11 @@ def main(
         console.print("#" * 80)
 
         vad = VAD(vad_aggressiveness)
+        capture = None
+        if capture_name:
+            capture = SharedCapture(capture_name)
+            samplerate, channels = capture.sample_rate, capture.channels
+
         i = 0
         while True:
             record_to_file(
@@ -134,6 +163,7 @@ def main(
                 channels,
                 subtype,
                 device,
+                capture=capture,
             )
             i += 1
 
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import click
+import numpy as np
+import soundfile as sf
+from rich.console import Console
+
+from asr import calc_block_size
+from asr.endpointer import Endpointer
+from asr.vad import VAD
+from common.vad import VoiceActivityDetector
+
+console = Console()
+
+ENGINES = ["fft", "webrtc"]
+HASH_BLOCK_BYTES = 1 << 20
+
+
+# Errors of a (corrupt / unreadable) file recorded in the index
+FILE_ERRORS = (OSError, RuntimeError, ValueError, EOFError)
+
+
+def file_hash(wav_file: str) -> Tuple[str, Optional[str]]:
+    """File content hash (None if the file can't be read)"""
+    h = hashlib.sha1()
+    try:
+        with Path(wav_file).open("rb") as f:
+            for data in iter(lambda: f.read(HASH_BLOCK_BYTES), b""):
+                h.update(data)
+    except OSError:
+        return wav_file, None
+
+    return wav_file, h.hexdigest()
+
+
+def _fft_segments(wav_file: str) -> List[Tuple[float, float]]:
+    try:
+        vad = VoiceActivityDetector(wav_file, mmap=True)
+    except ValueError:
+        # e.g. 24 bits WAV files can't be memory-mapped
+        vad = VoiceActivityDetector(wav_file)
+
+    # Speech lasting until the end of the file is a segment (as with webrtc)
+    segments = vad.stream_speech(until_end=True)
+    return [(s["speech_begin"], s["speech_end"]) for s in segments]
+
+
+def _webrtc_segments(
+    wav_file: str, vad_aggressiveness: int, block_ms: int = 250
+) -> List[Tuple[float, float]]:
+    sample_rate = sf.info(wav_file).samplerate
+    endpointer = Endpointer(VAD(vad_aggressiveness), sample_rate)
+    block_size = calc_block_size(block_ms, sample_rate)
+
+    segments = []
+    for block in sf.blocks(wav_file, block_size, dtype="int16", always_2d=True):
+        # VAD on the first channel
+        for kind, offset in endpointer.process(np.ascontiguousarray(block[:, 0])):
+            if kind == Endpointer.START:
+                start = offset / sample_rate
+            else:
+                segments.append((start, offset / sample_rate))
+
+    if endpointer.in_speech:
+        segments.append((start, endpointer.seconds))
+
+    # The start padding can overlap the previous segment
+    merged = []
+    for start, end in segments:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def segment_file(wav_file: str, settings: Dict) -> Dict:
+    """Speech segments of a single file (run in the worker processes). If
+    the file can't be processed the entry has just the 'error'
+    """
+    try:
+        if settings["engine"] == "fft":
+            segments = _fft_segments(wav_file)
+        else:
+            segments = _webrtc_segments(wav_file, settings["vad_aggressiveness"])
+        duration = sf.info(wav_file).duration
+    except FILE_ERRORS as e:
+        return {"file": wav_file, "error": f"{type(e).__name__}: {e}"}
+
+    speech_s = sum(end - start for start, end in segments)
+    return {
+        "file": wav_file,
+        "duration": round(duration, 3),
+        "speech_ratio": round(speech_s / duration, 3) if duration else 0.0,
+        "segments": [[round(s, 3), round(e, 3)] for s, e in segments],
+    }
+
+
+def load_index(index_file: str, settings: Dict) -> Dict[str, Dict]:
+    """Previous results by file hash (if computed with the same settings)"""
+    index_path = Path(index_file)
+    if not index_path.exists():
+        return {}
+
+    with index_path.open() as f:
+        index = json.load(f)
+
+    if index.get("settings") != settings:
+        console.print("[yellow]VAD settings changed, ignoring cached results[/yellow]")
+        return {}
+
+    # Files that failed are processed again
+    return {entry["hash"]: entry for entry in index["files"] if "error" not in entry}
+
+
+def find_files(inputs: List[str]) -> List[str]:
+    """WAV files in the given directories (recursively) or glob patterns"""
+    files = []
+    for path in map(Path, inputs):
+        if path.is_dir():
+            files.extend(path.rglob("*.wav"))
+        elif path.is_absolute():
+            files.extend(Path(path.anchor).glob(str(path.relative_to(path.anchor))))
+        else:
+            files.extend(Path().glob(str(path)))
+
+    return sorted({str(f) for f in files})
+
+
+@click.command()
+@click.argument("inputs", nargs=-1, required=True)
+@click.option("-o", "--output", default="segments.json", help="segment index file")
+@click.option("-e", "--engine", type=click.Choice(ENGINES), default="fft")
+@click.option(
+    "-v", "--vad-aggressiveness", type=int, help="VAD aggressiveness", default=2
+)
+@click.option("-j", "--jobs", type=int, default=os.cpu_count(), help="processes")
+def main(inputs, output, engine, vad_aggressiveness, jobs):
+    """Segments the speech of every WAV file in the given directories or
+    glob patterns across a pool of processes, writing a single JSON index
+    with the segments (start, end seconds) and speech ratio of each file.
+
+    Results are cached by file content hash in the index itself, so re-runs
+    only process new or modified files.
+    """
+    settings = {"engine": engine}
+    if engine == "webrtc":
+        settings["vad_aggressiveness"] = vad_aggressiveness
+
+    files = find_files(inputs)
+    cached = load_index(output, settings)
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        hashes = dict(pool.map(file_hash, files, chunksize=16))
+        errors = {f: "Can't read the file" for f, h in hashes.items() if h is None}
+        todo = [f for f in files if f not in errors and hashes[f] not in cached]
+        results = pool.map(segment_file, todo, [settings] * len(todo), chunksize=4)
+        for result in results:
+            if "error" in result:
+                errors[result["file"]] = result["error"]
+            else:
+                cached[hashes[result["file"]]] = result
+
+    entries = []
+    for wav_file in files:
+        if wav_file in errors:
+            console.print(f"[red]{wav_file}: {errors[wav_file]}[/red]")
+            entry = {"file": wav_file, "hash": hashes[wav_file]}
+            entry["error"] = errors[wav_file]
+        else:
+            entry = dict(cached[hashes[wav_file]], hash=hashes[wav_file])
+            entry["file"] = wav_file
+        entries.append(entry)
+
+    with Path(output).open("w") as f:
+        json.dump({"settings": settings, "files": entries}, f, separators=(",", ":"))
+
+    elapsed = time.time() - start
+    processed = set(todo)
+    audio_s = sum(e.get("duration", 0) for e in entries if e["file"] in processed)
+    n_cached = len([f for f in files if f not in processed and f not in errors])
+    console.print(
+        f"🗂️  {len(files)} files ({len(todo)} processed, "
+        f"{n_cached} cached, {len(errors)} failed) "
+        f"in {elapsed:.1f}s using {jobs} processes ({audio_s:.0f}s of audio) "
+        f"-> {output}"
+    )
+
+
+if __name__ == "__main__":
+    # python -m scripts.vad_segment recordings/ -o recordings/segments.json
+    main()
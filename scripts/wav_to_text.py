@@ -11,6 +11,7 @@ from asr.client import ASRClient
 async def wav_to_text(asr_uri: str, wav_file: str):
     client = ASRClient(asr_uri, vad=None)
     res = await client.from_wave(wav_file)
+    await client.sessions.close()
 
     return res["text"]
 
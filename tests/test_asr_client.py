@@ -0,0 +1,236 @@
+import asyncio
+import json
+from contextlib import suppress
+
+import pytest
+import websockets
+
+from asr.client import ASRClient, ASRSession, ASRSessionPool
+from asr.vad import VAD
+
+SAMPLE_RATE = 16000
+SILENCE = bytes(2 * ASRClient.ASR_BLOCK_SIZE)  # 250ms of int16 audio
+
+
+class _Pixels:
+    def speak(self):
+        pass
+
+    def off(self):
+        pass
+
+
+class _WebSocket:
+    """ASR server answering each audio block with a partial result and the
+    'reset' message with the final one. Answers are held until 'answer' is set
+    """
+
+    def __init__(self, text="lights on"):
+        self.text = text
+        self.sent = []
+        self.closed = False
+        self.pings = 0
+        self.ping_s = 0.0
+        self.answer = asyncio.Event()
+        self.answer.set()
+        self._replies = asyncio.Queue()
+
+    async def send(self, data):
+        self.sent.append(data)
+        if data == ASRSession.RESET_MSG:
+            reply = {"text": self.text}
+        elif isinstance(data, str):
+            reply = {}  # config message
+        else:
+            reply = {"partial": self.text}
+        self._replies.put_nowait(json.dumps(reply))
+
+    async def recv(self):
+        await self.answer.wait()
+        return await self._replies.get()
+
+    async def ping(self):
+        self.pings += 1
+        await asyncio.sleep(self.ping_s)
+        if self.closed:
+            raise OSError("Connection lost")
+        pong = asyncio.get_running_loop().create_future()
+        pong.set_result(None)
+        return pong
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Fake websockets opened by the ASR sessions, in order"""
+    opened = []
+
+    async def connect(uri):
+        opened.append(_WebSocket())
+        return opened[-1]
+
+    monkeypatch.setattr(websockets, "connect", connect)
+    return opened
+
+
+async def _silence():
+    while True:
+        yield SILENCE
+
+
+def test_stream_sends_audio_without_waiting_for_results():
+    async def stream():
+        client = ASRClient("ws://asr", VAD(1), _Pixels(), max_in_flight=3)
+        websocket = _WebSocket()
+        websocket.answer.clear()
+        streaming = asyncio.ensure_future(
+            client._stream(websocket, _silence(), SAMPLE_RATE)
+        )
+        await asyncio.sleep(0.05)
+        # Up to 'max_in_flight' blocks sent while no result came back
+        sent_before_answers = len(websocket.sent)
+
+        websocket.answer.set()
+        text = await asyncio.wait_for(streaming, timeout=5)
+        return text, sent_before_answers, websocket.sent
+
+    text, sent_before_answers, sent = asyncio.run(stream())
+
+    assert sent_before_answers == 3
+    assert text == "lights on"
+    # Stops after 3s (12 blocks) without voice and ends the utterance
+    assert sent == [SILENCE] * 12 + [ASRSession.RESET_MSG]
+
+
+def test_stream_ends_the_utterance_with_the_audio():
+    async def blocks():
+        for _ in range(2):
+            yield SILENCE
+
+    async def stream():
+        client = ASRClient("ws://asr", VAD(1), _Pixels())
+        websocket = _WebSocket()
+        text = await asyncio.wait_for(
+            client._stream(websocket, blocks(), SAMPLE_RATE), timeout=5
+        )
+        return text, websocket.sent
+
+    text, sent = asyncio.run(stream())
+
+    assert text == "lights on"
+    assert sent == [SILENCE, SILENCE, ASRSession.RESET_MSG]
+
+
+def test_pool_reuses_sessions(connections):
+    async def borrow_twice():
+        pool = ASRSessionPool("ws://asr")
+        await pool.start(SAMPLE_RATE)
+        async with pool.session(SAMPLE_RATE) as first:
+            pass
+        async with pool.session(SAMPLE_RATE) as second:
+            pass
+        await pool.close()
+        return first, second, pool.stats
+
+    first, second, stats = asyncio.run(borrow_twice())
+
+    assert first is second
+    assert stats["connects"] == 1
+    assert connections[0].sent == [ASRSession.CONFIG_MSG % SAMPLE_RATE]
+
+
+def test_pool_replaces_dead_sessions(connections):
+    async def borrow():
+        pool = ASRSessionPool("ws://asr")
+        await pool.start(SAMPLE_RATE)
+        connections[0].closed = True
+        async with pool.session(SAMPLE_RATE) as session:
+            pass
+        return session, pool.stats
+
+    session, stats = asyncio.run(borrow())
+
+    assert session.websocket is connections[1]
+    assert stats["reconnects"] == 1
+
+
+def test_pool_opens_a_session_for_another_sample_rate(connections):
+    async def borrow():
+        pool = ASRSessionPool("ws://asr")
+        await pool.start(SAMPLE_RATE)
+        async with pool.session(8000) as session:
+            pass
+        return session
+
+    session = asyncio.run(borrow())
+
+    assert session.websocket is connections[1]
+    assert session.sample_rate == 8000
+    assert connections[1].sent == [ASRSession.CONFIG_MSG % 8000]
+    assert connections[0].closed
+
+
+def test_pool_closes_the_session_of_a_cancelled_utterance(connections):
+    async def cancel():
+        pool = ASRSessionPool("ws://asr")
+        await pool.start(SAMPLE_RATE)
+        borrowed = asyncio.Event()
+
+        async def utterance():
+            async with pool.session(SAMPLE_RATE):
+                borrowed.set()
+                await asyncio.sleep(10)
+
+        task = asyncio.ensure_future(utterance())
+        await borrowed.wait()
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+        return pool._idle
+
+    idle = asyncio.run(cancel())
+
+    # Its state is unknown: not given back to the pool
+    assert connections[0].closed
+    assert idle == []
+
+
+def test_keepalive_does_not_lend_the_session_being_pinged(connections):
+    async def borrow_while_pinging():
+        pool = ASRSessionPool("ws://asr")
+        pool.PING_EVERY_S = 0.01
+        await pool.start(SAMPLE_RATE)
+        connections[0].ping_s = 0.1
+        while not connections[0].pings:
+            await asyncio.sleep(0.005)
+
+        async with pool.session(SAMPLE_RATE) as session:
+            pass
+        await pool.close()
+        return session
+
+    session = asyncio.run(asyncio.wait_for(borrow_while_pinging(), timeout=5))
+
+    assert session.websocket is connections[1]
+    assert all(websocket.closed for websocket in connections)
+
+
+def test_keepalive_reopens_dead_sessions(connections):
+    async def keepalive():
+        pool = ASRSessionPool("ws://asr")
+        pool.PING_EVERY_S = 0.01
+        await pool.start(SAMPLE_RATE)
+        connections[0].closed = True
+        while len(connections) < 2:
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0)
+        idle = [session.websocket for session in pool._idle]
+        await pool.close()
+        return idle, pool.stats
+
+    idle, stats = asyncio.run(asyncio.wait_for(keepalive(), timeout=5))
+
+    assert idle == [connections[1]]
+    assert stats["reconnects"] == 1
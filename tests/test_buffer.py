@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import uuid
+
+import numpy as np
+import pytest
+
+from asr.buffer import BlockPool, RingBuffer, RingReader
+
+
+def _block(start, n, channels=1):
+    return (
+        np.arange(start, start + n, dtype="int16")
+        .reshape(-1, 1)
+        .repeat(channels, axis=1)
+    )
+
+
+def test_ring_buffer_write_and_read():
+    ring = RingBuffer(seconds=1, sample_rate=10)
+    ring.write(_block(0, 4), timestamp=100.0)
+
+    assert ring.written == 4
+    np.testing.assert_array_equal(ring.read(1, 3)[:, 0], [1, 2, 3])
+    # Not written yet
+    assert ring.read(2, 3) is None
+
+
+def test_ring_buffer_wraps_around():
+    ring = RingBuffer(seconds=1, sample_rate=10)
+    for i in range(0, 24, 4):
+        ring.write(_block(i, 4))
+
+    assert ring.oldest == 14
+    np.testing.assert_array_equal(ring.read(18, 4)[:, 0], [18, 19, 20, 21])
+    with pytest.raises(IndexError):
+        ring.read(10, 2)
+
+
+def test_ring_buffer_frame_at_timestamp():
+    ring = RingBuffer(seconds=1, sample_rate=10)
+    ring.write(_block(0, 8), timestamp=100.0)
+
+    assert ring.frame_at(100.0) == 8
+    assert ring.frame_at(99.5) == 3
+    # Clamped to the available frames
+    assert ring.frame_at(10.0) == 0
+    assert ring.frame_at(200.0) == 8
+
+
+def test_shared_ring_buffer_attach():
+    name = f"raspvan-test-{uuid.uuid4().hex}"
+    ring = RingBuffer.create_shared(name, seconds=1, sample_rate=10, channels=4)
+    try:
+        other = RingBuffer.attach(name)
+        assert (other.capacity, other.sample_rate, other.channels) == (10, 10, 4)
+
+        ring.write(_block(0, 6, channels=4), timestamp=100.0)
+        reader = RingReader(other, cursor=2)
+        np.testing.assert_array_equal(reader.read(3)[:, 3], [2, 3, 4])
+        assert reader.read(3) is None
+        assert other.last_time == 100.0
+    finally:
+        RingBuffer.unlink(name)
+
+
+def test_shared_ring_buffer_keeps_the_dtype_and_finished_flag():
+    name = f"raspvan-test-{uuid.uuid4().hex}"
+    ring = RingBuffer.create_shared(
+        name, seconds=1, sample_rate=10, channels=2, dtype="float32"
+    )
+    try:
+        other = RingBuffer.attach(name)
+        ring.write(np.full((10, 2), 0.5, dtype="float32"))
+        assert other.read(0, 10).dtype == np.float32
+        np.testing.assert_array_equal(other.read(9, 1), [[0.5, 0.5]])
+
+        assert not other.finished
+        ring.finished = True
+        assert other.finished
+    finally:
+        RingBuffer.unlink(name)
+
+
+def test_ring_reader_counts_overruns():
+    ring = RingBuffer(seconds=1, sample_rate=10)
+    reader = RingReader(ring)
+    for i in range(0, 30, 5):
+        ring.write(_block(i, 5))
+
+    np.testing.assert_array_equal(reader.read(2)[:, 0], [20, 21])
+    assert reader.overruns == 1
+
+
+def test_block_pool_reuses_slots():
+    pool = BlockPool(n_blocks=2, block_bytes=4)
+
+    assert pool.put(b"\x01\x02\x03\x04")
+    assert pool.put(b"\x05\x06")
+    assert not pool.put(b"\x07\x08")
+    assert pool.overruns == 1
+
+    assert bytes(pool.get()) == b"\x01\x02\x03\x04"
+    pool.release()
+    assert bytes(pool.get()) == b"\x05\x06"
+    pool.release()
+
+    assert pool.put(b"\x09\x0a\x0b\x0c")
+    assert bytes(pool.peek()) == b"\x09\x0a\x0b\x0c"
+
+
+def test_block_pool_wakes_up_async_consumer():
+    pool = BlockPool(n_blocks=4, block_bytes=2)
+
+    async def consume():
+        loop = asyncio.get_running_loop()
+        loop.call_later(
+            0.01, lambda: threading.Thread(target=pool.put, args=(b"ab",)).start()
+        )
+        return bytes(await pool.get_async())
+
+    assert asyncio.run(consume()) == b"ab"
+    assert pool.underruns == 1
+
+
+def test_ring_reader_detects_blocks_overwritten_in_use():
+    ring = RingBuffer(seconds=1, sample_rate=10)
+    reader = RingReader(ring, cursor=0)
+    ring.write(_block(0, 4))
+
+    block = reader.read(2)
+    assert not reader.overwritten()
+    ring.write(_block(4, 8))  # wraps around over the block being used
+
+    assert block[0, 0] != 0
+    assert reader.overwritten()
+    assert reader.overruns == 1
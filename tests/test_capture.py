@@ -0,0 +1,97 @@
+import asyncio
+import uuid
+import wave
+
+import numpy as np
+
+from asr.capture import SharedCapture, WavCapture
+
+
+def _write_wav(path, frames, sample_rate=16000):
+    with wave.open(str(path), "wb") as wf:
+        wf.setnchannels(frames.shape[1])
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(frames.astype("int16").tobytes())
+
+
+def test_wav_capture_shared_with_other_readers(tmp_path):
+    frames = np.arange(16000 * 4, dtype="int16").reshape(-1, 4)
+    wav_file = tmp_path / "four-channels.wav"
+    _write_wav(wav_file, frames)
+
+    name = f"raspvan-test-{uuid.uuid4().hex}"
+    capture = WavCapture(str(wav_file), shm_name=name, block_size=800, speed=20)
+    try:
+        shared = SharedCapture(name)
+        assert shared.channels == 4
+        stream = shared.stream(channel=1)
+        capture.start()
+
+        chunk = np.frombuffer(stream.read(2 * 1000), dtype="int16")
+        np.testing.assert_array_equal(chunk, frames[:1000, 1])
+    finally:
+        capture.stop()
+
+
+def test_capture_blocks_from_start_time(tmp_path):
+    frames = np.arange(16000, dtype="int16").reshape(-1, 1)
+    wav_file = tmp_path / "mono.wav"
+    _write_wav(wav_file, frames)
+
+    async def first_block():
+        capture = WavCapture(str(wav_file), block_size=1600, speed=10).start()
+        blocks = capture.blocks(400, start_time=1)
+        try:
+            return np.frombuffer(await blocks.__anext__(), dtype="int16")
+        finally:
+            await blocks.aclose()
+            capture.stop()
+
+    # Starting from a time older than the buffer reads from the oldest frame
+    np.testing.assert_array_equal(asyncio.run(first_block()), frames[:400, 0])
+
+
+def test_capture_blocks_end_with_the_wav_file(tmp_path):
+    frames = np.arange(1000, dtype="int16").reshape(-1, 1)
+    wav_file = tmp_path / "short.wav"
+    _write_wav(wav_file, frames)
+
+    async def all_blocks():
+        capture = WavCapture(str(wav_file), block_size=100, speed=50).start()
+        try:
+            return [
+                np.frombuffer(block, dtype="int16").copy()
+                async for block in capture.blocks(300, start_time=1)
+            ]
+        finally:
+            capture.stop()
+
+    blocks = asyncio.wait_for(all_blocks(), timeout=5)
+    np.testing.assert_array_equal(np.concatenate(asyncio.run(blocks)), frames[:, 0])
+
+
+def test_shared_capture_blocks_are_views_ending_with_the_capture(tmp_path):
+    frames = np.arange(1000 * 4, dtype="int16").reshape(-1, 4)
+    wav_file = tmp_path / "four-channels.wav"
+    _write_wav(wav_file, frames)
+
+    name = f"raspvan-test-{uuid.uuid4().hex}"
+    capture = WavCapture(str(wav_file), shm_name=name, block_size=100, speed=50)
+    shared = SharedCapture(name)
+
+    async def all_blocks():
+        blocks = []
+        async for block in shared.blocks(300, start_time=1, channel=1):
+            # A channel of the shared buffer, not a copy of it
+            assert np.shares_memory(block, shared.ring._data)
+            blocks.append(block.copy())
+        return blocks
+
+    try:
+        capture.start()
+        blocks = asyncio.run(asyncio.wait_for(all_blocks(), timeout=5))
+    finally:
+        capture.stop()
+
+    np.testing.assert_array_equal(np.concatenate(blocks), frames[:, 1])
@@ -0,0 +1,40 @@
+import wave
+
+import numpy as np
+
+from respeaker.chime import ChimePlayer
+
+
+def _chime(path, n_frames):
+    with wave.open(str(path), "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(16000)
+        wf.writeframes(np.arange(1, n_frames + 1, dtype="int16").tobytes())
+
+
+def test_chime_plays_from_memory(tmp_path):
+    _chime(tmp_path / "ding.wav", 200)
+    player = ChimePlayer(str(tmp_path / "ding.wav"), block_size=128)
+
+    outdata = bytearray(256)
+    player._callback(outdata, 128, None, None)
+    assert outdata == bytes(256)  # silence while idle
+
+    player._pos = 0  # as 'play' does without opening the stream
+    player._callback(outdata, 128, None, None)
+    assert np.frombuffer(outdata, dtype="int16")[0] == 1
+    player._callback(outdata, 128, None, None)
+    samples = np.frombuffer(outdata, dtype="int16")
+    assert samples[71] == 200 and not samples[72:].any()
+    assert not player.playing
+
+
+def test_chime_null_sink_fallback(tmp_path):
+    player = ChimePlayer(str(tmp_path / "missing.wav")).start()
+    player.play()
+    player.play()
+
+    assert player.null_sink
+    assert player.plays == 2
+    assert not player.playing
@@ -0,0 +1,55 @@
+import numpy as np
+import scipy.io.wavfile as wf
+
+from common.vad import VoiceActivityDetector
+
+SAMPLE_RATE = 16000
+
+
+def _tone(freq, seconds):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    return (np.sin(2 * np.pi * freq * t) * 8000).astype("int16")
+
+
+def test_detect_speech_labels_voice_band_windows(tmp_path):
+    wav_file = str(tmp_path / "tones.wav")
+    # 1s out of the voice band, 1s within it and 1s out of it again
+    data = np.concatenate([_tone(5000, 1), _tone(1000, 1), _tone(5000, 1)])
+    wf.write(wav_file, SAMPLE_RATE, data)
+
+    vad = VoiceActivityDetector(wav_file)
+    detected_windows = vad.detect_speech(batch_windows=64)
+
+    # Windows of 20ms every 10ms, starting before the last full one
+    assert len(detected_windows) == 298
+    np.testing.assert_array_equal(detected_windows[:3, 0], [0, 160, 320])
+    speech = detected_windows[detected_windows[:, 1] == 1, 0] / SAMPLE_RATE
+    assert 0.95 <= speech.min() and speech.max() < 2.0
+
+
+def test_stream_speech_matches_detect_speech(tmp_path):
+    wav_file = str(tmp_path / "tones.wav")
+    rng = np.random.default_rng(0)
+    segments = [_tone(1000 if i % 2 else 5000, rng.uniform(0.3, 1.5)) for i in range(9)]
+    data = np.stack([np.concatenate(segments)] * 2, axis=1)
+    wf.write(wav_file, SAMPLE_RATE, data)
+
+    vad = VoiceActivityDetector(wav_file)
+    expected = vad.convert_windows_to_readible_labels(vad.detect_speech())
+
+    streaming = VoiceActivityDetector(wav_file, mmap=True)
+    # Chunks shorter than the median filter window
+    assert list(streaming.stream_speech(chunk_seconds=0.37)) == expected
+    assert list(streaming.stream_speech()) == expected
+    assert len(expected) == 4
+
+
+def test_stream_speech_until_the_end(tmp_path):
+    wav_file = str(tmp_path / "tones.wav")
+    wf.write(wav_file, SAMPLE_RATE, np.concatenate([_tone(5000, 1), _tone(1000, 1)]))
+
+    vad = VoiceActivityDetector(wav_file, mmap=True)
+    assert list(vad.stream_speech()) == []
+    (segment,) = vad.stream_speech(until_end=True)
+    assert 0.95 <= segment["speech_begin"] < 1.05
+    assert segment["speech_end"] == 2.0
@@ -0,0 +1,60 @@
+import numpy as np
+
+from asr.endpointer import Endpointer
+from asr.vad import VAD
+
+SAMPLE_RATE = 16000
+FRAME = 480  # 30ms @ 16kHz
+
+
+class _LoudVAD(VAD):
+    """Frames with any non-zero sample are speech"""
+
+    def __init__(self):
+        super().__init__(1)
+
+    def is_speech(self, frame, sample_rate):
+        return any(frame)
+
+
+def _audio(*segments_ms):
+    """Alternating silence / speech segments of the given durations"""
+    chunks = [
+        np.full(SAMPLE_RATE * ms // 1000, i % 2, dtype="int16")
+        for i, ms in enumerate(segments_ms)
+    ]
+    return np.concatenate(chunks)
+
+
+def _run(endpointer, audio, block_size=4000):
+    events = []
+    for i in range(0, len(audio), block_size):
+        events += endpointer.process(audio[i : i + block_size].tobytes())
+    return events
+
+
+def test_endpointer_start_and_end_events():
+    ep = Endpointer(_LoudVAD(), SAMPLE_RATE, pre_padding_ms=0, post_padding_ms=0)
+    events = _run(ep, _audio(600, 900, 1200))
+
+    assert events == [
+        (Endpointer.START, 20 * FRAME),
+        (Endpointer.END, 50 * FRAME),
+    ]
+    assert not ep.in_speech
+
+
+def test_endpointer_bridges_short_pauses():
+    ep = Endpointer(_LoudVAD(), SAMPLE_RATE, hangover_ms=300)
+    events = _run(ep, _audio(600, 600, 150, 600, 1200))
+
+    assert [kind for kind, _ in events] == [Endpointer.START, Endpointer.END]
+
+
+def test_endpointer_keeps_partial_frames_across_blocks():
+    ep = Endpointer(_LoudVAD(), SAMPLE_RATE)
+    audio = _audio(300, 600)
+    _run(ep, audio, block_size=1000)
+
+    assert ep.samples == len(audio) // FRAME * FRAME
+    assert ep.in_speech
@@ -0,0 +1,114 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from raspvan.workers import hotword
+from raspvan.workers.hotword import ActivationDispatcher, ASRTrigger
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_dispatcher_drops_activations_while_busy():
+    handling, release = threading.Event(), threading.Event()
+    handled = []
+
+    def handler(timestamp):
+        handling.set()
+        release.wait(timeout=5)
+        handled.append(timestamp)
+
+    dispatcher = ActivationDispatcher(handler, max_queued=2)
+    dispatcher.start()
+    dispatcher.dispatch(1.0)
+    assert handling.wait(timeout=5)
+
+    # The handler is stuck: 2 activations queued, the rest dropped
+    for timestamp in (2.0, 3.0, 4.0, 5.0):
+        dispatcher.dispatch(timestamp)
+    release.set()
+    assert _wait_for(lambda: len(handled) == 3)
+    dispatcher.stop()
+
+    assert handled == [1.0, 2.0, 3.0]
+    assert dispatcher.dropped == 2
+
+
+def test_dispatcher_survives_handler_errors():
+    handled = []
+
+    def handler(timestamp):
+        handled.append(timestamp)
+        if timestamp == 1.0:
+            raise RuntimeError("Broker down")
+
+    dispatcher = ActivationDispatcher(handler)
+    dispatcher.start()
+    dispatcher.dispatch(1.0)
+    dispatcher.dispatch(2.0)
+    dispatcher.stop()
+
+    assert handled == [1.0, 2.0]
+    assert dispatcher.dropped == 0
+
+
+class _Dispatcher:
+    def __init__(self):
+        self.dispatched = []
+
+    def dispatch(self, timestamp):
+        self.dispatched.append(timestamp)
+
+    def stop(self):
+        pass
+
+
+def _trigger(monkeypatch, refractory_s):
+    """Trigger with a fake clock (set 'now') recording the dispatched
+    activations instead of publishing them
+    """
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(hotword, "time", SimpleNamespace(time=lambda: clock.now))
+    trigger = ASRTrigger(
+        "hotword.detected", None, None, chime=object(), refractory_s=refractory_s
+    )
+    trigger.dispatcher.stop()
+    trigger.dispatcher = _Dispatcher()
+    return trigger, clock
+
+
+def test_trigger_suppresses_activations_within_the_refractory_window(monkeypatch):
+    trigger, clock = _trigger(monkeypatch, refractory_s=3.0)
+
+    for now in (1000.0, 1000.5, 1002.9, 1003.0):
+        clock.now = now
+        trigger.on_activation()
+
+    assert trigger.dispatcher.dispatched == [1000.0, 1003.0]
+    assert trigger.suppressed == 2
+
+
+def test_suppressed_activations_do_not_restart_the_window(monkeypatch):
+    trigger, clock = _trigger(monkeypatch, refractory_s=3.0)
+
+    # A continuous source of triggers, every second
+    for now in range(1000, 1008):
+        clock.now = float(now)
+        trigger.on_activation()
+
+    assert trigger.dispatcher.dispatched == [1000.0, 1003.0, 1006.0]
+    assert trigger.suppressed == 5
+
+
+def test_no_refractory_window(monkeypatch):
+    trigger, _ = _trigger(monkeypatch, refractory_s=0)
+
+    trigger.on_activation()
+    trigger.on_activation()
+
+    assert trigger.dispatcher.dispatched == [1000.0, 1000.0]
+    assert trigger.suppressed == 0
@@ -0,0 +1,136 @@
+import uuid
+
+import pika
+import pytest
+
+from common.utils.memory_broker import is_memory_uri, MemoryConnection, topic_matches
+
+
+@pytest.fixture
+def connection():
+    # A broker of its own for each test
+    connection = MemoryConnection(f"memory://{uuid.uuid4().hex}")
+    yield connection
+    if connection.is_open:
+        connection.close()
+
+
+def _consume(channel, queue_name):
+    received = []
+    channel.basic_consume(
+        queue=queue_name,
+        on_message_callback=lambda ch, method, props, body: received.append(
+            (method.delivery_tag, method.routing_key, body, method.redelivered)
+        ),
+    )
+    return received
+
+
+@pytest.mark.parametrize(
+    "pattern, routing_key, expected",
+    [
+        ("hotword.detected", "hotword.detected", True),
+        ("hotword.*", "hotword.detected", True),
+        ("hotword.*", "hotword.detected.twice", False),
+        ("*.complete", "asr.complete", True),
+        ("#", "asr.complete", True),
+        ("#.complete", "complete", True),
+        ("asr.#", "asr", True),
+        ("asr.#.done", "asr.a.b.done", True),
+        ("asr.#.done", "asr.a.b", False),
+        ("*", "", True),
+        ("*", "a.b", False),
+    ],
+)
+def test_topic_matches(pattern, routing_key, expected):
+    assert topic_matches(pattern, routing_key) is expected
+
+
+def test_is_memory_uri():
+    assert is_memory_uri("memory://")
+    assert is_memory_uri("memory://pipeline")
+    assert not is_memory_uri("localhost")
+    assert not is_memory_uri(None)
+
+
+def test_topic_exchange_routing(connection):
+    channel = connection.channel()
+    channel.exchange_declare(exchange="fiona", exchange_type="topic", durable=True)
+    queue_name = channel.queue_declare(queue="", durable=True).method.queue
+    channel.queue_bind(exchange="fiona", queue=queue_name, routing_key="*.complete")
+    received = _consume(channel, queue_name)
+
+    channel.basic_publish(exchange="fiona", routing_key="asr.complete", body="a")
+    channel.basic_publish(exchange="fiona", routing_key="hotword.detected", body="b")
+    channel.basic_publish(exchange="fiona", routing_key="nlu.complete", body=b"c")
+    connection.process_data_events(time_limit=0)
+
+    assert [(key, body) for _, key, body, _ in received] == [
+        ("asr.complete", b"a"),
+        ("nlu.complete", b"c"),
+    ]
+
+
+def test_prefetch_and_acks(connection):
+    channel = connection.channel()
+    channel.queue_declare(queue="work")
+    channel.basic_qos(prefetch_count=2)
+    received = _consume(channel, "work")
+    for i in range(5):
+        channel.basic_publish(exchange="", routing_key="work", body=str(i))
+    connection.process_data_events(time_limit=0)
+
+    # Only up to the prefetch count is delivered until acked
+    assert [body for _, _, body, _ in received] == [b"0", b"1"]
+    assert channel.queue_declare(queue="work", passive=True).method.message_count == 3
+
+    channel.basic_ack(delivery_tag=2, multiple=True)
+    connection.process_data_events(time_limit=0)
+    assert [body for _, _, body, _ in received] == [b"0", b"1", b"2", b"3"]
+
+
+def test_nack_requeues_and_close_redelivers(connection):
+    channel = connection.channel()
+    channel.queue_declare(queue="work")
+    channel.basic_qos(prefetch_count=1)
+    received = _consume(channel, "work")
+    channel.basic_publish(exchange="", routing_key="work", body="a")
+    connection.process_data_events(time_limit=0)
+
+    channel.basic_nack(delivery_tag=1, requeue=True)
+    connection.process_data_events(time_limit=0)
+    assert received[-1] == (2, "work", b"a", True)
+
+    # Unacked messages go back to the queue for the next consumer
+    channel.close()
+    other = connection.channel()
+    received = _consume(other, "work")
+    connection.process_data_events(time_limit=0)
+    assert [body for _, _, body, _ in received] == [b"a"]
+
+
+def test_channel_errors(connection):
+    channel = connection.channel()
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        channel.queue_declare(queue="missing", passive=True)
+    assert not channel.is_open
+
+    channel = connection.channel()
+    with pytest.raises(pika.exceptions.ChannelClosedByBroker):
+        channel.basic_publish(exchange="missing", routing_key="a", body="a")
+
+
+def test_publisher_confirms(connection):
+    channel = connection.channel()
+    confirms, selected = [], []
+    channel._impl.confirm_delivery(
+        ack_nack_callback=lambda frame: confirms.append(frame.method.delivery_tag),
+        callback=selected.append,
+    )
+    channel.exchange_declare(exchange="fiona", exchange_type="topic")
+    for _ in range(3):
+        channel.basic_publish(exchange="fiona", routing_key="unbound", body="a")
+    connection.process_data_events(time_limit=0)
+
+    assert len(selected) == 1
+    assert confirms == [1, 2, 3]
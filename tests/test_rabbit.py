@@ -0,0 +1,533 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from datetime import datetime as dt, timezone
+
+import pika
+import pytest
+
+from common.utils import rabbit
+from raspvan.constants import (
+    DEFAULT_EXCHANGE,
+    DEFAULT_HOTWORD_ASR_TOPIC,
+    DEFAULT_RABBITMQ_PORT,
+    RABBITMQ_HOST_ENV_VAR,
+    RABBITMQ_PORT_ENV_VAR,
+)
+
+
+@pytest.fixture
+def host():
+    # A broker of its own for each test
+    return f"memory://{uuid.uuid4().hex}"
+
+
+def _start(consumer):
+    thread = threading.Thread(target=consumer.consume, daemon=True)
+    thread.start()
+    return thread
+
+
+def _stop(consumer, thread):
+    consumer._connection.add_callback_threadsafe(consumer._channel.stop_consuming)
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    consumer.close()
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def _broker_down():
+    raise pika.exceptions.AMQPConnectionError("Broker down")
+
+
+def test_blocking_publisher_outbox_while_disconnected(host, monkeypatch):
+    received = []
+    consumer = rabbit.BlockingQueueConsumer(
+        on_event=lambda event: received.append(event["i"]),
+        on_done=lambda: None,
+        load_func=None,
+        queue_name="work",
+        host=host,
+    )
+    publisher = rabbit.BlockingQueuePublisher(
+        host=host, queue_name="work", outbox_size=3
+    )
+    assert publisher.send_message([{"i": 0}], topic="work")
+
+    connect = publisher.connect
+    monkeypatch.setattr(publisher, "connect", _broker_down)
+    publisher._connection.close()
+    for i in range(1, 6):
+        assert not publisher.send_message([{"i": i}], topic="work")
+    # Only the latest messages are kept
+    assert publisher.stats["queued"] == 3
+    assert publisher.stats["dropped"] == 2
+
+    monkeypatch.setattr(publisher, "connect", connect)
+    publisher._next_attempt = 0.0  # Done backing off
+    assert publisher.send_message([{"i": 6}], topic="work")
+    thread = _start(consumer)
+    assert _wait_for(lambda: len(received) == 5)
+    _stop(consumer, thread)
+    publisher.close()
+
+    # The queued messages first, in order
+    assert received == [0, 3, 4, 5, 6]
+    assert publisher.stats["reconnects"] == 1
+    assert publisher.stats["queued"] == 0
+
+
+def test_blocking_publisher_backs_off_reconnecting(host, monkeypatch):
+    publisher = rabbit.BlockingQueuePublisher(host=host)
+    publisher.MAX_RECONNECT_DELAY_S = 1.5
+    attempts = []
+
+    def broker_down():
+        attempts.append(1)
+        _broker_down()
+
+    monkeypatch.setattr(publisher, "connect", broker_down)
+    delays = []
+    for i in range(5):
+        publisher._next_attempt = 0.0
+        assert not publisher.send_message([{"i": i}], topic="work")
+        delays.append(publisher._next_attempt - time.monotonic())
+
+    # Retried right away once, then doubling the delay up to the maximum
+    assert delays == pytest.approx([0.0, 0.5, 1.0, 1.5, 1.5], abs=0.05)
+    # No attempts while backing off
+    assert not publisher.send_message([{"i": 5}], topic="work")
+    assert len(attempts) == 5
+    assert publisher.stats["queued"] == 6
+
+
+def test_blocking_publisher_confirm_window(host):
+    received = []
+    consumer = rabbit.BlockingQueueConsumer(
+        on_event=lambda event: received.append(event["i"]),
+        on_done=lambda: None,
+        load_func=None,
+        exchange_name="fiona",
+        exchange_type="topic",
+        routing_keys=["work"],
+        host=host,
+    )
+    publisher = rabbit.BlockingQueuePublisher(
+        host=host,
+        exchange_name="fiona",
+        exchange_type="topic",
+        confirm=True,
+        max_unconfirmed=4,
+    )
+    in_flight = []
+    publish = publisher._publish
+
+    def tracked_publish(message, topic):
+        in_flight.append(len(publisher._unconfirmed))
+        publish(message, topic)
+
+    publisher._publish = tracked_publish
+
+    assert publisher.publish_many([[{"i": i}] for i in range(50)], topic="work")
+    # Not routed to any queue, but confirmed all the same
+    assert publisher.send_message([{"i": -1}], topic="nowhere")
+    assert publisher.wait_for_confirms()
+    thread = _start(consumer)
+    assert _wait_for(lambda: len(received) == 50)
+    _stop(consumer, thread)
+    publisher.close()
+
+    # Pipelined up to the window, each message published once
+    assert max(in_flight) == 4
+    assert received == list(range(50))
+    stats = publisher.stats
+    assert stats["published"] == stats["confirmed"] == 51
+    assert stats["unconfirmed"] == stats["queued"] == stats["nacked"] == 0
+
+
+def test_blocking_consumer_keeps_the_order_by_key_across_workers(host):
+    results, done = [], []
+    running, overlaps = [], []
+    lock = threading.Lock()
+
+    def on_event(event):
+        with lock:
+            running.append(event["key"])
+            overlaps.append(len(running))
+        time.sleep(0.001 * (event["seq"] % 3))
+        with lock:
+            running.remove(event["key"])
+        return event["key"], event["seq"]
+
+    consumer = rabbit.BlockingQueueConsumer(
+        on_event=on_event,
+        on_done=lambda: done.append(1),
+        load_func=None,
+        exchange_name="fiona",
+        exchange_type="topic",
+        routing_keys=["hotword.*"],
+        host=host,
+        workers=4,
+        # One message of each key at a time, despite the workers
+        order_key=lambda method, properties, body: method.routing_key,
+        on_result=results.append,
+    )
+    thread = _start(consumer)
+    publisher = rabbit.BlockingQueuePublisher(
+        host=host, exchange_name="fiona", exchange_type="topic"
+    )
+    for seq in range(40):
+        key = "ab"[seq % 2]
+        publisher.send_message([{"key": key, "seq": seq}], topic=f"hotword.{key}")
+
+    assert _wait_for(lambda: len(done) == 40)
+    _stop(consumer, thread)
+    publisher.close()
+
+    for key in "ab":
+        assert [seq for k, seq in results if k == key] == list(
+            range("ab".index(key), 40, 2)
+        )
+    # Both keys processed concurrently, never 2 messages of the same one
+    assert max(overlaps) == 2
+
+
+def test_blocking_consumer_acks_failed_messages(host):
+    results, done = [], []
+
+    def on_event(event):
+        if event["seq"] == 3:
+            raise ValueError("Unexpected event")
+        return event["seq"]
+
+    consumer = rabbit.BlockingQueueConsumer(
+        on_event=on_event,
+        on_done=lambda: done.append(1),
+        load_func=None,
+        queue_name="work",
+        host=host,
+        workers=2,
+        on_result=results.append,
+    )
+    thread = _start(consumer)
+    publisher = rabbit.BlockingQueuePublisher(host=host, queue_name="work")
+    for seq in range(6):
+        publisher.send_message([{"seq": seq}], topic="work")
+
+    assert _wait_for(lambda: len(done) == 5 and consumer.in_flight == 0)
+    _stop(consumer, thread)
+    publisher.close()
+
+    assert sorted(results) == [0, 1, 2, 4, 5]
+    assert rabbit.get_q_count(publisher.connect()[1], "work") == 0
+
+
+def test_blocking_publisher_waits_below_the_queue_limit(host, monkeypatch):
+    received = []
+    consumer = rabbit.BlockingQueueConsumer(
+        on_event=lambda event: received.append(event["i"]),
+        on_done=lambda: None,
+        load_func=None,
+        queue_name="work",
+        host=host,
+    )
+    publisher = rabbit.BlockingQueuePublisher(host=host, queue_name="work", q_lim=5)
+    checks = []
+    get_q_count = rabbit.get_q_count
+
+    def counted_get_q_count(channel, queue_name):
+        checks.append(queue_name)
+        return get_q_count(channel, queue_name)
+
+    monkeypatch.setattr(rabbit, "get_q_count", counted_get_q_count)
+
+    # The queue depth is only checked once the credit is spent
+    for i in range(5):
+        assert publisher.send_message([{"i": i}], topic="work")
+    assert len(checks) == 1
+
+    def send():
+        for i in range(5, 30):
+            publisher.send_message([{"i": i}], topic="work")
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+
+    # Nothing consumed yet: the publisher stops at the limit
+    time.sleep(0.05)
+    assert sender.is_alive()
+    assert publisher.published == 5
+
+    thread = _start(consumer)
+    sender.join(timeout=5)
+    assert not sender.is_alive()
+    assert _wait_for(lambda: len(received) == 30)
+    _stop(consumer, thread)
+    publisher.close()
+
+    assert received == list(range(30))
+    assert publisher.stats["blocked"]["count"] >= 1
+
+
+def test_workers_talk_through_a_memory_broker_from_the_env(host, monkeypatch):
+    monkeypatch.setenv(RABBITMQ_HOST_ENV_VAR, host)
+    monkeypatch.delenv(RABBITMQ_PORT_ENV_VAR, raising=False)
+    amqp_host, amqp_port = rabbit.get_amqp_uri_from_env()
+    received = []
+    # As the ASR worker listens to the hotword one
+    consumer = rabbit.BlockingQueueConsumer(
+        on_event=lambda event: received.append(event["status"]),
+        on_done=lambda: None,
+        load_func=None,
+        exchange_name=DEFAULT_EXCHANGE,
+        exchange_type="topic",
+        routing_keys=[DEFAULT_HOTWORD_ASR_TOPIC],
+        host=amqp_host,
+        port=amqp_port,
+    )
+    thread = _start(consumer)
+    publisher = rabbit.BlockingQueuePublisher(
+        host=amqp_host,
+        port=amqp_port,
+        exchange_name=DEFAULT_EXCHANGE,
+        exchange_type="topic",
+    )
+    assert publisher.send_message(
+        [rabbit.make_event("detected")], topic=DEFAULT_HOTWORD_ASR_TOPIC
+    )
+    assert publisher.send_message([rabbit.make_event("other")], topic="nlu.complete")
+
+    assert _wait_for(lambda: received == ["detected"])
+    _stop(consumer, thread)
+    publisher.close()
+
+    assert amqp_port == DEFAULT_RABBITMQ_PORT
+
+
+def test_async_publish_and_consume(host):
+    async def roundtrip():
+        consumer = rabbit.AsyncQueueConsumer(
+            exchange_name="fiona",
+            exchange_type="topic",
+            routing_keys=["#.complete"],
+            host=host,
+        )
+        publisher = rabbit.AsyncQueuePublisher(
+            host=host, exchange_name="fiona", exchange_type="topic"
+        )
+        await consumer.connect()
+        await publisher.publish_many([[{"n": i}] for i in range(5)], "asr.complete")
+        await publisher.send_message([{"n": 5}], topic="hotword.detected")
+        await publisher.send_message([{"n": 6}], topic="nlu.complete")
+
+        received = []
+        async for delivery in consumer:
+            received += [(delivery.routing_key, e["n"]) for e in delivery.events]
+            delivery.ack()
+            if len(received) == 6:
+                break
+        await publisher.close()
+        await consumer.close()
+        return received, publisher.published
+
+    received, published = asyncio.run(asyncio.wait_for(roundtrip(), timeout=5))
+
+    assert received == [("asr.complete", i) for i in range(5)] + [("nlu.complete", 6)]
+    assert published == 7
+
+
+def test_async_consume_ends_when_closed(host):
+    async def consume():
+        events, done = [], []
+
+        async def on_event(event):
+            events.append(event["n"])
+            if len(events) == 3:
+                await consumer.close()
+
+        consumer = rabbit.AsyncQueueConsumer(
+            on_event=on_event,
+            on_done=lambda: done.append(1),
+            queue_name="work",
+            host=host,
+        )
+        publisher = rabbit.AsyncQueuePublisher(host=host, queue_name="work")
+        await consumer.connect()
+        await publisher.publish_many([[{"n": i}] for i in range(3)], "work")
+        await consumer.consume()
+        await publisher.close()
+
+        # Closed before acking the last message, which goes back to the queue
+        other = rabbit.AsyncQueueConsumer(queue_name="work", host=host)
+        redelivered = await other.__anext__()
+        await other.close()
+        return events, done, list(redelivered.events)
+
+    events, done, redelivered = asyncio.run(asyncio.wait_for(consume(), timeout=5))
+
+    assert events == [0, 1, 2]
+    assert len(done) == 3
+    assert redelivered == [{"n": 2}]
+
+
+def test_async_consume_acks_failed_messages(host):
+    async def consume():
+        events, done = [], []
+
+        async def on_event(event):
+            events.append(event["n"])
+            if event["n"] == 1:
+                raise ValueError("Unexpected event")
+            if event["n"] == 3:
+                await consumer.close()
+
+        consumer = rabbit.AsyncQueueConsumer(
+            on_event=on_event,
+            on_done=lambda: done.append(1),
+            queue_name="work",
+            host=host,
+        )
+        publisher = rabbit.AsyncQueuePublisher(host=host, queue_name="work")
+        await consumer.connect()
+        await publisher.publish_many([[{"n": i}] for i in range(4)], "work")
+        await consumer.consume()
+        await publisher.close()
+
+        # Only the message being handled when closing goes back to the queue
+        other = rabbit.AsyncQueueConsumer(queue_name="work", host=host)
+        redelivered = await other.__anext__()
+        await other.close()
+        return events, done, list(redelivered.events)
+
+    events, done, redelivered = asyncio.run(asyncio.wait_for(consume(), timeout=5))
+
+    assert events == [0, 1, 2, 3]
+    assert len(done) == 3
+    assert redelivered == [{"n": 3}]
+
+
+def _batch_consumer(host, on_batch, on_done=lambda: None):
+    return rabbit.BlockingQueueConsumer(
+        on_event=None,
+        on_done=on_done,
+        load_func=None,
+        queue_name="work",
+        host=host,
+        on_batch=on_batch,
+        batch_size=8,
+        batch_ms=20,
+    )
+
+
+def test_blocking_consumer_batches(host):
+    batches = []
+
+    def on_batch(events):
+        batches.append([event["i"] for event in events])
+        return [None] * len(events)
+
+    consumer = _batch_consumer(host, on_batch)
+    publisher = rabbit.BlockingQueuePublisher(host=host, queue_name="work")
+    publisher.publish_many([[{"i": i}] for i in range(30)], topic="work")
+    publisher.send_message([{"i": 30}, {"i": 31}], topic="work")
+
+    thread = _start(consumer)
+    assert _wait_for(lambda: sum(len(b) for b in batches) == 32)
+    _stop(consumer, thread)
+    publisher.close()
+
+    assert [i for batch in batches for i in batch] == list(range(32))
+    assert max(len(batch) for batch in batches) == 8
+
+
+def test_blocking_consumer_nacks_only_the_poison_message(host):
+    batches, done = [], []
+
+    def on_batch(events):
+        batches.append([event["i"] for event in events])
+        if any(event["i"] == 2 for event in events):
+            raise ValueError("Poison message")
+        return [event["i"] for event in events]
+
+    consumer = _batch_consumer(host, on_batch, on_done=lambda: done.append(1))
+    publisher = rabbit.BlockingQueuePublisher(host=host, queue_name="work")
+    publisher.publish_many([[{"i": i}] for i in range(4)], topic="work")
+
+    thread = _start(consumer)
+    assert _wait_for(lambda: len(done) == 3)
+    _stop(consumer, thread)
+    publisher.close()
+
+    # The whole batch, then each message on its own
+    assert batches == [[0, 1, 2, 3], [0], [1], [2], [3]]
+    # The poison message is rejected (not requeued), the rest acked
+    other = rabbit.BlockingQueuePublisher(host=host, queue_name="work")
+    assert rabbit.get_q_count(other.connect()[1], "work") == 0
+
+
+@pytest.mark.parametrize(
+    "codec, content_type",
+    [
+        ("json", rabbit.JSON_CONTENT_TYPE),
+        ("orjson", rabbit.JSON_CONTENT_TYPE),
+        ("msgpack", rabbit.MSGPACK_CONTENT_TYPE),
+    ],
+)
+def test_codec_round_trip(codec, content_type):
+    events = [rabbit.make_event("completed", text="lights on", n=1)]
+    body, properties = rabbit._encode(rabbit.get_codec(codec), events)
+
+    assert properties.content_type == content_type
+    assert properties.headers == {rabbit.SCHEMA_HEADER: rabbit.EVENT_SCHEMA_VERSION}
+    # Decoded by the content type, whatever the consumer 'load_func'
+    assert rabbit._get_loader(properties, None)(body) == events
+
+
+def test_encoded_messages_are_decoded_with_the_load_func():
+    body, properties = rabbit._encode(rabbit.get_codec("msgpack"), '[{"n": 1}]')
+
+    assert properties.content_type is None
+    assert rabbit._get_loader(properties, json.loads)(body) == [{"n": 1}]
+    with pytest.raises(ValueError, match="No decoder"):
+        rabbit._get_loader(properties, None)
+
+
+def test_make_event():
+    event = rabbit.make_event("detected", seq=3)
+
+    assert event["v"] == rabbit.EVENT_SCHEMA_VERSION
+    assert event["status"] == "detected"
+    assert event["seq"] == 3
+    assert dt.fromisoformat(event["timestamp"]).tzinfo == timezone.utc
+
+
+def test_blocking_consumer_acks_messages_without_decoder(host):
+    done = []
+    consumer = rabbit.BlockingQueueConsumer(
+        on_event=lambda event: event,
+        on_done=lambda: done.append(1),
+        load_func=None,
+        queue_name="work",
+        host=host,
+        workers=2,
+    )
+    thread = _start(consumer)
+    publisher = rabbit.BlockingQueuePublisher(
+        host=host, queue_name="work", codec="msgpack"
+    )
+    publisher.send_message('[{"n": 0}]', topic="work")  # no content type
+    publisher.send_message([{"n": 1}], topic="work")
+
+    assert _wait_for(lambda: len(done) == 1 and consumer.in_flight == 0)
+    _stop(consumer, thread)
+    publisher.close()
+
+    assert rabbit.get_q_count(publisher.connect()[1], "work") == 0
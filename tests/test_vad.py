@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from asr.vad import EnergyGate, VAD
+
+
+def test_vad_frames_are_views_of_the_pcm_data():
+    vad = VAD(1)
+    pcm_data = bytes(2 * 4000)  # 250ms @ 16kHz
+
+    frames = list(vad.frames(pcm_data, 16000, 30))
+
+    # 8 frames of 30ms and a trailing 10ms frame
+    assert [len(f) for f in frames] == [960] * 8 + [320]
+    assert all(isinstance(f, memoryview) for f in frames)
+
+
+def test_vad_frames_drop_too_short_tail():
+    vad = VAD(1)
+    frames = list(vad.frames(bytes(2 * (480 + 100)), 16000, 30))
+
+    assert [len(f) for f in frames] == [960]
+
+
+def test_vad_is_voice_on_partial_frames():
+    vad = VAD(1)
+
+    # 48kHz blocks leave a 3.3ms tail webrtcvad would reject
+    assert not vad.is_voice(bytes(2 * 4000), 48000, 20)
+    with pytest.raises(ValueError):
+        vad.is_voice(bytes(2 * 4000), 16000, 25)
+
+
+def _noise(n, amplitude, seed=0):
+    rng = np.random.default_rng(seed)
+    return (rng.standard_normal(n) * amplitude).astype("int16").tobytes()
+
+
+def test_energy_gate_skips_blocks_near_the_noise_floor():
+    gate = EnergyGate(margin_db=6.0, warmup_blocks=2)
+    vad = VAD(1, gate=gate)
+
+    for i in range(5):
+        assert not vad.is_voice(_noise(4000, 50, seed=i), 16000)
+
+    # Warm-up blocks always go through webrtcvad
+    assert gate.stats["frames"] == 45
+    assert gate.stats["skipped"] == 27
+
+    # A much louder block is never gated
+    assert not gate.is_silence(_noise(4000, 3000), 9)
+    assert gate.skipped_frames == 27
+
+
+def test_energy_gate_without_noise_estimate_does_not_gate():
+    gate = EnergyGate(warmup_blocks=0)
+
+    assert not gate.is_silence(_noise(4000, 50), 9)
+    assert gate.skipped_frames == 0
+
+
+def test_energy_gate_floor_only_adapts_on_unvoiced_blocks():
+    gate = EnergyGate(warmup_blocks=0)
+    gate.is_silence(_noise(4000, 50), 9)
+    gate.update(0, 9)
+    floor = gate.noise_rms
+
+    # A partly voiced (louder) block must not raise the noise floor
+    gate.is_silence(_noise(4000, 400), 9)
+    gate.update(5, 9)
+    assert gate.noise_rms == floor
+
+    gate.is_silence(_noise(4000, 60, seed=1), 9)
+    gate.update(0, 9)
+    assert gate.noise_rms > floor